@@ -26,7 +26,7 @@ from esky.bootstrap import parse_version, join_app_version
 from esky.errors import *
 from esky.util import deep_extract_zipfile, copy_ownership_info, \
                       ESKY_CONTROL_DIR
-from esky.patch import apply_patch, PatchError
+from esky.patch import apply_patch, PatchStream, PatchError
 
 
 class VersionFinder(object):
@@ -105,10 +105,16 @@ class DefaultVersionFinder(VersionFinder):
     Zipfiles suitable for use with this class can be produced using the
     "bdist_esky" distutils command.  It also supports simple differential
     updates as produced by the "bdist_esky_patch" command.
+
+    If 'stream_patches' is true, patches are applied while they are being
+    downloaded rather than once the download is complete.  They are still
+    saved to disk, so a failed update can be retried without downloading
+    them again.
     """
 
-    def __init__(self,download_url):
+    def __init__(self,download_url,stream_patches=False):
         self.download_url = download_url
+        self.stream_patches = stream_patches
         super(DefaultVersionFinder,self).__init__()
         self.version_graph = VersionGraph()
 
@@ -197,22 +203,36 @@ class DefaultVersionFinder(VersionFinder):
                 raise EskyVersionError(version)
             if path is None:
                 raise EskyVersionError(version)
-            local_path = []
-            for url in path:
-                for status in self._fetch_file_iter(app,url):
-                    if status["status"] == "ready":
-                        local_path.append((status["path"],url))
-                    else:
-                        yield status
             try:
-                self._prepare_version(app,version,local_path)
+                if self.stream_patches:
+                    for status in self._stream_version_iter(app,version,path):
+                        yield status
+                else:
+                    local_path = []
+                    for url in path:
+                        for status in self._fetch_file_iter(app,url):
+                            if status["status"] == "ready":
+                                local_path.append((status["path"],url))
+                            else:
+                                yield status
+                    self._prepare_version(app,version,local_path)
             except PatchError:
                 yield {"status":"retrying","size":None}
         yield {"status":"ready","path":name}
 
-    def _fetch_file_iter(self,app,url):
+    def _download_name(self,app,url):
+        """Get the local path to which the given url is downloaded."""
         nm = os.path.basename(urlparse(url).path)
-        outfilenm = os.path.join(self._workdir(app,"downloads"),nm)
+        return os.path.join(self._workdir(app,"downloads"),nm)
+
+    def _fetch_file_iter(self,app,url,tee=None):
+        """Download the given url, yielding status information.
+
+        If 'tee' is given, the downloaded data is also written to it as it
+        arrives.  Nothing is written to it if the file was downloaded
+        previously.
+        """
+        outfilenm = self._download_name(app,url)
         if not os.path.exists(outfilenm):
             infile = self.open_url(urljoin(self.download_url,url))
             if not hasattr(infile,"size"):
@@ -228,6 +248,8 @@ class DefaultVersionFinder(VersionFinder):
                                "received": partfile.tell(),
                         }
                         partfile.write(data)
+                        if tee is not None:
+                            tee.write(data)
                         data = infile.read(1024*512)
                 except Exception:
                     partfile.close()
@@ -249,70 +271,123 @@ class DefaultVersionFinder(VersionFinder):
         """
         uppath = tempfile.mkdtemp(dir=self._workdir(app,"unpack"))
         try:
-            if not path:
-                self._copy_best_version(app,uppath)
-            else:
-                if path[0][0].endswith(".patch"):
-                    #  We're direcly applying a series of patches.
-                    #  Copy the current version across and go from there.
-                    try:
-                        self._copy_best_version(app,uppath)
-                    except EnvironmentError, e:
-                        self.version_graph.remove_all_links(path[0][1])
-                        err = "couldn't copy current version: %s" % (e,)
-                        raise PatchError(err)
-                    patches = path
-                else:
-                    #  We're starting from a zipfile.  Extract the first dir
-                    #  containing more than a single item and go from there.
-                    try:
-                        deep_extract_zipfile(path[0][0],uppath)
-                    except (zipfile.BadZipfile,zipfile.LargeZipFile):
-                        self.version_graph.remove_all_links(path[0][1])
-                        try:
-                            os.unlink(path[0][0])
-                        except EnvironmentError:
-                            pass
-                        raise
-                    patches = path[1:]
-                for (patchfile,patchurl) in patches:
+            for (patchfile,patchurl) in self._unpack_base_version(app,uppath,path):
+                try:
+                    with open(patchfile,"rb") as f:
+                        apply_patch(uppath,f)
+                except PatchError:
+                    self._discard_patch(patchfile,patchurl)
+                    raise
+            self._make_version_ready(app,version,uppath,path)
+        finally:
+            shutil.rmtree(uppath)
+
+    def _stream_version_iter(self,app,version,path):
+        """Fetch and prepare the requested version, yielding status info.
+
+        This is like fetching each file in the path and then calling
+        _prepare_version(), except that patches are applied as they are
+        downloaded.  A zipfile at the start of the path must be downloaded
+        in full before it can be extracted.
+        """
+        local_path = [(self._download_name(app,url),url) for url in path]
+        if path and not local_path[0][0].endswith(".patch"):
+            for status in self._fetch_file_iter(app,path[0]):
+                if status["status"] != "ready":
+                    yield status
+        uppath = tempfile.mkdtemp(dir=self._workdir(app,"unpack"))
+        try:
+            for (patchfile,patchurl) in self._unpack_base_version(app,uppath,local_path):
+                if os.path.exists(patchfile):
                     try:
                         with open(patchfile,"rb") as f:
                             apply_patch(uppath,f)
                     except PatchError:
-                        self.version_graph.remove_all_links(patchurl)
-                        try:
-                            os.unlink(patchfile)
-                        except EnvironmentError:
-                            pass
+                        self._discard_patch(patchfile,patchurl)
                         raise
-            # Move anything that's not the version dir into esky/bootstrap
-            vdir = join_app_version(app.name,version,app.platform)
-            vsdir = os.path.join(uppath,"versions")
-            #vsdir = uppath
-            bspath = os.path.join(vsdir,vdir,ESKY_CONTROL_DIR,"bootstrap")
-            if not os.path.isdir(bspath):
-                os.makedirs(bspath)
-            for nm in os.listdir(uppath):
-                if nm != vdir:
-                #if nm != "versions":
-                    os.rename(os.path.join(uppath,nm),os.path.join(bspath,nm))
-            # Check that it has an esky-files/bootstrap-manifest.txt file
-            bsfile = os.path.join(vsdir,vdir,ESKY_CONTROL_DIR,"bootstrap-manifest.txt")
-            if not os.path.exists(bsfile):
-                self.version_graph.remove_all_links(path[0][1])
-                err = "patch didn't create bootstrap-manifest.txt"
-                raise PatchError(err)
-            # Make it available for upgrading
-            rdpath = self._ready_name(app,version)
-            if os.path.exists(rdpath):
-                shutil.rmtree(rdpath)
-            os.rename(os.path.join(vsdir,vdir),rdpath)
-            for (filenm,_) in path:
-                os.unlink(filenm)
+                    continue
+                stream = PatchStream(uppath)
+                try:
+                    for status in self._fetch_file_iter(app,patchurl,stream):
+                        if status["status"] != "ready":
+                            yield status
+                    stream.close()
+                except PatchError:
+                    self._discard_patch(patchfile,patchurl)
+                    raise
+                finally:
+                    stream.abort()
+            self._make_version_ready(app,version,uppath,local_path)
         finally:
             shutil.rmtree(uppath)
 
+    def _unpack_base_version(self,app,uppath,path):
+        """Unpack the version at the start of the given path into uppath.
+
+        This is either the current version, or a downloaded zipfile.  The
+        list of patches remaining to be applied is returned.
+        """
+        if not path:
+            self._copy_best_version(app,uppath)
+            return []
+        if path[0][0].endswith(".patch"):
+            #  We're direcly applying a series of patches.
+            #  Copy the current version across and go from there.
+            try:
+                self._copy_best_version(app,uppath)
+            except EnvironmentError, e:
+                self.version_graph.remove_all_links(path[0][1])
+                err = "couldn't copy current version: %s" % (e,)
+                raise PatchError(err)
+            return path
+        #  We're starting from a zipfile.  Extract the first dir
+        #  containing more than a single item and go from there.
+        try:
+            deep_extract_zipfile(path[0][0],uppath)
+        except (zipfile.BadZipfile,zipfile.LargeZipFile):
+            self.version_graph.remove_all_links(path[0][1])
+            try:
+                os.unlink(path[0][0])
+            except EnvironmentError:
+                pass
+            raise
+        return path[1:]
+
+    def _discard_patch(self,patchfile,patchurl):
+        """Forget about a patch that failed to apply."""
+        self.version_graph.remove_all_links(patchurl)
+        try:
+            os.unlink(patchfile)
+        except EnvironmentError:
+            pass
+
+    def _make_version_ready(self,app,version,uppath,path):
+        """Move a prepared version from uppath into the "ready" dir."""
+        # Move anything that's not the version dir into esky/bootstrap
+        vdir = join_app_version(app.name,version,app.platform)
+        vsdir = os.path.join(uppath,"versions")
+        #vsdir = uppath
+        bspath = os.path.join(vsdir,vdir,ESKY_CONTROL_DIR,"bootstrap")
+        if not os.path.isdir(bspath):
+            os.makedirs(bspath)
+        for nm in os.listdir(uppath):
+            if nm != vdir:
+            #if nm != "versions":
+                os.rename(os.path.join(uppath,nm),os.path.join(bspath,nm))
+        # Check that it has an esky-files/bootstrap-manifest.txt file
+        bsfile = os.path.join(vsdir,vdir,ESKY_CONTROL_DIR,"bootstrap-manifest.txt")
+        if not os.path.exists(bsfile):
+            self.version_graph.remove_all_links(path[0][1])
+            err = "patch didn't create bootstrap-manifest.txt"
+            raise PatchError(err)
+        # Make it available for upgrading
+        rdpath = self._ready_name(app,version)
+        if os.path.exists(rdpath):
+            shutil.rmtree(rdpath)
+        os.rename(os.path.join(vsdir,vdir),rdpath)
+        for (filenm,_) in path:
+            os.unlink(filenm)
+
     def _copy_best_version(self,app,uppath):
         #best_vdir = join_app_version(app.name,app.version,app.platform)
         #source = os.path.join(app.appdir,best_vdir)
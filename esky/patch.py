@@ -49,6 +49,37 @@ the "-Z" or "--deep-zipped" option instead:
 This can be useful for generating differential esky updates by hand, when you
 already have the corresponding zip files.
 
+To spread the work of diffing individual files across several worker
+processes, pass the "-j" or "--jobs" option when generating a patch, e.g:
+
+  python -m esky.patch --jobs 4 diff <source> <target> <patch>
+
+Files no bigger than two diff windows are diffed whole by a worker; for bigger
+files, the individual windows are diffed by the workers.  Either way, the
+generated commands are identical to those produced by a single process.
+
+Inserted data and bsdiff payloads can be compressed with bz2, zlib or lzma;
+by default bz2 and zlib are tried and the smallest result is used.  To choose
+the codecs, or to favour decoding speed over patch size, use the "--codecs"
+and "--objective" options, e.g:
+
+  python -m esky.patch --codecs zlib,lzma --objective speed diff <src> <tgt>
+
+Patches using lzma can only be applied where the lzma module is available.
+
+To trade patch size for diffing speed, pass "--effort fast" to skip encoders
+that sampling suggests won't help, or "--effort best" to try them all.
+
+Passing "--patch-version 2" generates a version 2 patch, in which the commands
+for each top-level item of the target are grouped into a separate frame and
+an index of the frames is appended.  Frames for different items can be applied
+concurrently, so "--jobs" can also be given when applying such a patch, e.g:
+
+  python -m esky.patch --jobs 4 patch <source> <patch>
+
+Version 2 patches can't be applied by versions of this module older than the
+format itself, so version 1 is still generated by default.
+
 """
 
 from __future__ import with_statement
@@ -59,13 +90,30 @@ except NameError:
 
 
 import os
+import re
 import sys
+import imp
 import bz2
+import stat
+import zlib
+import copy
+import mmap
+import types
+import marshal
+import heapq
+import operator
+import itertools
+import posixpath
 import shutil
 import hashlib
 import optparse
+import array
+import struct
+import binascii
 import zipfile
 import tempfile
+import threading
+import Queue
 if sys.version_info[0] < 3:
     try:
         from cStringIO import StringIO as BytesIO
@@ -79,25 +127,99 @@ try:
 except ImportError:
     cx_bsdiff = None
 
+#  Whether the Differ should bsdiff files using the pure-python fallback
+#  when cx-bsdiff isn't available.  That works, but it's slow enough that
+#  you may prefer to just insert changed data instead.
+BSDIFF_FALLBACK = True
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    multiprocessing = None
+    ThreadPool = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 #  Default size of blocks to use when diffing a file.  4M seems reasonable.
 #  Setting this higher generates smaller patches at the cost of higher
 #  memory use (and bsdiff is a memory hog at the best of times...)
 DIFF_WINDOW_SIZE = 1024 * 1024 * 4
 
+#  Files at least this big are scanned for runs of data that have moved to
+#  a different offset, which are then copied directly from the source.
+BLOCK_MATCH_MIN_SIZE = 1024 * 64
+
+#  Files smaller than this are never diffed against the content of some other
+#  file in the source tree; a command referencing the other file's path
+#  would not be much smaller than just inserting the data.
+REUSE_MIN_SIZE = 128
+
+#  When solid compression is enabled, inserts of at most SOLID_MAX_INSERT
+#  bytes are gathered into a shared block and compressed together, since
+#  compressing them one at a time gets very little out of the codec.  A block
+#  is written once it holds SOLID_BLOCK_SIZE bytes, or once the commands
+#  waiting behind it take up SOLID_BUFFER_SIZE bytes.
+SOLID_MAX_INSERT = 1024 * 64
+SOLID_BLOCK_SIZE = 1024 * 1024 * 4
+SOLID_BUFFER_SIZE = 1024 * 1024 * 16
+
+#  Name of the temporary directory in which source items are stashed when
+#  they are to be reused for new target items.  A suffix is added if the
+#  name is already in use.
+REUSE_STASH_NAME = ".esky-patch-stash"
+
 #  Highest patch version that can be processed by this module.
-HIGHEST_VERSION = 1
+HIGHEST_VERSION = 2
 
 #  Header bytes included in the patch file
 PATCH_HEADER = "ESKYPTCH".encode("ascii")
 
+#  In a version 2 patch, the commands following the header are grouped into
+#  frames.  Each frame starts with a vint giving its kind and a bytestring
+#  giving the target path it covers, followed by its commands as a series
+#  of length-prefixed chunks terminated by an empty chunk.  Serial frames
+#  must be applied in order, while consecutive parallel frames touch
+#  disjoint parts of the target and can be applied concurrently.  A frame
+#  of kind FRAME_END is followed by an index of the frames, then the offset
+#  of the index as an 8-byte big-endian integer, then PATCH_INDEX_FOOTER.
+#  The index gives (kind,path,offset,size,digest) for each frame.
+FRAME_END = 0
+FRAME_SERIAL = 1
+FRAME_PARALLEL = 2
+PATCH_INDEX_FOOTER = "ESKYPIDX".encode("ascii")
+
+#  Flags for the PF_REC_ZIP_EXT command.  If ZIP_RELATIVE_OFFSETS is set,
+#  the offsets recorded in the zipfile are relative to the end of the data
+#  prepended to it rather than to the start of the file.
+ZIP_RELATIVE_OFFSETS = 1
+
+#  Bytes at which files are split into chunks for similarity detection.
+_NL = "\n".encode("ascii")
+_NUL = "\x00".encode("ascii")
+
 
 from esky.errors import Error
 from esky.util import extract_zipfile, create_zipfile, deep_extract_zipfile,\
                       zipfile_common_prefix_dir
 
 __all__ = ["PatchError","DiffError","main","write_patch","apply_patch",
-           "Differ","Patcher"]
+           "read_patch_index","Differ","Patcher","PatchStream","TreeSnapshot"]
 
 
 class PatchError(Error):
@@ -135,6 +257,18 @@ _COMMANDS = [
  "PF_BSDIFF4",    # PF_BSDIFF4(n,p):     patch file; bsdiff4 from n input bytes
  "PF_REC_ZIP",    # PF_REC_ZIP(m,cs):    patch file; recurse into zipfile
  "CHMOD",         # CHMOD(mode):         set mode of current target
+ "PF_COPY_AT",    # PF_COPY_AT(o,n):     patch file; copy n bytes from offset o
+ "PF_SEEK",       # PF_SEEK(o):          patch file; seek to input offset o
+ "PF_INS_ZLIB",   # PF_INS_ZLIB(bytes):  patch file; insert inflated bytes
+ "PF_INS_LZMA",   # PF_INS_LZMA(bytes):  patch file; insert unxz'd bytes
+ "PF_BSDIFF4_ZLIB",  # PF_BSDIFF4_ZLIB(n,p): PF_BSDIFF4 with zlib blocks
+ "PF_BSDIFF4_LZMA",  # PF_BSDIFF4_LZMA(n,p): PF_BSDIFF4 with lzma blocks
+ "PF_REC_ZIP_EXT",   # PF_REC_ZIP_EXT(f,p,m,cs): PF_REC_ZIP with prepended data
+ "PF_REC_COMPRESSED",  # PF_REC_COMPRESSED(f,l,p,cs): recurse into compressed file
+ "PF_REC_X86",    # PF_REC_X86(sr,tr,cs): recurse into x86 branch transform
+ "PF_REC_PYC",    # PF_REC_PYC(h,fn,cs): recurse into compiled python module
+ "SOLID_DATA",    # SOLID_DATA(c,bytes): add compressed data to solid stream
+ "PF_INS_SOLID",  # PF_INS_SOLID(n):     patch file; insert n solid data bytes
 ]
 
 # Make commands available as global variables
@@ -142,16 +276,465 @@ for i,cmd in enumerate(_COMMANDS):
     globals()[cmd] = i
 
 
+class _Codec(object):
+    """A compression scheme for inserted data and bsdiff payloads.
+
+    Each codec has a command for inserting compressed data, a command for
+    applying bsdiff patches whose blocks are compressed with it, and a rough
+    relative cost of decompressing each byte of output.  The costs are used
+    when the Differ is asked to favour decoding speed over patch size.
+    The 'decompressor' function creates an incremental decompressor, for
+    use when the Patcher is streaming data with bounded memory.
+    """
+
+    def __init__(self,name,ins_command,bsdiff_command,decode_cost,
+                 compress,decompress,decompressor):
+        self.name = name
+        self.ins_command = ins_command
+        self.bsdiff_command = bsdiff_command
+        self.decode_cost = decode_cost
+        self.compress = compress
+        self.decompress = decompress
+        self.decompressor = decompressor
+
+
+def _lzma_compress(data):
+    return lzma.compress(data,format=lzma.FORMAT_XZ)
+
+def _lzma_decompress(data):
+    if lzma is None:
+        raise PatchError("lzma support is not available")
+    return lzma.decompress(data)
+
+def _lzma_decompressor():
+    if lzma is None:
+        raise PatchError("lzma support is not available")
+    return lzma.LZMADecompressor()
+
+_CODECS = {
+  "bz2": _Codec("bz2",PF_INS_BZ2,PF_BSDIFF4,10,bz2.compress,bz2.decompress,
+                bz2.BZ2Decompressor),
+  "zlib": _Codec("zlib",PF_INS_ZLIB,PF_BSDIFF4_ZLIB,1,
+                 lambda data: zlib.compress(data,9),zlib.decompress,
+                 zlib.decompressobj),
+  "lzma": _Codec("lzma",PF_INS_LZMA,PF_BSDIFF4_LZMA,4,
+                 _lzma_compress,_lzma_decompress,_lzma_decompressor),
+}
+
+#  Codecs tried by default when generating a patch.  LZMA isn't included
+#  since it's not available to clients running older versions of python.
+DEFAULT_CODECS = ("bz2","zlib")
+
+#  Relative cost of applying a bsdiff patch, per byte of output.
+_BSDIFF_DECODE_COST = 2
+
+#  When optimising for decoding speed, options up to this much bigger than
+#  the smallest one are considered.
+DECODE_SPEED_SLACK = 1.25
+
+#  Levels of effort the Differ can put into encoding each window of data.
+#  At "best" every encoder is tried; at lower levels, sampling the data is
+#  used to skip those unlikely to produce the smallest result.
+EFFORT_LEVELS = ("fast","default","best")
+
+
+class _CompressedFormat(object):
+    """A single-file compression format whose contents can be diffed.
+
+    Files in these formats are decompressed and their contents diffed, then
+    the Patcher compresses the patched contents again.  This only works if
+    compression is deterministic, so the Differ must find a compression
+    level and any other parameters that recreate the target exactly.
+
+    The 'params' function is given the first few kilobytes of a compressed
+    file.  It returns None if they aren't in this format, or a tuple giving
+    the levels to try in order of likelihood and a bytestring of any other
+    parameters.  The 'decompress' and 'compress' functions stream data from
+    one file object to another, and 'errors' gives the exceptions raised
+    by 'decompress' for corrupt data.
+    """
+
+    def __init__(self,name,extensions,params,decompress,compress,errors):
+        self.name = name
+        self.extensions = extensions
+        self.params = params
+        self.decompress = decompress
+        self.compress = compress
+        self.errors = errors
+
+
+def _gzip_params(head):
+    """Find the compression parameters of a gzip file.
+
+    The parameters are the complete gzip header, which is reused verbatim.
+    """
+    if head[:3] != struct.pack("3B",0x1F,0x8B,8) or len(head) < 10:
+        return None
+    flags = ord(head[3:4])
+    if flags & 0xE0:
+        return None
+    i = 10
+    if flags & 0x04:
+        if len(head) < 12:
+            return None
+        i = 12 + struct.unpack("<H",head[10:12])[0]
+    for flag in (0x08,0x10):
+        if flags & flag:
+            i = head.find(_NUL,i) + 1
+            if i == 0:
+                return None
+    if flags & 0x02:
+        i += 2
+    if i > len(head):
+        return None
+    #  The XFL byte is meant to record whether the best or fastest compression
+    #  was used, but it's only a hint; python's gzip module sets it to 2
+    #  whatever the level.  So the hinted level is just tried first.
+    levels = [6,9,1,2,3,4,5,7,8,0]
+    hint = {2:9,4:1}.get(ord(head[8:9]))
+    if hint is not None:
+        levels.remove(hint)
+        levels.insert(0,hint)
+    return (levels,head[:i])
+
+
+def _gzip_decompress(fin,fout):
+    data = fin.read(1024*64)
+    params = _gzip_params(data)
+    if params is None:
+        raise PatchError("bad gzip header")
+    data = data[len(params[1]):]
+    d = zlib.decompressobj(-zlib.MAX_WBITS)
+    while data:
+        fout.write(d.decompress(data))
+        if d.unused_data:
+            break
+        data = fin.read(1024*64)
+    fout.write(d.flush())
+
+
+def _gzip_compress(fin,fout,level,params):
+    fout.write(params)
+    c = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS)
+    crc = zlib.crc32("".encode("ascii"))
+    size = 0
+    data = fin.read(1024*64)
+    while data:
+        crc = zlib.crc32(data,crc)
+        size += len(data)
+        fout.write(c.compress(data))
+        data = fin.read(1024*64)
+    fout.write(c.flush())
+    fout.write(struct.pack("<LL",crc & 0xFFFFFFFF,size & 0xFFFFFFFF))
+
+
+def _bz2_params(head):
+    """Find the compression parameters of a bz2 file.
+
+    The block size, and hence the compression level, is in the header.
+    """
+    if head[:3] != "BZh".encode("ascii") or len(head) < 4:
+        return None
+    level = ord(head[3:4]) - ord("0")
+    if not 1 <= level <= 9:
+        return None
+    return ([level],"".encode("ascii"))
+
+
+def _bz2_decompress(fin,fout):
+    d = bz2.BZ2Decompressor()
+    data = fin.read(1024*64)
+    while data:
+        try:
+            fout.write(d.decompress(data))
+        except EOFError:
+            break
+        if d.unused_data:
+            break
+        data = fin.read(1024*64)
+
+
+def _bz2_compress(fin,fout,level,params):
+    c = bz2.BZ2Compressor(level)
+    data = fin.read(1024*64)
+    while data:
+        fout.write(c.compress(data))
+        data = fin.read(1024*64)
+    fout.write(c.flush())
+
+
+def _xz_params(head):
+    """Find the compression parameters of an xz file.
+
+    The parameters are the integrity check type, from the stream header.
+    Levels 0-9 are the standard presets, and 10-19 the "extreme" ones.
+    Nothing in the header records the preset, and each one tried means
+    compressing the whole file again, so only the default preset and its
+    extreme variant are tried.  Files made with any other preset are just
+    diffed as binaries.
+    """
+    if head[:6] != struct.pack("6B",0xFD,0x37,0x7A,0x58,0x5A,0) or len(head) < 8:
+        return None
+    check = ord(head[7:8]) & 0x0F
+    return ([6,16],struct.pack("B",check))
+
+
+def _xz_decompress(fin,fout):
+    if lzma is None:
+        raise PatchError("lzma support is not available")
+    d = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    data = fin.read(1024*64)
+    while data and not d.eof:
+        fout.write(d.decompress(data))
+        data = fin.read(1024*64)
+
+
+def _xz_compress(fin,fout,level,params):
+    if lzma is None:
+        raise PatchError("lzma support is not available")
+    preset = level % 10
+    if level >= 10:
+        preset |= lzma.PRESET_EXTREME
+    c = lzma.LZMACompressor(format=lzma.FORMAT_XZ,check=ord(params),
+                            preset=preset)
+    data = fin.read(1024*64)
+    while data:
+        fout.write(c.compress(data))
+        data = fin.read(1024*64)
+    fout.write(c.flush())
+
+
+#  Formats that can be diffed by PF_REC_COMPRESSED, indexed by the number
+#  used to identify them in the patch.  New formats must go at the end.
+_COMPRESSED_FORMATS = [
+  _CompressedFormat("gzip",(".gz",".tgz"),_gzip_params,
+                    _gzip_decompress,_gzip_compress,(zlib.error,PatchError)),
+  _CompressedFormat("bz2",(".bz2",".tbz",".tbz2"),_bz2_params,
+                    _bz2_decompress,_bz2_compress,(EnvironmentError,ValueError)),
+  _CompressedFormat("xz",(".xz",".txz"),_xz_params,_xz_decompress,_xz_compress,
+                    (lzma.LZMAError,) if lzma is not None else ()),
+]
+
+
+#  Matches x86 CALL and JMP instructions with a 32-bit relative operand.
+_X86_BRANCH = re.compile("[\\xe8\\xe9]....".encode("ascii"),re.DOTALL)
+
+
+def _x86_code_ranges(path):
+    """Find the ranges of x86 machine code in an ELF file.
+
+    Returns a sorted list of (offset,size) tuples giving the parts of the
+    file holding executable sections, or None if it's not a little-endian
+    x86 or x86_64 ELF file.  If there are no section headers, executable
+    segments are used instead.
+    """
+    with open(path,"rb") as f:
+        header = f.read(64)
+        if header[:4] != "\x7fELF".encode("ascii") or len(header) < 52:
+            return None
+        (elfclass,order) = struct.unpack("BB",header[4:6])
+        if order != 1:
+            return None
+        try:
+            if elfclass == 1:
+                fields = struct.unpack("<HHIIIIIHHHHHH",header[16:52])
+                (shfmt,phfmt,machine) = ("<IIIIIIIIII","<IIIIIIII",3)
+            elif elfclass == 2 and len(header) >= 64:
+                fields = struct.unpack("<HHIQQQIHHHHHH",header[16:64])
+                (shfmt,phfmt,machine) = ("<IIQQQQIIQQ","<IIQQQQQQ",62)
+            else:
+                return None
+            if fields[1] != machine:
+                return None
+            (phoff,shoff) = fields[4:6]
+            (phentsize,phnum,shentsize,shnum) = fields[8:12]
+            ranges = []
+            if shnum and shentsize >= struct.calcsize(shfmt):
+                f.seek(shoff)
+                table = f.read(shnum * shentsize)
+                for i in xrange(shnum):
+                    sh = struct.unpack_from(shfmt,table,i * shentsize)
+                    (shtype,shflags,offset,size) = (sh[1],sh[2],sh[4],sh[5])
+                    #  SHF_EXECINSTR sections, other than SHT_NOBITS.
+                    if shflags & 0x04 and shtype != 8 and size:
+                        ranges.append((offset,size))
+            elif phnum and phentsize >= struct.calcsize(phfmt):
+                f.seek(phoff)
+                table = f.read(phnum * phentsize)
+                for i in xrange(phnum):
+                    ph = struct.unpack_from(phfmt,table,i * phentsize)
+                    if elfclass == 1:
+                        (phtype,offset,size,phflags) = (ph[0],ph[1],ph[4],ph[6])
+                    else:
+                        (phtype,phflags,offset,size) = (ph[0],ph[1],ph[2],ph[5])
+                    #  PT_LOAD segments with PF_X set.
+                    if phtype == 1 and phflags & 0x01 and size:
+                        ranges.append((offset,size))
+        except struct.error:
+            return None
+    filesize = os.path.getsize(path)
+    merged = []
+    for (offset,size) in sorted(ranges):
+        end = min(offset + size,filesize)
+        if merged and offset <= merged[-1][1]:
+            merged[-1] = (merged[-1][0],max(end,merged[-1][1]))
+        elif offset < end:
+            merged.append((offset,end))
+    if not merged:
+        return None
+    return [(start,end - start) for (start,end) in merged]
+
+
+def _x86_convert(data,offset,encode):
+    """Convert the operands of x86 CALL and JMP instructions in 'data'.
+
+    This is the "BCJ" filter used by xz.  When encoding, the relative target
+    of each branch is replaced by an absolute one, where 'offset' is the
+    position of the data in the file; when decoding, this is reversed.  Every
+    call to a given function then looks the same wherever it is, so shifting
+    code around changes far fewer bytes.  Only operands whose top byte is
+    0x00 or 0xFF are converted, and the converted value is kept to 25 bits,
+    so that the top byte is preserved and the conversion can be reversed
+    exactly.
+    """
+    out = bytearray(data)
+    for m in _X86_BRANCH.finditer(data):
+        i = m.start()
+        if out[i+4] not in (0x00,0xFF):
+            continue
+        addr = struct.unpack("<i",data[i+1:i+5])[0]
+        if encode:
+            addr += offset + i + 5
+        else:
+            addr -= offset + i + 5
+        addr &= 0x1FFFFFF
+        if addr & 0x1000000:
+            addr |= 0xFE000000
+        struct.pack_into("<I",out,i+1,addr)
+    return bytes(out)
+
+
+def _x86_transform_file(fin,fout,ranges,encode):
+    """Copy a file, converting x86 branches in the given ranges.
+
+    The data is streamed from file object 'fin' to 'fout', converting each
+    range of the file with _x86_convert().
+    """
+    pos = 0
+    for (offset,size) in ranges + [(None,None)]:
+        while offset is None or pos < offset:
+            n = 1024*64
+            if offset is not None:
+                n = min(n,offset - pos)
+            data = fin.read(n)
+            if not data:
+                break
+            fout.write(data)
+            pos += len(data)
+        if offset is None or pos != offset:
+            break
+        data = fin.read(size)
+        fout.write(_x86_convert(data,offset,encode))
+        pos += len(data)
+
+
+#  Extensions of compiled python modules, which are diffed by PF_REC_PYC.
+_PYC_EXTENSIONS = (".pyc",".pyo")
+
+#  Size of the header on compiled python modules: the magic number
+#  followed by the modification time of the source file.
+_PYC_HEADER_SIZE = len(imp.get_magic()) + 4
+
+
+def _pyc_set_filename(code,filename):
+    """Copy a code object, replacing the co_filename of it and its children."""
+    consts = []
+    for c in code.co_consts:
+        if isinstance(c,types.CodeType):
+            c = _pyc_set_filename(c,filename)
+        consts.append(c)
+    return types.CodeType(code.co_argcount,code.co_nlocals,code.co_stacksize,
+                          code.co_flags,code.co_code,tuple(consts),
+                          code.co_names,code.co_varnames,filename,
+                          code.co_name,code.co_firstlineno,code.co_lnotab,
+                          code.co_freevars,code.co_cellvars)
+
+
+def _pyc_split(data):
+    """Split a compiled python module into header, filename and body.
+
+    The body is the marshalled code object with the filename stripped
+    out, so that it doesn't change when only the module's source path or
+    timestamp does.  ValueError is raised if the data isn't a module
+    compiled by this version of python.
+    """
+    if data[:len(imp.get_magic())] != imp.get_magic():
+        raise ValueError("not a compiled python module")
+    try:
+        code = marshal.loads(data[_PYC_HEADER_SIZE:])
+    except (EOFError,TypeError):
+        raise ValueError("not a compiled python module")
+    if not isinstance(code,types.CodeType):
+        raise ValueError("not a compiled python module")
+    body = marshal.dumps(_pyc_set_filename(code,"".encode("ascii")))
+    return (data[:_PYC_HEADER_SIZE],code.co_filename,body)
+
+
+def _pyc_join(header,filename,body):
+    """Reassemble a compiled python module split by _pyc_split()."""
+    code = _pyc_set_filename(marshal.loads(body),filename)
+    return header + marshal.dumps(code)
+
+
 def apply_patch(target,stream,**kwds):
     """Apply patch commands from the given stream to the given target.
 
     'target' must be the path of a file or directory, and 'stream' an object
     supporting the read() method.  Patch protocol commands will be read from
     the stream and applied in sequence to the target.
+
+    If the keyword argument 'max_memory' is given, data is streamed through
+    in chunks so that applying each command uses roughly that much memory.
+    If the keyword argument 'workers' is greater than one, independent frames
+    of a version 2 patch are applied concurrently by that many threads.
     """
     Patcher(target,stream,**kwds).patch()
 
 
+def read_patch_index(stream):
+    """Read the index of frames from a version 2 patch.
+
+    'stream' must be a seekable file-like object containing the patch.  This
+    returns a list of tuples (kind,path,offset,size,digest), one per frame.
+    The offset and size of each frame are in bytes from the start of the
+    patch, and the digest is the expected MD5 digest of the target path once
+    the frame has been applied (or empty for frames covering the root).
+    """
+    stream.seek(-(8 + len(PATCH_INDEX_FOOTER)),2)
+    footer = stream.read(8 + len(PATCH_INDEX_FOOTER))
+    if footer[8:] != PATCH_INDEX_FOOTER:
+        raise PatchError("patch has no index")
+    stream.seek(struct.unpack(">Q",footer[:8])[0])
+    reader = _CommandReader(stream)
+    def read_bytes():
+        l = reader.read_vint()
+        data = reader.read(l)
+        if len(data) != l:
+            raise PatchError("corrupted patch index")
+        return data
+    index = []
+    try:
+        for _ in xrange(reader.read_vint()):
+            kind = reader.read_vint()
+            path = read_bytes().decode("utf8")
+            offset = reader.read_vint()
+            size = reader.read_vint()
+            index.append((kind,path,offset,size,read_bytes()))
+    except EOFError:
+        raise PatchError("corrupted patch index")
+    return index
+
+
 def write_patch(source,target,stream,**kwds):
     """Generate patch commands to transform source into target.
 
@@ -159,6 +742,28 @@ def write_patch(source,target,stream,**kwds):
     an object supporting the write() method.  Patch protocol commands to
     transform 'source' into 'target' will be generated and written sequentially
     to the stream.
+
+    If the keyword argument 'patch_version' is 2, a version 2 patch is
+    generated; see read_patch_index() for its extra features.
+
+    If the keyword argument 'workers' is greater than one, individual files
+    are diffed in a pool of that many worker processes, with the windows of
+    files bigger than two diff windows diffed in parallel.  The resulting
+    patch is identical to the one generated by a single process.
+
+    The keyword argument 'codecs' gives the names of the compression schemes
+    to try, and 'objective' says whether to favour the smallest patch
+    ("size", the default) or the fastest to decode ("speed").  The keyword
+    argument 'effort' is one of "fast", "default" or "best", and controls
+    how many encoders are tried for each window of data.
+
+    If the keyword argument 'transform_executables' is true, x86 and x86_64
+    ELF files have the branches in their machine code normalised before
+    they are diffed, which makes for smaller patches of rebuilt binaries.
+
+    If the keyword argument 'solid' is true, small inserts are gathered
+    into shared blocks and compressed together.  This makes for much
+    smaller patches when many small files have changed.
     """
     Differ(stream,**kwds).diff(source,target)
 
@@ -182,6 +787,294 @@ def _read_vint(stream):
     x += (b << e)
     return x
 
+class _CommandReader(object):
+    """Buffered reader for decoding the patch command stream.
+
+    Reading a vint one byte at a time from the underlying stream is slow,
+    so this reads the stream in large blocks and decodes from a buffer.
+    Big reads (e.g. of bsdiff payloads) bypass the buffer.
+    """
+
+    BUFFER_SIZE = 1024 * 64
+
+    def __init__(self,stream):
+        self.stream = stream
+        self._buffer = "".encode("ascii")
+        self._pos = 0
+
+    def _fill(self):
+        """Read another block from the stream into the buffer.
+
+        Returns False if the stream is exhausted.
+        """
+        data = self.stream.read(self.BUFFER_SIZE)
+        if not data:
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def read(self,size):
+        """Read up to 'size' bytes from the stream."""
+        pos = self._pos
+        end = pos + size
+        if end <= len(self._buffer):
+            self._pos = end
+            return self._buffer[pos:end]
+        data = self._buffer[pos:]
+        self._buffer = "".encode("ascii")
+        self._pos = 0
+        size -= len(data)
+        if size >= self.BUFFER_SIZE:
+            more = self.stream.read(size)
+            if more:
+                data += more
+            return data
+        self._fill()
+        return data + self.read(min(size,len(self._buffer)))
+
+    def read_vint(self):
+        """Read a vint-encoded integer from the stream."""
+        pos = self._pos
+        x = _SMALL_VINTS.get(self._buffer[pos:pos+1])
+        if x is not None:
+            self._pos = pos + 1
+            return x
+        x = e = 0
+        while True:
+            b = self.read(1)
+            if not b:
+                raise EOFError
+            b = ord(b)
+            if b < 128:
+                return x + (b << e)
+            x += (b - 128) << e
+            e += 7
+
+class _CommandWriter(object):
+    """Buffered writer for the patch command stream.
+
+    Commands are accumulated in a bytearray and written to the underlying
+    stream in large chunks; call flush() to write out the remainder.  The
+    writer also counts the bytes written for each type of command.
+
+    If no stream is given, the data is kept in memory.  The Differ uses
+    such writers for segments of output that may be discarded or written
+    out of order; their contents are added to another writer by passing
+    the result of parts() to its write_parts() method.
+
+    Data for PF_INS_SOLID commands is added with write_solid().  When the
+    writer is flushed, it's compressed with the best of 'solid_codecs' and
+    written in a SOLID_DATA command, placed ahead of the first command that
+    uses it.
+    """
+
+    FLUSH_SIZE = 1024 * 64
+
+    def __init__(self,stream=None,solid_codecs=()):
+        self.stream = stream
+        self.solid_codecs = solid_codecs
+        self.stats = {}
+        self.index = []
+        self._buffer = bytearray()
+        self._command = "HEADER"
+        self._frame = None
+        self._written = 0
+        self._solid = []
+        self._solid_at = None
+        self._solid_size = 0
+        self._solid_cost = 0
+
+    def __len__(self):
+        return len(self._buffer) + self._solid_cost
+
+    def write(self,data):
+        self._buffer.extend(data)
+        self._count(len(data))
+
+    def write_vint(self,x):
+        buf = self._buffer
+        n = len(buf)
+        while x >= 128:
+            buf.append((x & 127) | 128)
+            x = x >> 7
+        buf.append(x)
+        self._count(len(buf) - n)
+
+    def write_command(self,cmd):
+        self._command = _COMMANDS[cmd]
+        self.write_vint(cmd)
+
+    def _count(self,n):
+        try:
+            self.stats[self._command] += n
+        except KeyError:
+            self.stats[self._command] = n
+        if self.stream is not None and len(self._buffer) >= self.FLUSH_SIZE:
+            self._check_flush()
+
+    def _check_flush(self):
+        """Flush the buffered data, unless it's waiting for more solid data.
+
+        Commands are held back for a while when there's solid data pending,
+        so that there's more of it to compress together.
+        """
+        if self._solid_size >= SOLID_BLOCK_SIZE:
+            self.flush()
+        elif not self._solid or len(self._buffer) >= SOLID_BUFFER_SIZE:
+            self.flush()
+
+    def write_solid(self,data,cost):
+        """Add data for a PF_INS_SOLID command to the solid block.
+
+        This must be called between commands, before writing the command
+        that uses the data.  The 'cost' is an estimate of the size of the
+        data once compressed, which is included in len(self).
+        """
+        if not self._solid:
+            self._solid_at = len(self._buffer)
+        self._solid.append(data)
+        self._solid_size += len(data)
+        self._solid_cost += cost
+        if self.stream is not None and self._solid_size >= SOLID_BLOCK_SIZE:
+            self.flush()
+
+    def parts(self):
+        """Get a picklable tuple (data,stats,command,solid) for the output.
+
+        The third item is the command being written when the output ended,
+        to which any further arguments will belong.  The final item gives
+        the offset at which the output's solid data must be placed, the
+        pieces of solid data and their estimated cost.
+        """
+        solid = (self._solid_at,self._solid,self._solid_cost)
+        return (bytes(self._buffer),self.stats,self._command,solid)
+
+    def write_parts(self,data,stats,command,solid):
+        """Add output described by the parts() of another writer."""
+        (solid_at,pieces,cost) = solid
+        if pieces:
+            if not self._solid:
+                self._solid_at = len(self._buffer) + solid_at
+            self._solid.extend(pieces)
+            self._solid_size += sum(len(p) for p in pieces)
+            self._solid_cost += cost
+        self._buffer.extend(data)
+        for (nm,n) in stats.iteritems():
+            self.stats[nm] = self.stats.get(nm,0) + n
+        self._command = command
+        if self.stream is not None and len(self._buffer) >= self.FLUSH_SIZE:
+            self._check_flush()
+        elif self.stream is not None and self._solid_size >= SOLID_BLOCK_SIZE:
+            self.flush()
+
+    def _write_solid_block(self):
+        """Put the pending solid data into the buffer, in a SOLID_DATA command.
+
+        The data is compressed with each of self.solid_codecs, and the
+        smallest result is used.
+        """
+        data = "".encode("ascii").join(self._solid)
+        best = None
+        for nm in self.solid_codecs:
+            codec = _CODECS[nm]
+            cdata = codec.compress(data)
+            if best is None or len(cdata) < len(best[1]):
+                best = (codec,cdata)
+        if best is None:
+            raise DiffError("no codecs available for solid data")
+        (codec,cdata) = best
+        block = _encode_vint(SOLID_DATA) + _encode_vint(codec.ins_command)
+        block += _encode_vint(len(cdata)) + cdata
+        self._buffer[self._solid_at:self._solid_at] = block
+        self.stats["SOLID_DATA"] = self.stats.get("SOLID_DATA",0) + len(block)
+        self._solid = []
+        self._solid_at = None
+        self._solid_size = 0
+        self._solid_cost = 0
+
+    def flush(self):
+        """Write any buffered data to the underlying stream.
+
+        Inside a frame, the data is written as a length-prefixed chunk.
+        Any pending solid data is written along with it.
+        """
+        if self.stream is not None and self._solid:
+            self._write_solid_block()
+        if self.stream is not None and self._buffer:
+            if self._frame is not None:
+                self._write_raw(_encode_vint(len(self._buffer)),"FRAMING")
+            self.stream.write(bytes(self._buffer))
+            self._written += len(self._buffer)
+            del self._buffer[:]
+
+    def begin_frame(self,kind,path,digest="".encode("ascii")):
+        """Start a new frame of a version 2 patch.
+
+        Any current frame is finished, and an entry for the new one added to
+        self.index.  Frames can only be written to a writer with a stream.
+        """
+        assert self.stream is not None
+        self._end_frame()
+        self.flush()
+        path = path.encode("utf8")
+        self._frame = [kind,path,self._written,0,digest]
+        self.index.append(self._frame)
+        header = _encode_vint(kind) + _encode_vint(len(path)) + path
+        self._write_raw(header,"FRAMING")
+
+    def _end_frame(self):
+        """Finish the current frame, if there is one."""
+        if self._frame is not None:
+            self.flush()
+            self._write_raw(_encode_vint(0),"FRAMING")
+            self._frame[3] = self._written - self._frame[2]
+            self._frame = None
+
+    def finish_frames(self):
+        """Finish the last frame, and write the index of frames."""
+        self._end_frame()
+        self.flush()
+        self._write_raw(_encode_vint(FRAME_END),"FRAMING")
+        offset = self._written
+        index = [_encode_vint(len(self.index))]
+        for (kind,path,foffset,size,digest) in self.index:
+            index.append(_encode_vint(kind))
+            index.append(_encode_vint(len(path)))
+            index.append(path)
+            index.append(_encode_vint(foffset))
+            index.append(_encode_vint(size))
+            index.append(_encode_vint(len(digest)))
+            index.append(digest)
+        index.append(struct.pack(">Q",offset))
+        index.append(PATCH_INDEX_FOOTER)
+        self._write_raw("".encode("ascii").join(index),"INDEX")
+
+    def _write_raw(self,data,name):
+        """Write data directly to the stream, counting it under 'name'."""
+        self.stream.write(data)
+        self._written += len(data)
+        self.stats[name] = self.stats.get(name,0) + len(data)
+
+    def getvalue(self):
+        """Get the buffered data, for writers without a stream."""
+        return bytes(self._buffer)
+
+
+#  Single-byte vints, mapped to their values.
+_SMALL_VINTS = dict((bytes(bytearray([i])),i) for i in xrange(128))
+
+
+def _encode_vint(x):
+    """Get the vint encoding of the given integer, as a bytestring."""
+    buf = bytearray()
+    while x >= 128:
+        buf.append((x & 127) | 128)
+        x = x >> 7
+    buf.append(x)
+    return bytes(buf)
+
+
 if sys.version_info[0] > 2:
     def _write_vint(stream,x):
         """Write a vint-encoded integer to the given stream."""
@@ -213,66 +1106,379 @@ def _write_zipfile_metadata(stream,zfin):
 
     For simplicity, the metadata is represented as a zipfile with the same
     members as the given zipfile, but where they all have zero length.
+    The ZipInfo objects of the given zipfile are left untouched.  Any zip64
+    extra fields are dropped, since zipfile adds them itself when needed.
     """
     zfout = zipfile.ZipFile(stream,"w")
     try:
         for zinfo in zfin.infolist():
+            zinfo = copy.copy(zinfo)
+            zinfo.extra = _strip_zip64_extra(zinfo.extra)
             zfout.writestr(zinfo,"")
+        zfout.comment = zfin.comment
     finally:
         zfout.close()
 
 
-def paths_differ(path1,path2):
-    """Check whether two paths differ."""
-    if os.path.isdir(path1):
-        if not os.path.isdir(path2):
-            return True
-        for nm in os.listdir(path1):
-            if paths_differ(os.path.join(path1,nm),os.path.join(path2,nm)):
+def _strip_zip64_extra(extra):
+    """Remove any zip64 fields from the extra data of a zipfile member."""
+    fields = []
+    i = 0
+    while i + 4 <= len(extra):
+        (tp,ln) = struct.unpack("<HH",extra[i:i+4])
+        if tp != 1:
+            fields.append(extra[i:i+4+ln])
+        i += 4 + ln
+    fields.append(extra[i:])
+    return "".encode("ascii").join(fields)
+
+
+def _zipfile_preamble_size(zf):
+    """Get the size of any data prepended to the given zipfile."""
+    return min(zinfo.header_offset for zinfo in zf.infolist())
+
+
+def _copy_zipfile_preamble(path,zf,dest):
+    """Copy any data prepended to the given zipfile into the file 'dest'."""
+    size = _zipfile_preamble_size(zf)
+    with open(path,"rb") as fin:
+        with open(dest,"wb") as fout:
+            while size > 0:
+                data = fin.read(min(size,1024*64))
+                if not data:
+                    raise EOFError("truncated zipfile")
+                fout.write(data)
+                size -= len(data)
+
+
+def _zipfile_layout(path,zf):
+    """Work out how to recreate the layout of the given zipfile.
+
+    This returns a tuple (extended,flags).  If 'extended' is false, the
+    zipfile can be recreated by the PF_REC_ZIP command; otherwise it has
+    prepended data, a comment or zip64 extensions, and PF_REC_ZIP_EXT must
+    be used with the given flags.  If the zipfile records offsets that are
+    relative to neither the start of the file nor the end of the prepended
+    data, None is returned.
+    """
+    with open(path,"rb") as f:
+        endrec = zipfile._EndRecData(f)
+    if endrec is None:
+        return None
+    preamble = _zipfile_preamble_size(zf)
+    base = zf.start_dir - endrec[zipfile._ECD_OFFSET]
+    if base == 0:
+        flags = 0
+    elif base == preamble:
+        flags = ZIP_RELATIVE_OFFSETS
+    else:
+        return None
+    extended = preamble != 0 or bool(zf.comment)
+    if endrec[zipfile._ECD_SIGNATURE] == zipfile.stringEndArchive64:
+        extended = True
+    for zinfo in zf.infolist():
+        if _strip_zip64_extra(zinfo.extra) != zinfo.extra:
+            extended = True
+    return (extended,flags)
+
+
+def _changed_zipfile_members(s_zf,t_zf):
+    """Find the names of zipfile members that need to be diffed.
+
+    Members with the same name, CRC, size and compression in both zipfiles
+    are taken to be unchanged, and can be left out of the diff entirely;
+    the Patcher will simply leave them where they are.  This returns the set
+    of all other member names, plus any unchanged members that might be
+    reused as the base for a changed one: those with the same contents or
+    the same basename as a changed member, and those sharing a module name
+    with a changed .py file, so that its .pyc isn't cleaned up.
+    """
+    def key(zinfo):
+        return (zinfo.CRC,zinfo.file_size,zinfo.compress_size,
+                zinfo.compress_type)
+    s_infos = {}
+    for zinfo in s_zf.infolist():
+        if not zinfo.filename.endswith("/"):
+            s_infos[zinfo.filename] = zinfo
+    t_infos = {}
+    for zinfo in t_zf.infolist():
+        if not zinfo.filename.endswith("/"):
+            t_infos[zinfo.filename] = zinfo
+    names = set()
+    unchanged = set()
+    for (nm,zinfo) in s_infos.iteritems():
+        if nm not in t_infos:
+            names.add(nm)
+    for (nm,zinfo) in t_infos.iteritems():
+        s_zinfo = s_infos.get(nm)
+        if s_zinfo is not None and key(s_zinfo) == key(zinfo):
+            unchanged.add(nm)
+        else:
+            names.add(nm)
+    if not names or not unchanged:
+        return names | unchanged
+    t_keys = set()
+    t_basenames = set()
+    t_modules = set()
+    for nm in names:
+        if nm in t_infos:
+            t_keys.add(key(t_infos[nm]))
+            t_basenames.add(posixpath.basename(nm))
+            if nm.endswith(".py"):
+                t_modules.add(nm)
+    for nm in unchanged:
+        if key(t_infos[nm]) in t_keys:
+            names.add(nm)
+        elif posixpath.basename(nm) in t_basenames:
+            names.add(nm)
+        elif nm[-4:] in (".pyc",".pyo") and nm[:-1] in t_modules:
+            names.add(nm)
+    return names
+
+
+def _extract_zipfile_members(path,zf,root,names):
+    """Extract the named members of a zipfile into a directory.
+
+    The directories containing all the other members are also created,
+    so that the tree has the same shape as if the whole zipfile had been
+    extracted by extract_zipfile().
+    """
+    os.makedirs(root)
+    for zinfo in zf.infolist():
+        if zinfo.filename.endswith("/"):
+            continue
+        dirnm = os.path.dirname(os.path.join(root,*zinfo.filename.split("/")))
+        if not os.path.isdir(dirnm):
+            os.makedirs(dirnm)
+    def name_filter(nm):
+        if nm in names:
+            return nm
+        return None
+    extract_zipfile(path,root,name_filter)
+
+
+def paths_differ(path1,path2,snapshot=None):
+    """Check whether two paths differ.
+
+    If given, 'snapshot' is a TreeSnapshot used to look up metadata and
+    cache the results, so that repeated comparisons don't hit the disk.
+    """
+    if snapshot is None:
+        snapshot = TreeSnapshot()
+    return snapshot.paths_differ(path1,path2)
+
+
+def calculate_digest(target,hash=hashlib.md5,snapshot=None):
+    """Calculate the digest of the given path.
+
+    If the target is a file, its digest is calculated as normal.  If it is
+    a directory, it is calculated from the names and digests of its contents.
+    If given, 'snapshot' is a TreeSnapshot used to cache the digests.
+    """
+    if snapshot is None:
+        snapshot = TreeSnapshot()
+    return snapshot.digest(target,hash)
+
+
+class TreeSnapshot(object):
+    """Snapshot of the metadata and content digests of directory trees.
+
+    Each directory is scanned once, the first time something inside it is
+    queried, recording the mode, size and mtime of each entry; os.scandir
+    (or the scandir module) is used for this if available.  Content digests
+    are calculated lazily and cached, and comparing two identical files
+    calculates their digests at the same time.  So no matter how many times
+    an item is compared or digested, identical files are only read once.
+
+    The snapshot assumes that the trees don't change while it's in use;
+    call forget() to discard the cached information for a path.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._listings = {}
+        self._digests = {}
+        self._differ = {}
+
+    def _scan(self,path):
+        """Scan the given directory, caching stat info for its entries."""
+        try:
+            return self._listings[path]
+        except KeyError:
+            pass
+        names = []
+        if scandir is not None:
+            for entry in scandir(path):
+                names.append(entry.name)
+                try:
+                    st = entry.stat()
+                except EnvironmentError:
+                    st = None
+                self._stats[os.path.join(path,entry.name)] = st
+        else:
+            for nm in os.listdir(path):
+                names.append(nm)
+                try:
+                    st = os.stat(os.path.join(path,nm))
+                except EnvironmentError:
+                    st = None
+                self._stats[os.path.join(path,nm)] = st
+        self._listings[path] = names
+        return names
+
+    def stat(self,path):
+        """Get the stat info for the given path, or None if it doesn't exist.
+
+        If the path's parent directory is known, the whole directory is
+        scanned; otherwise the path itself is stat'ed.
+        """
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+        parent = os.path.dirname(path)
+        if parent != path and parent not in self._listings:
+            pst = self._stats.get(parent)
+            if pst is not None and stat.S_ISDIR(pst.st_mode):
+                self._scan(parent)
+                if path in self._stats:
+                    return self._stats[path]
+        try:
+            st = os.stat(path)
+        except EnvironmentError:
+            st = None
+        self._stats[path] = st
+        return st
+
+    def exists(self,path):
+        return self.stat(path) is not None
+
+    def isdir(self,path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def isfile(self,path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def getsize(self,path):
+        st = self.stat(path)
+        if st is None:
+            raise OSError("no such file: " + path)
+        return st.st_size
+
+    def listdir(self,path):
+        """List the given directory, in the same order as os.listdir()."""
+        return list(self._scan(path))
+
+    def walk(self,root):
+        """Walk the tree at the given root, in the style of os.walk()."""
+        dirnames = []
+        filenames = []
+        for nm in self._scan(root):
+            if self.isdir(os.path.join(root,nm)):
+                dirnames.append(nm)
+            else:
+                filenames.append(nm)
+        yield (root,dirnames,filenames)
+        for nm in dirnames:
+            for item in self.walk(os.path.join(root,nm)):
+                yield item
+
+    def forget(self,path):
+        """Discard all cached information about the given path."""
+        prefix = os.path.join(path,"")
+        for cache in (self._stats,self._listings,self._digests):
+            for p in list(cache):
+                if p == path or p.startswith(prefix):
+                    del cache[p]
+        for key in list(self._differ):
+            for p in key:
+                if p == path or p.startswith(prefix):
+                    del self._differ[key]
+                    break
+
+    def digest(self,path,hash=hashlib.md5):
+        """Calculate the digest of the given path.
+
+        This has the same semantics as calculate_digest().  Only digests
+        using the default hash function are cached.
+        """
+        if hash is hashlib.md5:
+            try:
+                return self._digests[path]
+            except KeyError:
+                pass
+        d = hash()
+        if self.isdir(path):
+            for nm in sorted(self.listdir(path)):
+                d.update(nm.encode("utf8"))
+                d.update(self.digest(os.path.join(path,nm)))
+        else:
+            with open(path,"rb") as f:
+                data = f.read(1024*64)
+                while data:
+                    d.update(data)
+                    data = f.read(1024*64)
+        digest = d.digest()
+        if hash is hashlib.md5:
+            self._digests[path] = digest
+        return digest
+
+    def paths_differ(self,path1,path2):
+        """Check whether two paths differ, caching the result."""
+        key = (path1,path2)
+        try:
+            return self._differ[key]
+        except KeyError:
+            pass
+        differ = self._paths_differ(path1,path2)
+        self._differ[key] = differ
+        return differ
+
+    def _paths_differ(self,path1,path2):
+        if self.isdir(path1):
+            if not self.isdir(path2):
                 return True
-        for nm in os.listdir(path2):
-            if not os.path.exists(os.path.join(path1,nm)):
+            for nm in self.listdir(path1):
+                if self.paths_differ(os.path.join(path1,nm),
+                                     os.path.join(path2,nm)):
+                    return True
+            for nm in self.listdir(path2):
+                if not self.exists(os.path.join(path1,nm)):
+                    return True
+        elif self.isfile(path1):
+            if not self.isfile(path2):
                 return True
-    elif os.path.isfile(path1):
-        if not os.path.isfile(path2):
-            return True
-        if os.stat(path1).st_size != os.stat(path2).st_size:
+            if self.getsize(path1) != self.getsize(path2):
+                return True
+            if path1 in self._digests and path2 in self._digests:
+                return self._digests[path1] != self._digests[path2]
+            return self._files_differ(path1,path2)
+        elif self.exists(path2):
             return True
+        return False
+
+    def _files_differ(self,path1,path2):
+        """Compare the contents of two files of the same size.
+
+        If they turn out to be identical, their digest is cached.
+        """
+        d = hashlib.md5()
         with open(path1,"rb") as f1:
             with open(path2,"rb") as f2:
-                data1 = f1.read(1024*16)
-                data2 = f2.read(1024*16)
+                data1 = f1.read(1024*64)
+                data2 = f2.read(1024*64)
                 while data1:
                     if data1 != data2:
                         return True
-                    data1 = f1.read(1024*16)
-                    data2 = f2.read(1024*16)
+                    d.update(data1)
+                    data1 = f1.read(1024*64)
+                    data2 = f2.read(1024*64)
                 if data1 != data2:
                     return True
-    elif os.path.exists(path2):
-        return True
-    return False
-
-    
-
-def calculate_digest(target,hash=hashlib.md5):
-    """Calculate the digest of the given path.
-
-    If the target is a file, its digest is calculated as normal.  If it is
-    a directory, it is calculated from the names and digests of its contents.
-    """
-    d = hash()
-    if os.path.isdir(target):
-        for nm in sorted(os.listdir(target)):
-            d.update(nm.encode("utf8"))
-            d.update(calculate_digest(os.path.join(target,nm)))
-    else:
-        with open(target,"rb") as f:
-            data = f.read(1024*16)
-            while data:
-                d.update(data)
-                data = f.read(1024*16)
-    return d.digest()
+        self._digests[path1] = self._digests[path2] = d.digest()
+        return False
 
 
 class Patcher(object):
@@ -281,19 +1487,48 @@ class Patcher(object):
     Instances of this class can be used to apply a sequence of patch commands
     to a target file or directory.  You can think of it as a little automaton
     that edits a directory in-situ.
+
+    If 'max_memory' is given, the Patcher streams data through in chunks
+    rather than loading whole bytestrings into memory, so that the memory
+    used to apply each command is roughly bounded by that many bytes.
+    Compressed data is decompressed incrementally and bsdiff patches are
+    applied piece by piece, spooling parts of the patch to temp files.
+
+    If 'workers' is greater than one, the work is spread over a pool of that
+    many threads.  For a version 2 patch, consecutive parallel frames are
+    applied concurrently, each being read into memory before it is handed
+    to the pool.  For a version 1 patch, the commands are decoded in-process
+    but the file-level work of each file patch (copying, decompressing and
+    applying bsdiff patches) is deferred to the pool; commands that change
+    the directory structure wait for any pending jobs on the paths they
+    touch.  This isn't done when streaming with 'max_memory'.
     """
 
-    def __init__(self,target,commands,dry_run=False):
+    def __init__(self,target,commands,dry_run=False,max_memory=None,
+                 workers=None):
         target = os.path.abspath(target)
         self.target = target
         self.new_target = None
-        self.commands = commands
+        self.commands = _CommandReader(commands)
         self.root_dir = self.target
         self.infile = None
         self.outfile = None
         self.dry_run = dry_run
+        self.max_memory = max_memory
+        self.workers = workers
+        if max_memory is None:
+            self._chunk_size = 1024 * 1024 * 16
+        else:
+            self._chunk_size = max(max_memory // 8,1024 * 4)
         self._workdir = tempfile.mkdtemp()
         self._context_stack = []
+        self._pool = None
+        self._job = None
+        self._jobs = []
+        self._lazy_zips = []
+        self._solid_blocks = []
+        self._solid = iter(())
+        self._solid_buf = "".encode("ascii")
 
     def __del__(self):
         if self.infile:
@@ -309,21 +1544,21 @@ class Patcher(object):
 
     def _read_int(self):
         """Read an integer from the command stream."""
-        i = _read_vint(self.commands)
+        i = self.commands.read_vint()
         if self.dry_run:
             print "  ", i
         return i
 
     def _read_command(self):
         """Read the next command to be processed."""
-        cmd = _read_vint(self.commands)
+        cmd = self.commands.read_vint()
         if self.dry_run:
             print _COMMANDS[cmd]
         return cmd
 
     def _read_bytes(self):
         """Read a bytestring from the command stream."""
-        l = _read_vint(self.commands)
+        l = self.commands.read_vint()
         bytes = self.commands.read(l)
         if len(bytes) != l:
             raise PatchError("corrupted bytestring")
@@ -331,9 +1566,26 @@ class Patcher(object):
             print "  [%s bytes]" % (len(bytes),)
         return bytes
 
+    def _read_bytes_chunks(self):
+        """Read a bytestring from the command stream, in chunks.
+
+        This is a generator yielding the bytestring in pieces of at most
+        self._chunk_size bytes.  It must be exhausted before anything else
+        is read from the command stream.
+        """
+        l = self.commands.read_vint()
+        if self.dry_run:
+            print "  [%s bytes]" % (l,)
+        while l > 0:
+            chunk = self.commands.read(min(l,self._chunk_size))
+            if not chunk:
+                raise PatchError("corrupted bytestring")
+            l -= len(chunk)
+            yield chunk
+
     def _read_path(self):
         """Read a unicode path from the given stream."""
-        l = _read_vint(self.commands)
+        l = self.commands.read_vint()
         bytes = self.commands.read(l)
         if len(bytes) != l:
             raise PatchError("corrupted path")
@@ -342,39 +1594,130 @@ class Patcher(object):
             print "  ", path
         return path
 
-    def _check_begin_patch(self):
+    def _read_source_path(self):
+        """Read the source path for a COPY_FROM or MOVE_FROM command.
+
+        The path is interpreted relative to the directory containing the
+        current target, and may use ".." to refer to items elsewhere in
+        the tree; it's normalised and checked against the root directory.
+        """
+        path = os.path.join(os.path.dirname(self.target),self._read_path())
+        path = os.path.normpath(path)
+        self._check_path(path)
+        return path
+
+    def _check_begin_patch(self,defer=True):
         """Begin patching the current file, if not already.
 
         This method is called by all file-patching commands; if there is
         no file open for patching then the current target is opened.
+
+        If we have a pool of workers, the file is instead patched by a job
+        that records the file-level operations and is run by the pool once
+        the file is finished.  Pass defer=False to ensure the file is open
+        in-process; any operations already recorded are then replayed.
         """
-        if not self.outfile and not self.dry_run:
-            if os.path.exists(self.target) and not os.path.isfile(self.target):
-                shutil.rmtree(self.target)
-            self.new_target = self.target + ".new"
-            while os.path.exists(self.new_target):
-                self.new_target += ".new"
-            if os.path.exists(self.target):
-                self.infile = open(self.target,"rb")
-            else:
-                self.infile = BytesIO("".encode("ascii"))
-            self.outfile = open(self.new_target,"wb")
+        if self.outfile or self.dry_run:
+            return
+        if self._job is not None:
+            if not defer:
+                job = self._job
+                self._job = None
+                self._open_target()
+                for (op,args) in job.ops:
+                    op(self,*args)
+            return
+        self._extract_lazy(self.target)
+        if defer and self._pool is not None:
+            self._wait_for_jobs(self.target)
+            self._job = _FilePatchJob(self.target,self._chunk_size)
+            return
+        self._open_target()
+
+    def _file_op(self,op,*args):
+        """Perform a file-level operation on the file being patched.
+
+        If the file is being patched by a job, the operation is recorded
+        to be performed by the job.
+        """
+        if self._job is None:
+            op(self,*args)
+        else:
+            self._job.ops.append((op,args))
+
+    def _open_target(self):
+        """Open the current target for patching."""
+        if os.path.exists(self.target) and not os.path.isfile(self.target):
+            shutil.rmtree(self.target)
+        self.new_target = self.target + ".new"
+        while os.path.exists(self.new_target):
+            self.new_target += ".new"
+        if os.path.exists(self.target):
+            self.infile = open(self.target,"rb")
+        else:
+            self.infile = BytesIO("".encode("ascii"))
+        self.outfile = open(self.new_target,"wb")
 
     def _check_end_patch(self):
         """Finish patching the current file, if there is one.
 
         This method is called by all non-file-patching commands; if there is
-        a file open for patching then it is closed and committed.
+        a file open for patching then it is closed and committed.  If it's
+        being patched by a job, the job is handed to the pool.
         """
-        if self.outfile and not self.dry_run:
-            self.infile.close()
-            self.infile = None
-            self.outfile.close()
-            self.outfile = None
-            if os.path.exists(self.target):
-               os.unlink(self.target)
-            os.rename(self.new_target,self.target)
-            self.new_target = None
+        if self._job is not None:
+            job = self._job
+            self._job = None
+            self._jobs.append((job.target,self._pool.apply_async(job.run)))
+            if len(self._jobs) > self.workers * 4:
+                self._jobs.pop(0)[1].get()
+        elif self.outfile and not self.dry_run:
+            self._commit_target()
+
+    def _wait_for_jobs(self,*paths):
+        """Wait for pending jobs patching any of the given paths.
+
+        A job is waited for if its target is one of the paths, or is inside
+        or contains one of them.  If no paths are given, all jobs are waited
+        for.  Any error raised by a job is re-raised.
+        """
+        if not self._jobs:
+            return
+        pending = []
+        for (target,job) in self._jobs:
+            if paths and not _paths_overlap(target,paths):
+                pending.append((target,job))
+            else:
+                job.get()
+        self._jobs = pending
+
+    def _extract_lazy(self,*paths):
+        """Extract any zipfile members at the given paths not yet on disk.
+
+        This is called before a command reads or modifies anything at the
+        paths; see _LazyZipContents.
+        """
+        for contents in self._lazy_zips:
+            contents.extract(*paths)
+
+    def _discard_lazy(self,*paths):
+        """Forget any zipfile members at the given paths not yet on disk.
+
+        This is called before a command replaces whatever is at the paths.
+        """
+        for contents in self._lazy_zips:
+            contents.discard(*paths)
+
+    def _commit_target(self):
+        """Close the current target and replace it with the patched file."""
+        self.infile.close()
+        self.infile = None
+        self.outfile.close()
+        self.outfile = None
+        if os.path.exists(self.target):
+           os.unlink(self.target)
+        os.rename(self.new_target,self.target)
+        self.new_target = None
 
     def _check_path(self,path=None):
         """Check that we're not traversing outside the root."""
@@ -406,9 +1749,8 @@ class Patcher(object):
     def patch(self):
         """Interpret and apply patch commands to the target.
 
-        This is a simple command loop that dispatches to the _do_<CMD>
-        methods defined below.  It keeps processing until one of them
-        raises EOFError.
+        This checks the patch header, then applies the commands that follow
+        it; for a version 2 patch, frame by frame.
         """
         header = self._read(len(PATCH_HEADER))
         if header != PATCH_HEADER:
@@ -416,13 +1758,134 @@ class Patcher(object):
         version = self._read_int()
         if version > HIGHEST_VERSION:
             raise PatchError("esky patch version %d not supported"%(version,))
+        if version >= 2:
+            self._patch_frames()
+        elif self._can_use_pool():
+            self._pool = ThreadPool(self.workers)
+            try:
+                self._patch_commands()
+                self._wait_for_jobs()
+            finally:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+                self._jobs = []
+        else:
+            self._patch_commands()
+
+    def _can_use_pool(self):
+        """Check whether work can be spread over a pool of threads."""
+        if not self.workers or self.workers < 2 or ThreadPool is None:
+            return False
+        return not self.dry_run and self.max_memory is None
+    def _patch_frames(self):
+        """Apply the frames of a version 2 patch.
+
+        Serial frames are applied in order, once all preceding frames are
+        done.  If we have workers, runs of parallel frames are handed to a
+        thread pool, with a bounded number of frames waiting in memory.
+        """
+        pool = None
+        if self._can_use_pool():
+            pool = ThreadPool(self.workers)
+        pending = []
+        try:
+            while True:
+                try:
+                    kind = self.commands.read_vint()
+                    path = self.commands.read(self.commands.read_vint())
+                except EOFError:
+                    raise PatchError("truncated patch")
+                if kind == FRAME_END:
+                    break
+                if kind not in (FRAME_SERIAL,FRAME_PARALLEL):
+                    raise PatchError("unknown frame kind: %d" % (kind,))
+                if self.dry_run:
+                    print "FRAME", kind, path.decode("utf8")
+                if kind == FRAME_PARALLEL and pool is not None:
+                    chunks = list(self._read_frame_chunks())
+                    job = pool.apply_async(self._patch_frame,(chunks,))
+                    pending.append(job)
+                    while len(pending) > self.workers * 2:
+                        pending.pop(0).get()
+                else:
+                    while pending:
+                        pending.pop(0).get()
+                    self._patch_frame(self._read_frame_chunks())
+            while pending:
+                pending.pop(0).get()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _read_frame_chunks(self):
+        """Iterate over the chunks of commands making up the current frame."""
+        while True:
+            try:
+                size = self.commands.read_vint()
+            except EOFError:
+                raise PatchError("truncated frame")
+            if size == 0:
+                break
+            data = self.commands.read(size)
+            if len(data) != size:
+                raise PatchError("truncated frame")
+            yield data
+
+    def _patch_frame(self,chunks):
+        """Apply the commands from the given chunks, starting at the root."""
+        reader = _ChunkReader(chunks)
+        patcher = Patcher(self.root_dir,reader,dry_run=self.dry_run,
+                          max_memory=self.max_memory)
+        patcher._patch_commands()
+        reader.drain()
+
+    def _patch_commands(self):
+        """Interpret and apply patch commands from the command stream.
+
+        This is a simple command loop that dispatches to the _do_<CMD>
+        methods defined below.  It keeps processing until one of them
+        raises EOFError.
+        """
+        dispatch = self._get_dispatch_table()
+        if self.dry_run:
+            read_command = self._read_command
+        else:
+            read_command = self.commands.read_vint
+        #  Commands are single-byte vints, so the common case of decoding
+        #  one from the buffer is done inline.
+        reader = self.commands
+        small = _SMALL_VINTS
         try:
             while True:
-                cmd = self._read_command()
-                getattr(self,"_do_" + _COMMANDS[cmd])()
+                pos = reader._pos
+                cmd = small.get(reader._buffer[pos:pos+1])
+                if cmd is None or self.dry_run:
+                    cmd = read_command()
+                else:
+                    reader._pos = pos + 1
+                try:
+                    handler = dispatch[cmd]
+                except IndexError:
+                    raise PatchError("unknown patch command: %d" % (cmd,))
+                handler(self)
         except EOFError:
             self._check_end_patch()
 
+    @classmethod
+    def _get_dispatch_table(cls):
+        """Get the list of _do_<CMD> methods, indexed by command number.
+
+        The table holds unbound methods and is cached on the class, so
+        that instances don't end up in a reference cycle.
+        """
+        table = cls.__dict__.get("_dispatch_table")
+        if table is None:
+            table = [getattr(cls,"_do_" + nm) for nm in _COMMANDS]
+            cls._dispatch_table = table
+        return table
+
     def _do_END(self):
         """Execute the END command.
 
@@ -430,6 +1893,7 @@ class Patcher(object):
         the topmost entry.  Otherwise, it exits the main command loop.
         """
         self._check_end_patch()
+        self._wait_for_jobs()
         if self._context_stack:
             self._context_stack.pop()()
         else:
@@ -489,6 +1953,8 @@ class Patcher(object):
         a PatchError is raised.
         """
         self._check_end_patch()
+        self._wait_for_jobs(self.target)
+        self._extract_lazy(self.target)
         digest = self._read(16)
         assert len(digest) == 16
         if not self.dry_run:
@@ -503,6 +1969,8 @@ class Patcher(object):
         intermediate directories.
         """
         self._check_end_patch()
+        self._wait_for_jobs(self.target)
+        self._discard_lazy(self.target)
         if not self.dry_run:
             if os.path.isdir(self.target):
                 shutil.rmtree(self.target)
@@ -516,6 +1984,8 @@ class Patcher(object):
         This forcibly removes the file or directory at the current target path.
         """
         self._check_end_patch()
+        self._wait_for_jobs(self.target)
+        self._discard_lazy(self.target)
         if not self.dry_run:
             if os.path.isdir(self.target):
                 shutil.rmtree(self.target)
@@ -532,8 +2002,10 @@ class Patcher(object):
         directory.
         """
         self._check_end_patch()
-        source_path = os.path.join(os.path.dirname(self.target),self._read_path())
-        self._check_path(source_path)
+        source_path = self._read_source_path()
+        self._wait_for_jobs(self.target,source_path)
+        self._extract_lazy(source_path)
+        self._discard_lazy(self.target)
         if not self.dry_run:
             if os.path.exists(self.target):
                 if os.path.isdir(self.target):
@@ -555,8 +2027,10 @@ class Patcher(object):
         directory.
         """
         self._check_end_patch()
-        source_path = os.path.join(os.path.dirname(self.target),self._read_path())
-        self._check_path(source_path)
+        source_path = self._read_source_path()
+        self._wait_for_jobs(self.target,source_path)
+        self._extract_lazy(source_path)
+        self._discard_lazy(self.target)
         if not self.dry_run:
             if os.path.exists(self.target):
                 if os.path.isdir(self.target):
@@ -575,7 +2049,51 @@ class Patcher(object):
         self._check_begin_patch()
         n = self._read_int()
         if not self.dry_run:
-            self.outfile.write(self.infile.read(n))
+            self._file_op(Patcher._pf_copy,n)
+
+    def _pf_copy(self,n):
+        while n > 0:
+            data = self.infile.read(min(n,self._chunk_size))
+            if not data:
+                break
+            self.outfile.write(data)
+            n -= len(data)
+
+    def _do_PF_COPY_AT(self):
+        """Execute the PF_COPY_AT command.
+
+        This generates new data for the file currently being patched.  It
+        reads integers O and N from the command stream, then copies N bytes
+        starting at offset O in the source file into the target file.  The
+        position of the source file pointer is not changed.
+        """
+        self._check_begin_patch()
+        offset = self._read_int()
+        n = self._read_int()
+        if not self.dry_run:
+            self._file_op(Patcher._pf_copy_at,offset,n)
+
+    def _pf_copy_at(self,offset,n):
+        pos = self.infile.tell()
+        self.infile.seek(offset)
+        while n > 0:
+            data = self.infile.read(min(n,self._chunk_size))
+            if not data:
+                raise PatchError("insufficient source data in %s" % (self.target,))
+            self.outfile.write(data)
+            n -= len(data)
+        self.infile.seek(pos)
+
+    def _do_PF_SEEK(self):
+        """Execute the PF_SEEK command.
+
+        This reads an integer from the command stream, then moves the source
+        file pointer to that offset without changing the target file.
+        """
+        self._check_begin_patch()
+        offset = self._read_int()
+        if not self.dry_run:
+            self._file_op(Patcher._pf_seek,offset,os.SEEK_SET)
 
     def _do_PF_SKIP(self):
         """Execute the PF_SKIP command.
@@ -586,7 +2104,10 @@ class Patcher(object):
         self._check_begin_patch()
         n = self._read_int()
         if not self.dry_run:
-            self.infile.read(n)
+            self._file_op(Patcher._pf_seek,n,os.SEEK_CUR)
+
+    def _pf_seek(self,offset,whence):
+        self.infile.seek(offset,whence)
 
     def _do_PF_INS_RAW(self):
         """Execute the PF_INS_RAW command.
@@ -596,9 +2117,17 @@ class Patcher(object):
         into the target file.
         """
         self._check_begin_patch()
-        data = self._read_bytes()
-        if not self.dry_run:
-            self.outfile.write(data)
+        if self.max_memory is None:
+            data = self._read_bytes()
+            if not self.dry_run:
+                self._file_op(Patcher._pf_write,data)
+        else:
+            for data in self._read_bytes_chunks():
+                if not self.dry_run:
+                    self.outfile.write(data)
+
+    def _pf_write(self,data):
+        self.outfile.write(data)
 
     def _do_PF_INS_BZ2(self):
         """Execute the PF_INS_BZ2 command.
@@ -607,50 +2136,249 @@ class Patcher(object):
         reads a bytestring from the command stream, decompresses it using
         bz2 and and write the result into the target file.
         """
-        self._check_begin_patch()
-        data = bz2.decompress(self._read_bytes())
-        if not self.dry_run:
-            self.outfile.write(data)
+        self._do_insert(_CODECS["bz2"])
 
-    def _do_PF_BSDIFF4(self):
-        """Execute the PF_BSDIFF4 command.
+    def _do_PF_INS_ZLIB(self):
+        """Execute the PF_INS_ZLIB command.
 
-        This reads an integer N and a BSDIFF4-format patch bytestring from
-        the command stream.  It then reads N bytes from the source file,
-        applies the patch to these bytes, and writes the result into the
-        target file.
+        This is just like PF_INS_BZ2 but the data is compressed using zlib.
         """
-        self._check_begin_patch()
-        n = self._read_int()
-        # Restore the standard bsdiff header bytes
-        patch = "BSDIFF40".encode("ascii") + self._read_bytes()
-        if not self.dry_run:
-            source = self.infile.read(n)
-            if len(source) != n:
-                raise PatchError("insufficient source data in %s" % (self.target,))
-            self.outfile.write(bsdiff4_patch(source,patch))
+        self._do_insert(_CODECS["zlib"])
 
-    def _do_PF_REC_ZIP(self):
-        """Execute the PF_REC_ZIP command.
+    def _do_PF_INS_LZMA(self):
+        """Execute the PF_INS_LZMA command.
+
+        This is just like PF_INS_BZ2 but the data is compressed using lzma.
+        """
+        self._do_insert(_CODECS["lzma"])
+
+    def _do_insert(self,codec):
+        """Insert data from the command stream, decompressed by the codec."""
+        self._check_begin_patch()
+        if self.max_memory is None:
+            data = self._read_bytes()
+            if not self.dry_run:
+                self._file_op(Patcher._pf_insert,codec,data)
+        elif self.dry_run:
+            for _ in self._read_bytes_chunks():
+                pass
+        else:
+            chunks = self._read_bytes_chunks()
+            for data in _decompress_chunks(codec.decompressor(),chunks,
+                                           self._chunk_size):
+                self.outfile.write(data)
+
+    def _pf_insert(self,codec,data):
+        self.outfile.write(codec.decompress(data))
+
+    def _do_SOLID_DATA(self):
+        """Execute the SOLID_DATA command.
+
+        This reads the number of the PF_INS_* command for a codec, and a
+        bytestring compressed with that codec.  Its contents are added to
+        the end of the solid stream, from which PF_INS_SOLID commands take
+        their data.  The data is only decompressed as it's needed.
+        """
+        cmd = self._read_int()
+        for codec in _CODECS.itervalues():
+            if codec.ins_command == cmd:
+                break
+        else:
+            raise PatchError("unknown solid data codec: %d" % (cmd,))
+        self._solid_blocks.append((codec,self._read_bytes()))
+
+    def _do_PF_INS_SOLID(self):
+        """Execute the PF_INS_SOLID command.
+
+        This generates new data for the file currently being patched.  It
+        reads an integer n from the command stream, and writes the next n
+        bytes of the solid stream into the target file.
+        """
+        self._check_begin_patch()
+        data = self._read_solid(self._read_int())
+        if not self.dry_run:
+            self._file_op(Patcher._pf_write,data)
+
+    def _read_solid(self,n):
+        """Read the next n bytes from the solid stream.
+
+        Blocks added by SOLID_DATA are decompressed in pieces, and only
+        once all the data before them has been used.
+        """
+        data = self._solid_buf
+        while len(data) < n:
+            try:
+                data += next(self._solid)
+            except StopIteration:
+                if not self._solid_blocks:
+                    raise PatchError("insufficient solid data")
+                (codec,block) = self._solid_blocks.pop(0)
+                self._solid = _decompress_chunks(codec.decompressor(),[block],
+                                                 1024 * 64)
+        self._solid_buf = data[n:]
+        return data[:n]
+
+    def _do_PF_BSDIFF4(self):
+        """Execute the PF_BSDIFF4 command.
+
+        This reads an integer N and a BSDIFF4-format patch bytestring from
+        the command stream.  It then reads N bytes from the source file,
+        applies the patch to these bytes, and writes the result into the
+        target file.
+        """
+        self._do_bsdiff4(_CODECS["bz2"])
+
+    def _do_PF_BSDIFF4_ZLIB(self):
+        """Execute the PF_BSDIFF4_ZLIB command.
+
+        This is just like PF_BSDIFF4 but the control, diff and extra blocks
+        of the patch are compressed using zlib.
+        """
+        self._do_bsdiff4(_CODECS["zlib"])
+
+    def _do_PF_BSDIFF4_LZMA(self):
+        """Execute the PF_BSDIFF4_LZMA command.
+
+        This is just like PF_BSDIFF4 but the control, diff and extra blocks
+        of the patch are compressed using lzma.
+        """
+        self._do_bsdiff4(_CODECS["lzma"])
+
+    def _do_bsdiff4(self,codec):
+        """Apply a bsdiff patch whose blocks are compressed by the codec."""
+        self._check_begin_patch()
+        n = self._read_int()
+        if self.max_memory is not None:
+            self._stream_bsdiff4(n,codec)
+            return
+        # Restore the standard bsdiff header bytes
+        patch = "BSDIFF40".encode("ascii") + self._read_bytes()
+        if not self.dry_run:
+            self._file_op(Patcher._pf_bsdiff4,n,patch,codec)
+
+    def _pf_bsdiff4(self,n,patch,codec):
+        source = self.infile.read(n)
+        if len(source) != n:
+            raise PatchError("insufficient source data in %s" % (self.target,))
+        self.outfile.write(bsdiff4_patch(source,patch,codec.decompress))
+
+    def _stream_bsdiff4(self,n,codec):
+        """Apply a bsdiff patch from the command stream with bounded memory.
+
+        The control and diff blocks are spooled to temp files, so that they
+        can be read in step with the extra block as it's streamed from the
+        command stream.  The N bytes of source data are read piece by piece
+        as required, so the source pointer is moved past them at the end.
+        """
+        raw = _ChunkReader(self._read_bytes_chunks())
+        if self.dry_run:
+            raw.drain()
+            return
+        header = raw.read(24)
+        if len(header) != 24:
+            raise PatchError("corrupted bsdiff patch")
+        (l_bcontrol,l_bdiff,l_target) = _decode_offts(header)
+        base = self.infile.tell()
+        self.infile.seek(0,os.SEEK_END)
+        if self.infile.tell() - base < n:
+            raise PatchError("insufficient source data in %s" % (self.target,))
+        spools = []
+        try:
+            for size in (l_bcontrol,l_bdiff):
+                f = tempfile.TemporaryFile(dir=self._workdir)
+                spools.append(f)
+                for chunk in raw.chunks(size):
+                    f.write(chunk)
+                f.seek(0)
+            def stream(chunks):
+                return _ChunkReader(_decompress_chunks(codec.decompressor(),
+                                                       chunks,self._chunk_size))
+            control = stream(_file_chunks(spools[0],self._chunk_size))
+            diff = stream(_file_chunks(spools[1],self._chunk_size))
+            extra = stream(raw.chunks())
+            oldpos = newpos = 0
+            while newpos < l_target:
+                ctrl = control.read(24)
+                if len(ctrl) != 24:
+                    raise PatchError("corrupted bsdiff patch")
+                (x,y,z) = _decode_offts(ctrl)
+                while x > 0:
+                    size = min(x,self._chunk_size)
+                    diff_data = diff.read(size)
+                    self.infile.seek(base + oldpos)
+                    orig_data = self.infile.read(size)
+                    if len(diff_data) != size or len(orig_data) != size:
+                        raise PatchError("corrupted bsdiff patch")
+                    self.outfile.write(_add_bytes(diff_data,orig_data))
+                    x -= size
+                    oldpos += size
+                    newpos += size
+                while y > 0:
+                    extra_data = extra.read(min(y,self._chunk_size))
+                    if not extra_data:
+                        raise PatchError("corrupted bsdiff patch")
+                    self.outfile.write(extra_data)
+                    y -= len(extra_data)
+                    newpos += len(extra_data)
+                oldpos += z
+            raw.drain()
+        finally:
+            for f in spools:
+                f.close()
+        self.infile.seek(base + n)
+
+    def _do_PF_REC_ZIP(self):
+        """Execute the PF_REC_ZIP command.
 
         This patches the current target by treating it as a zipfile and
-        recursing into it.  It extracts the source file to a temp directory,
-        then reads commands and applies them to that directory.
+        recursing into it.  The members of the source file are extracted
+        to a temp directory as they're needed, and commands are read and
+        applied to that directory.
 
         This command expects two END-terminated blocks of sub-commands.  The
         first block patches the zipfile metadata, and the second patches the
-        actual contents of the zipfile.
+        actual contents of the zipfile.  The new zipfile is then written
+        directly to the target; members never touched by the commands are
+        copied across in compressed form.
         """
-        self._check_begin_patch()
+        self._recurse_zipfile(None)
+
+    def _do_PF_REC_ZIP_EXT(self):
+        """Execute the PF_REC_ZIP_EXT command.
+
+        This extends PF_REC_ZIP to zipfiles with data prepended to them,
+        such as an executable with an appended library zip, and to zipfiles
+        with archive comments or zip64 extensions.  It reads an integer
+        of ZIP_* flags, then expects three END-terminated blocks of
+        sub-commands.  The first block patches the prepended data, and the
+        others are as for PF_REC_ZIP.
+        """
+        flags = self._read_int()
+        self._recurse_zipfile(flags)
+
+    def _recurse_zipfile(self,flags):
+        """Patch the current target as a zipfile.
+
+        This implements the PF_REC_ZIP and PF_REC_ZIP_EXT commands; 'flags'
+        is None for the former.
+        """
+        self._wait_for_jobs()
+        self._check_begin_patch(defer=False)
         if not self.dry_run:
             workdir = os.path.join(self._workdir,str(len(self._context_stack)))
             os.mkdir(workdir)
             t_temp = os.path.join(workdir,"contents")
             m_temp = os.path.join(workdir,"meta")
-            z_temp = os.path.join(workdir,"result.zip")
+            p_temp = os.path.join(workdir,"preamble")
         cur_state = self._blank_state()
         zfmeta = [None]
-        #  First we process a set of commands to generate the zipfile metadata.
+        contents = [None]
+        #  For PF_REC_ZIP_EXT, we first process a set of commands to generate
+        #  the data prepended to the zipfile.
+        def end_preamble():
+            if not self.dry_run:
+                self.target = m_temp
+        #  Then we process a set of commands to generate the zipfile metadata.
         def end_metadata():
             if not self.dry_run:
                 zfmeta[0] = _read_zipfile_metadata(m_temp)
@@ -659,28 +2387,157 @@ class Patcher(object):
         def end_contents():
             self._restore_state(cur_state)
             if not self.dry_run:
-                create_zipfile(t_temp,z_temp,members=zfmeta[0].infolist())
-                with open(z_temp,"rb") as f:
-                    data = f.read(1024*16)
-                    while data:
-                        self.outfile.write(data)
-                        data = f.read(1024*16)
-                zfmeta[0].close()
+                self._lazy_zips.remove(contents[0])
+                try:
+                    stream = self.outfile
+                    if flags is not None:
+                        with open(p_temp,"rb") as f:
+                            shutil.copyfileobj(f,self.outfile)
+                        if flags & ZIP_RELATIVE_OFFSETS:
+                            stream = _OffsetWriter(stream,stream.tell())
+                    contents[0].write_zipfile(stream,zfmeta[0].infolist(),
+                                              zfmeta[0].comment)
+                finally:
+                    contents[0].close()
+                    zfmeta[0].close()
                 shutil.rmtree(workdir)
         self._context_stack.append(end_contents)
         self._context_stack.append(end_metadata)
+        if flags is not None:
+            self._context_stack.append(end_preamble)
         if not self.dry_run:
-            #  Begin by writing the current zipfile metadata to a temp file.
-            #  This will be patched, then end_metadata() will be called.
+            #  Begin by writing the current zipfile metadata to a temp file,
+            #  along with any prepended data.  These will be patched, then
+            #  end_preamble() and end_metadata() will be called.
+            contents[0] = _LazyZipContents(self.target,t_temp)
+            self._lazy_zips.append(contents[0])
             with open(m_temp,"wb") as f:
-                zf = zipfile.ZipFile(self.target)
+                _write_zipfile_metadata(f,contents[0].zipfile)
+            if flags is not None:
+                _copy_zipfile_preamble(self.target,contents[0].zipfile,p_temp)
+                self.target = p_temp
+            else:
+                self.target = m_temp
+            self.root_dir = workdir
+
+    def _do_PF_REC_COMPRESSED(self):
+        """Execute the PF_REC_COMPRESSED command.
+
+        This patches the current target by treating it as a compressed file
+        and recursing into it.  It reads the number of the format from
+        _COMPRESSED_FORMATS, the compression level and a bytestring of any
+        other parameters.  The source file is decompressed into a temp file,
+        then commands are read up to an END command and applied to that
+        file.  The result is compressed into the target.
+        """
+        try:
+            fmt = _COMPRESSED_FORMATS[self._read_int()]
+        except IndexError:
+            raise PatchError("unknown compression format")
+        level = self._read_int()
+        params = self._read_bytes()
+        self._wait_for_jobs()
+        self._check_begin_patch(defer=False)
+        if not self.dry_run:
+            workdir = os.path.join(self._workdir,str(len(self._context_stack)))
+            os.mkdir(workdir)
+            payload = os.path.join(workdir,"payload")
+        cur_state = self._blank_state()
+        def end_payload():
+            self._restore_state(cur_state)
+            if not self.dry_run:
+                with open(payload,"rb") as f:
+                    fmt.compress(f,self.outfile,level,params)
+                shutil.rmtree(workdir)
+        self._context_stack.append(end_payload)
+        if not self.dry_run:
+            with open(payload,"wb") as fout:
+                if os.path.isfile(self.target):
+                    with open(self.target,"rb") as fin:
+                        fmt.decompress(fin,fout)
+            self.root_dir = workdir
+            self.target = payload
+
+    def _do_PF_REC_X86(self):
+        """Execute the PF_REC_X86 command.
+
+        This patches the current target by transforming the x86 machine code
+        in it so that branches have absolute targets, and recursing into the
+        transformed file.  It reads the ranges of code in the source and in
+        the target, each as a count followed by (offset,size) pairs.  The
+        transformed source is written to a temp file, then commands are read
+        up to an END command and applied to that file.  The result has the
+        transform reversed and is written to the target.
+        """
+        ranges = []
+        for i in xrange(2):
+            ranges.append([(self._read_int(),self._read_int())
+                           for j in xrange(self._read_int())])
+        (s_ranges,t_ranges) = ranges
+        self._wait_for_jobs()
+        self._check_begin_patch(defer=False)
+        if not self.dry_run:
+            workdir = os.path.join(self._workdir,str(len(self._context_stack)))
+            os.mkdir(workdir)
+            payload = os.path.join(workdir,"payload")
+        cur_state = self._blank_state()
+        def end_payload():
+            self._restore_state(cur_state)
+            if not self.dry_run:
+                with open(payload,"rb") as f:
+                    _x86_transform_file(f,self.outfile,t_ranges,False)
+                shutil.rmtree(workdir)
+        self._context_stack.append(end_payload)
+        if not self.dry_run:
+            with open(payload,"wb") as fout:
+                if os.path.isfile(self.target):
+                    with open(self.target,"rb") as fin:
+                        _x86_transform_file(fin,fout,s_ranges,True)
+            self.root_dir = workdir
+            self.target = payload
+
+    def _do_PF_REC_PYC(self):
+        """Execute the PF_REC_PYC command.
+
+        This patches the current target by treating it as a compiled python
+        module and recursing into its body.  It reads the header and the
+        source filename of the target module.  The source module is split
+        into header, filename and body by _pyc_split(), the body is written
+        to a temp file, then commands are read up to an END command and
+        applied to that file.  The result is reassembled with the target
+        header and filename.
+        """
+        header = self._read_bytes()
+        filename = self._read_bytes()
+        self._wait_for_jobs()
+        self._check_begin_patch(defer=False)
+        if not self.dry_run:
+            workdir = os.path.join(self._workdir,str(len(self._context_stack)))
+            os.mkdir(workdir)
+            payload = os.path.join(workdir,"payload")
+        cur_state = self._blank_state()
+        def end_payload():
+            self._restore_state(cur_state)
+            if not self.dry_run:
+                with open(payload,"rb") as f:
+                    body = f.read()
                 try:
-                    _write_zipfile_metadata(f,zf)
-                finally:
-                    zf.close()
-            extract_zipfile(self.target,t_temp)
+                    self.outfile.write(_pyc_join(header,filename,body))
+                except (ValueError,EOFError,TypeError):
+                    raise PatchError("invalid compiled python module")
+                shutil.rmtree(workdir)
+        self._context_stack.append(end_payload)
+        if not self.dry_run:
+            with open(payload,"wb") as fout:
+                if os.path.isfile(self.target):
+                    with open(self.target,"rb") as fin:
+                        try:
+                            fout.write(_pyc_split(fin.read())[2])
+                        except ValueError:
+                            msg = "not a compiled python module: %s"
+                            raise PatchError(msg % (self.target,))
             self.root_dir = workdir
-            self.target = m_temp
+            self.target = payload
 
     def _do_CHMOD(self):
         """Execute the CHMOD command.
@@ -689,11 +2546,284 @@ class Patcher(object):
         of the current target to that integer.
         """
         self._check_end_patch()
+        self._wait_for_jobs(self.target)
+        self._extract_lazy(self.target)
         mod = self._read_int()
         if not self.dry_run:
             os.chmod(self.target,mod)
 
 
+class _FilePatchJob(Patcher):
+    """Deferred patching of a single file, to be run by a worker thread.
+
+    The Patcher records file-level operations on the job as it decodes the
+    commands for a file; run() then opens the file, performs them using the
+    same methods as the Patcher itself, and commits the result.
+    """
+
+    def __init__(self,target,chunk_size):
+        self.target = target
+        self.new_target = None
+        self.infile = None
+        self.outfile = None
+        self._chunk_size = chunk_size
+        self._workdir = None
+        self.ops = []
+
+    def run(self):
+        self._open_target()
+        try:
+            for (op,args) in self.ops:
+                op(self,*args)
+        except:
+            self.infile.close()
+            self.infile = None
+            self.outfile.close()
+            self.outfile = None
+            os.unlink(self.new_target)
+            raise
+        self._commit_target()
+
+
+def _paths_overlap(path,others):
+    """Check whether path is, contains or is inside any of the other paths."""
+    for other in others:
+        if path == other:
+            return True
+        if path.startswith(other + os.sep) or other.startswith(path + os.sep):
+            return True
+    return False
+
+
+class _LazyZipContents(object):
+    """Contents of a zipfile, extracted into a directory on demand.
+
+    The directories containing the members are created up front, but each
+    member is only extracted when the Patcher calls extract() for a path
+    at or above it.  Members discarded by discard() or never extracted are
+    left in the zipfile.  When the new zipfile is written by write_zipfile(),
+    any of its members still in the zipfile are copied in compressed form.
+    """
+
+    def __init__(self,path,root):
+        self.zipfile = zipfile.ZipFile(path,"r")
+        self._rawfile = open(path,"rb")
+        self.root = root
+        self.members = {}
+        os.makedirs(root)
+        for zinfo in self.zipfile.infolist():
+            if zinfo.filename.endswith("/"):
+                continue
+            mpath = os.path.join(root,*zinfo.filename.split("/"))
+            self.members[mpath] = zinfo
+            if not os.path.isdir(os.path.dirname(mpath)):
+                os.makedirs(os.path.dirname(mpath))
+
+    def close(self):
+        self.zipfile.close()
+        self._rawfile.close()
+
+    def _find(self,paths):
+        """Find the paths of unextracted members at or below the given paths."""
+        found = []
+        for path in paths:
+            if path in self.members:
+                found.append(path)
+            elif os.path.isdir(path) and _paths_overlap(path,(self.root,)):
+                prefix = os.path.join(path,"")
+                for mpath in self.members:
+                    if mpath.startswith(prefix):
+                        found.append(mpath)
+        return found
+
+    def extract(self,*paths):
+        """Extract any members at or below the given paths."""
+        for mpath in self._find(paths):
+            zinfo = self.members.pop(mpath)
+            with open(mpath,"wb") as f:
+                infile = self.zipfile.open(zinfo)
+                try:
+                    shutil.copyfileobj(infile,f)
+                finally:
+                    infile.close()
+            mode = zinfo.external_attr >> 16
+            if mode:
+                os.chmod(mpath,mode)
+
+    def discard(self,*paths):
+        """Forget any unextracted members at or below the given paths."""
+        for mpath in self._find(paths):
+            del self.members[mpath]
+
+    def write_zipfile(self,stream,members,comment=""):
+        """Write a zipfile with the given members to the given stream.
+
+        'members' is a list of ZipInfo objects, and the data for each is
+        read from the corresponding file in the directory.  If a member
+        was never extracted, its compressed data is copied directly from
+        the source zipfile instead, as long as it's compressed the same way.
+        The result is the same as that of util.create_zipfile(), except
+        that zip64 extensions are used where needed.
+        """
+        zf = zipfile.ZipFile(stream,"w",allowZip64=True)
+        zf.comment = comment
+        try:
+            for zinfo in members:
+                mpath = os.path.join(self.root,*zinfo.filename.split("/"))
+                s_zinfo = self.members.get(mpath)
+                if s_zinfo is not None and not s_zinfo.flag_bits & 0x01:
+                    if s_zinfo.compress_type == zinfo.compress_type:
+                        self._copy_member(zf,zinfo,s_zinfo)
+                        continue
+                self.extract(mpath)
+                with open(mpath,"rb") as f:
+                    zf.writestr(zinfo,f.read())
+        finally:
+            zf.close()
+
+    def _copy_member(self,zf,zinfo,s_zinfo):
+        """Copy the compressed data for a member directly into zf.
+
+        This writes exactly what zf.writestr() would, without decompressing
+        and recompressing the data.
+        """
+        zinfo.CRC = s_zinfo.CRC
+        zinfo.file_size = s_zinfo.file_size
+        zinfo.compress_size = s_zinfo.compress_size
+        zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+                zinfo.compress_size > zipfile.ZIP64_LIMIT
+        if zip64 and not zf._allowZip64:
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+        zinfo.header_offset = zf.fp.tell()
+        zf.fp.write(zinfo.FileHeader(zip64))
+        self._rawfile.seek(_zipfile_data_offset(self._rawfile,s_zinfo))
+        n = s_zinfo.compress_size
+        while n > 0:
+            data = self._rawfile.read(min(n,1024*64))
+            if not data:
+                raise PatchError("truncated zipfile member")
+            zf.fp.write(data)
+            n -= len(data)
+        if zinfo.flag_bits & 0x08:
+            fmt = "<LLQQ" if zip64 else "<LLLL"
+            zf.fp.write(struct.pack(fmt,0x08074b50,zinfo.CRC,
+                                    zinfo.compress_size,zinfo.file_size))
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        zf._didModify = True
+        if hasattr(zf,"start_dir"):
+            zf.start_dir = zf.fp.tell()
+
+
+class _OffsetWriter(object):
+    """File-like object writing to a stream that starts at the given offset.
+
+    This is used to write zipfiles whose recorded offsets are relative to
+    the end of some prepended data.
+    """
+
+    def __init__(self,stream,offset):
+        self.stream = stream
+        self.offset = offset
+
+    def write(self,data):
+        self.stream.write(data)
+
+    def tell(self):
+        return self.stream.tell() - self.offset
+
+    def flush(self):
+        self.stream.flush()
+
+
+class _DigestWriter(object):
+    """File-like object calculating the md5 digest of the data written."""
+
+    def __init__(self):
+        self.hash = hashlib.md5()
+        self.size = 0
+
+    def write(self,data):
+        self.hash.update(data)
+        self.size += len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def digest(self):
+        return self.hash.digest()
+
+
+class _Mismatch(Exception):
+    """Raised by _CompareWriter when the data written doesn't match."""
+
+
+class _CompareWriter(object):
+    """File-like object checking that the data written matches a file."""
+
+    def __init__(self,f):
+        self.f = f
+
+    def write(self,data):
+        if data and self.f.read(len(data)) != data:
+            raise _Mismatch
+
+    def finish(self):
+        """Check that the whole file has been written."""
+        if self.f.read(1):
+            raise _Mismatch
+
+
+def _find_compression(fmt,source,target,s_payload,t_payload):
+    """Find how to recreate a compressed target exactly.
+
+    The source and target are decompressed into the files 's_payload' and
+    't_payload', and the levels suggested by the target's parameters are
+    tried until compressing its contents gives exactly the target.  This
+    returns a tuple (level,params), or None if either file can't be
+    decompressed or the target can't be recreated.
+    """
+    with open(target,"rb") as f:
+        found = fmt.params(f.read(1024*64))
+    if found is None:
+        return None
+    (levels,params) = found
+    try:
+        for (path,payload) in ((source,s_payload),(target,t_payload)):
+            with open(path,"rb") as fin:
+                with open(payload,"wb") as fout:
+                    fmt.decompress(fin,fout)
+    except fmt.errors:
+        return None
+    for level in levels:
+        with open(t_payload,"rb") as fin:
+            with open(target,"rb") as f:
+                out = _CompareWriter(f)
+                try:
+                    fmt.compress(fin,out,level,params)
+                    out.finish()
+                except _Mismatch:
+                    continue
+        return (level,params)
+    return None
+
+
+def _zipfile_data_offset(f,zinfo):
+    """Find the offset of the compressed data for a zipfile member.
+
+    This reads the member's local file header from the file object 'f'.
+    """
+    f.seek(zinfo.header_offset)
+    header = f.read(30)
+    if len(header) != 30 or header[:4] != "PK\x03\x04".encode("ascii"):
+        raise PatchError("bad zipfile member header")
+    (namelen,extralen) = struct.unpack("<HH",header[26:30])
+    return zinfo.header_offset + 30 + namelen + extralen
+
+
 class Differ(object):
     """Class generating our patch protocol.
 
@@ -701,18 +2831,61 @@ class Differ(object):
     commands to transform one file/directory into another.
     """
 
-    def __init__(self,outfile,diff_window_size=None):
+    def __init__(self,outfile,diff_window_size=None,workers=None,
+                 adaptive_windows=False,codecs=None,objective="size",
+                 effort="default",patch_version=1,
+                 transform_executables=False,solid=False):
         if not diff_window_size:
             diff_window_size = DIFF_WINDOW_SIZE
         self.diff_window_size = diff_window_size
-        self.outfile = outfile
+        self.workers = workers
+        self.adaptive_windows = adaptive_windows
+        if codecs is None:
+            codecs = DEFAULT_CODECS
+        for nm in codecs:
+            if nm not in _CODECS:
+                raise ValueError("unknown codec: %s" % (nm,))
+            if nm == "lzma" and lzma is None:
+                raise DiffError("lzma support is not available")
+        self.codecs = tuple(codecs)
+        if objective not in ("size","speed"):
+            raise ValueError("unknown objective: %s" % (objective,))
+        self.objective = objective
+        if effort not in EFFORT_LEVELS:
+            raise ValueError("unknown effort level: %s" % (effort,))
+        self.effort = effort
+        if patch_version not in (1,2):
+            raise ValueError("unknown patch version: %s" % (patch_version,))
+        self.patch_version = patch_version
+        self.transform_executables = transform_executables
+        self.solid = solid
+        solid_codecs = self.codecs if solid else ()
+        self.outfile = self._writer = _CommandWriter(outfile,solid_codecs)
         self._pending_pop_path = False
+        self._pool = None
+        self._pool_stream = None
+        self._pool_results = []
+        self._reuse = {}
+        self._gone = set()
+        self._tree = TreeSnapshot()
+        self._frame_root = None
+        self._next_frame = None
+
+    @property
+    def stats(self):
+        """Dict giving the number of bytes written for each type of command.
+
+        The bytes for each command include those of its arguments.  Bytes
+        not belonging to any command (i.e. the patch header) are counted
+        under the key "HEADER".
+        """
+        return self._writer.stats
 
     def _write(self,data):
         self.outfile.write(data)
 
     def _write_int(self,i):
-        _write_vint(self.outfile,i)
+        self.outfile.write_vint(i)
 
     def _write_command(self,cmd):
         """Write the given command to the stream.
@@ -720,27 +2893,53 @@ class Differ(object):
         This does some simple optimisations to collapse sequences of commands
         into a single command - current only around path manipulation.
         """
+        if self._next_frame is not None:
+            self._begin_frame()
         if cmd == POP_PATH:
             if self._pending_pop_path:
-                _write_vint(self.outfile,POP_PATH)
+                self.outfile.write_command(POP_PATH)
             else:
                 self._pending_pop_path = True
         elif self._pending_pop_path:
             self._pending_pop_path = False
             if cmd == JOIN_PATH:
-                _write_vint(self.outfile,POP_JOIN_PATH)
+                self.outfile.write_command(POP_JOIN_PATH)
             elif cmd == SET_PATH:
-                _write_vint(self.outfile,SET_PATH)
+                self.outfile.write_command(SET_PATH)
             else:
-                _write_vint(self.outfile,POP_PATH)
-                _write_vint(self.outfile,cmd)
+                self.outfile.write_command(POP_PATH)
+                self.outfile.write_command(cmd)
         else:
-            _write_vint(self.outfile,cmd)
+            self.outfile.write_command(cmd)
 
     def _write_bytes(self,bytes):
-        _write_vint(self.outfile,len(bytes))
+        self.outfile.write_vint(len(bytes))
         self._write(bytes)
 
+    def _set_next_frame(self,kind,path=""):
+        """Arrange for the next command to start a new frame.
+
+        Frames are started lazily, so that no empty frames are written for
+        e.g. items that are unchanged.  A frame's commands always start at
+        the root, so any pending POP_PATH back to the root is dropped.
+        """
+        self._next_frame = (kind,path)
+
+    def _begin_frame(self):
+        (kind,path) = self._next_frame
+        self._next_frame = None
+        self._pending_pop_path = False
+        digest = "".encode("ascii")
+        if path:
+            t_nm = os.path.join(self._frame_root,path)
+            digest = calculate_digest(t_nm,hashlib.md5,self._tree)
+        if self._pool is None:
+            self.outfile.begin_frame(kind,path,digest)
+        else:
+            self._pool_results.append(self.outfile)
+            self._pool_results.append((kind,path,digest))
+            self.outfile = _CommandWriter()
+
     def _write_path(self,path):
         self._write_bytes(path.encode("utf8"))
 
@@ -753,13 +2952,311 @@ class Differ(object):
         """
         source = os.path.abspath(source)
         target = os.path.abspath(target)
-        self._write(PATCH_HEADER)
-        self._write_int(HIGHEST_VERSION)
-        self._diff(source,target)
-        self._write_command(SET_PATH)
-        self._write_bytes("".encode("ascii"))
-        self._write_command(VERIFY_MD5)
-        self._write(calculate_digest(target,hashlib.md5))
+        if self.workers and self.workers > 1 and multiprocessing is not None:
+            self._start_pool()
+        try:
+            self._write(PATCH_HEADER)
+            self._write_int(self.patch_version)
+            if self.patch_version >= 2:
+                self._frame_root = target
+                self._set_next_frame(FRAME_SERIAL)
+            self._diff_tree(source,target)
+            self._write_command(SET_PATH)
+            self._write_bytes("".encode("ascii"))
+            self._write_command(VERIFY_MD5)
+            self._write(calculate_digest(target,hashlib.md5,self._tree))
+        except:
+            self._stop_pool(abort=True)
+            raise
+        else:
+            self._stop_pool()
+            if self.patch_version >= 2:
+                self.outfile.finish_frames()
+            self.outfile.flush()
+        finally:
+            self._frame_root = None
+            self._next_frame = None
+
+    def _start_pool(self):
+        """Start a pool of worker processes for diffing individual files.
+
+        While the pool is active, commands are written into an in-memory
+        segment rather than directly to the output file.  Each file diffed
+        by a worker closes off the current segment, and the results are
+        written out in order as they become available.
+        """
+        self._pool = multiprocessing.Pool(self.workers)
+        self._pool_stream = self.outfile
+        self._pool_results = []
+        self.outfile = _CommandWriter()
+
+    def _stop_pool(self,abort=False):
+        """Shut down the worker pool, writing out any outstanding results."""
+        if self._pool is None:
+            return
+        try:
+            if abort:
+                self._pool.terminate()
+            else:
+                self._pool_results.append(self.outfile)
+                self._flush_pool_results(0)
+                self._pool.close()
+        finally:
+            self._pool.join()
+            self.outfile = self._pool_stream
+            self._pool = None
+            self._pool_stream = None
+            self._pool_results = []
+
+    def _submit_to_pool(self,func,*args):
+        """Generate some commands in a worker process.
+
+        The given function is called in a worker process with the keyword
+        arguments for a Differ followed by 'args', and must return the
+        result of calling parts() on the _CommandWriter holding the generated
+        commands.  The current segment is closed off
+        and a placeholder for the worker's output is queued behind it, so
+        that everything is written out in the same order as it would have
+        been by doing the work in-process.
+        """
+        assert not self._pending_pop_path
+        self._pool_results.append(self.outfile)
+        self.outfile = _CommandWriter()
+        job = self._pool.apply_async(func,(self._worker_kwds(),) + args)
+        self._pool_results.append(job)
+        #  Write out whatever is ready, and limit the amount of pending
+        #  work so we don't buffer the entire patch in memory.
+        self._flush_pool_results(self.workers * 4)
+
+    def _drain_pool(self):
+        """Wait for all work submitted to the pool to be written out.
+
+        This must be called before removing any temp files that have been
+        given to the workers.
+        """
+        if self._pool is not None:
+            self._flush_pool_results(0)
+
+    def _worker_kwds(self):
+        """Get keyword arguments for creating a Differ in a worker process."""
+        return {"diff_window_size":self.diff_window_size,
+                "adaptive_windows":self.adaptive_windows,
+                "codecs":self.codecs,
+                "objective":self.objective,
+                "effort":self.effort,
+                "transform_executables":self.transform_executables,
+                "solid":self.solid}
+
+    def _flush_pool_results(self,max_pending):
+        """Write out finished results, waiting until at most 'max_pending'
+        jobs remain outstanding."""
+        results = self._pool_results
+        num_pending = len([r for r in results
+                           if not isinstance(r,(_CommandWriter,tuple))])
+        i = 0
+        while i < len(results):
+            r = results[i]
+            if isinstance(r,tuple):
+                #  Marks the start of a frame in a version 2 patch.
+                self._pool_stream.begin_frame(*r)
+                i += 1
+                continue
+            if isinstance(r,_CommandWriter):
+                r = r.parts()
+            else:
+                if num_pending <= max_pending and not r.ready():
+                    break
+                r = r.get()
+                num_pending -= 1
+            self._pool_stream.write_parts(*r)
+            i += 1
+        del results[:i]
+
+    def _diff_tree(self,source,target):
+        """Generate patch commands to transform one tree into another.
+
+        This wraps the _diff() method for the root of a tree, i.e. the
+        top-level source and target or the contents of a zipfile.  If both
+        are directories, it works out which existing items in the source
+        will be reused for new items in the target, and stashes any that
+        would otherwise be modified or removed before they are needed.
+        """
+        saved_plan = (self._reuse,self._gone)
+        self._reuse = {}
+        self._gone = set()
+        try:
+            stash = None
+            if self._tree.isdir(source) and self._tree.isdir(target):
+                stash = self._plan_reuse(source,target)
+            if stash is not None:
+                (stashnm,entries) = stash
+                self._write_command(JOIN_PATH)
+                self._write_path(stashnm)
+                self._write_command(MAKEDIR)
+                for (i,(cmd,relpath)) in enumerate(entries):
+                    self._write_command(JOIN_PATH)
+                    self._write_path(str(i))
+                    self._write_command(cmd)
+                    self._write_path("../" + relpath)
+                    self._write_command(POP_PATH)
+                self._write_command(POP_PATH)
+            self._diff(source,target)
+            if stash is not None:
+                self._write_command(JOIN_PATH)
+                self._write_path(stashnm)
+                self._write_command(REMOVE)
+                self._write_command(POP_PATH)
+        finally:
+            (self._reuse,self._gone) = saved_plan
+
+    def _plan_reuse(self,source,target):
+        """Plan which source items will be reused for new target items.
+
+        This walks the target tree in the same order as _diff_dir(), working
+        out which source item each target item will be diffed against.  New
+        target directories are matched against a similar sibling if there is
+        one, or the most similar directory anywhere in the source.  New target
+        files are matched against any source file with identical contents,
+        or failing that the most similar source file.
+
+        The results are stored in self._reuse, mapping each new target path
+        to a tuple (source path, command, command path).  Items that remain
+        unchanged in place can be copied directly; anything else is first
+        moved (or copied, if the walk still needs it in place) into a stash
+        directory.  If any stashing is required, this method returns a tuple
+        giving the name of the stash directory and a list of (command,path)
+        pairs to populate it; otherwise it returns None.
+        """
+        #  Map each source item to the target item that will be diffed
+        #  against it in-place, and find all new items in walk order.
+        #  Directories must be matched during the walk, since their contents
+        #  are then diffed against the contents of the matched directory.
+        in_place = {}
+        new_items = []
+        dir_bases = {}
+        similar = _SimilarityIndex(source,self._tree)
+        def walk(s_dir,t_dir):
+            claimed = set()
+            for nm in self._tree.listdir(t_dir):
+                s_nm = os.path.join(s_dir,nm)
+                t_nm = os.path.join(t_dir,nm)
+                if self._tree.exists(s_nm):
+                    in_place[s_nm] = t_nm
+                elif self._tree.isfile(t_nm):
+                    new_items.append(t_nm)
+                    continue
+                elif self._tree.isdir(t_nm):
+                    sibnm = self._find_similar_sibling(s_dir,t_dir,nm,claimed)
+                    if sibnm is not None:
+                        claimed.add(sibnm)
+                        s_nm = os.path.join(s_dir,sibnm)
+                        self._reuse[t_nm] = (s_nm,MOVE_FROM,sibnm)
+                        self._gone.add(s_nm)
+                        in_place[s_nm] = t_nm
+                    else:
+                        base = similar.find_similar_dir(t_nm)
+                        if base is not None:
+                            new_items.append(t_nm)
+                            dir_bases[t_nm] = s_nm = base
+                if self._tree.isdir(t_nm):
+                    walk(s_nm,t_nm)
+        walk(source,target)
+        if not new_items:
+            return None
+        #  An item is stable if it's diffed in place against an identical
+        #  item at the same path; the walk will never touch it.
+        stable_cache = {}
+        def is_stable(s_nm):
+            try:
+                return stable_cache[s_nm]
+            except KeyError:
+                stable = False
+                t_nm = in_place.get(s_nm)
+                if t_nm is not None:
+                    if _relpath(s_nm,source) == _relpath(t_nm,target):
+                        stable = not self._tree.paths_differ(s_nm,t_nm)
+                stable_cache[s_nm] = stable
+                return stable
+        #  Find a base for each new file, preferring identical files to
+        #  merely similar ones.
+        index = _ContentIndex(source,self._tree)
+        uses = []
+        for t_nm in new_items:
+            if t_nm in dir_bases:
+                uses.append((t_nm,dir_bases[t_nm]))
+                continue
+            best = None
+            for s_nm in index.find_duplicates(t_nm):
+                if is_stable(s_nm):
+                    rank = 0
+                elif in_place.get(s_nm) is None:
+                    rank = 1
+                else:
+                    rank = 2
+                if os.path.basename(s_nm) != os.path.basename(t_nm):
+                    rank += 0.5
+                if best is None or rank < best[0]:
+                    best = (rank,s_nm)
+            if best is not None:
+                uses.append((t_nm,best[1]))
+            else:
+                s_nm = similar.find_similar_file(t_nm)
+                if s_nm is not None:
+                    uses.append((t_nm,s_nm))
+        if not uses:
+            return None
+        #  Stable items are copied directly from their current location.
+        #  Everything else gets stashed before the walk begins, deepest
+        #  paths first so that stashing an item doesn't move its children.
+        #  The last use of each stashed item moves it out of the stash.
+        stashnm = REUSE_STASH_NAME
+        i = 1
+        while self._tree.exists(os.path.join(source,stashnm)) or \
+              self._tree.exists(os.path.join(target,stashnm)):
+            i += 1
+            stashnm = "%s-%d" % (REUSE_STASH_NAME,i)
+        stashed = []
+        for (_,s_nm) in uses:
+            if not is_stable(s_nm) and s_nm not in stashed:
+                stashed.append(s_nm)
+        stashed.sort(key=lambda p: -p.count(os.sep))
+        entries = []
+        for s_nm in stashed:
+            relpath = _relpath(s_nm,source)
+            if in_place.get(s_nm) is None:
+                entries.append((MOVE_FROM,relpath))
+                self._gone.add(s_nm)
+            else:
+                entries.append((COPY_FROM,relpath))
+        last_use = {}
+        for (t_nm,s_nm) in uses:
+            last_use[s_nm] = t_nm
+        #  In a version 2 patch, the frames for top-level target items may
+        #  be applied concurrently.  Stashed items they share are copied out
+        #  of the stash, which is removed at the end.
+        if target == self._frame_root:
+            frames = {}
+            for (t_nm,s_nm) in uses:
+                top = _relpath(t_nm,target).split("/")[0]
+                frames.setdefault(s_nm,set()).add(top)
+            for (s_nm,tops) in frames.iteritems():
+                if len(tops) > 1:
+                    last_use[s_nm] = None
+        for (t_nm,s_nm) in uses:
+            t_dir = posixpath.dirname(_relpath(t_nm,target))
+            if is_stable(s_nm):
+                ref = posixpath.relpath(_relpath(s_nm,source),t_dir or ".")
+                self._reuse[t_nm] = (s_nm,COPY_FROM,ref)
+            else:
+                loc = "%s/%d" % (stashnm,stashed.index(s_nm))
+                ref = posixpath.relpath(loc,t_dir or ".")
+                if last_use[s_nm] == t_nm:
+                    self._reuse[t_nm] = (s_nm,MOVE_FROM,ref)
+                else:
+                    self._reuse[t_nm] = (s_nm,COPY_FROM,ref)
+        if not entries:
+            return None
+        return (stashnm,entries)
 
     def _diff(self,source,target):
         """Recursively generate patch commands to transform source into target.
@@ -768,9 +3265,9 @@ class Differ(object):
         generates the patch commands for a given (source,target) pair.  The
         main diff() method adds some header and footer commands.
         """
-        if os.path.isdir(target):
+        if self._tree.isdir(target):
             self._diff_dir(source,target)
-        elif os.path.isfile(target):
+        elif self._tree.isfile(target):
             self._diff_file(source,target)
         else:
             #  We can't deal with any other objects for the moment.
@@ -779,41 +3276,45 @@ class Differ(object):
 
     def _diff_dir(self,source,target):
         """Generate patch commands for when the target is a directory."""
-        if not os.path.isdir(source):
+        if not self._tree.isdir(source):
             self._write_command(MAKEDIR)
-        moved_sources = []
-        for nm in os.listdir(target):
+        framed = (target == self._frame_root)
+        for nm in self._tree.listdir(target):
+            if framed:
+                self._set_next_frame(FRAME_PARALLEL,nm)
             s_nm = os.path.join(source,nm)
             t_nm = os.path.join(target,nm)
-            #  If this is a new file or directory, try to find a promising
-            #  sibling against which to diff.  This might generate a few
-            #  spurious COPY_FROM and REMOVE commands, but in return we
-            #  get a better chance of diffing against something.
+            #  If this is a new file or directory, diff against whatever
+            #  existing item was selected by _plan_reuse().  This might
+            #  generate a few spurious COPY_FROM and REMOVE commands, but in
+            #  return we get a better chance of diffing against something.
             at_path = False
-            if not os.path.exists(s_nm):
-                sibnm = self._find_similar_sibling(source,target,nm)
-                if sibnm is not None:
-                    s_nm = os.path.join(source,sibnm)
-                    at_path = True
+            reused = False
+            if not self._tree.exists(s_nm):
+                reuse = self._reuse.get(t_nm)
+                if reuse is not None:
+                    (s_nm,cmd,ref) = reuse
+                    at_path = reused = True
                     self._write_command(JOIN_PATH)
                     self._write_path(nm)
-                    if os.path.exists(os.path.join(target,sibnm)):
-                        self._write_command(COPY_FROM)
-                    else:
-                        self._write_command(MOVE_FROM)
-                        moved_sources.append(sibnm)
-                    self._write_path(sibnm)
+                    self._write_command(cmd)
+                    self._write_path(ref)
             #  Recursively diff against the selected source directory
-            if paths_differ(s_nm,t_nm):
+            if self._tree.paths_differ(s_nm,t_nm):
                 if not at_path:
                     self._write_command(JOIN_PATH)
                     self._write_path(nm)
                     at_path = True
                 self._diff(s_nm,t_nm)
+            elif reused:
+                t_mod = self._tree.stat(t_nm).st_mode
+                if self._tree.stat(s_nm).st_mode != t_mod:
+                    self._write_command(CHMOD)
+                    self._write_int(t_mod)
             #  Clean up .pyc files, as they can be generated automatically
             #  and cause digest verification to fail.
             if nm.endswith(".py"):
-                if not os.path.exists(t_nm+"c"):
+                if not self._tree.exists(t_nm+"c"):
                     if at_path:
                         self._write_command(POP_JOIN_PATH)
                     else:
@@ -821,7 +3322,7 @@ class Differ(object):
                     self._write_path(nm+"c")
                     at_path = True
                     self._write_command(REMOVE)
-                if not os.path.exists(t_nm+"o"):
+                if not self._tree.exists(t_nm+"o"):
                     if at_path:
                         self._write_command(POP_JOIN_PATH)
                     else:
@@ -831,19 +3332,21 @@ class Differ(object):
                     self._write_command(REMOVE)
             if at_path:
                 self._write_command(POP_PATH)
+        if framed:
+            self._set_next_frame(FRAME_SERIAL)
         #  Remove anything that's no longer in the target dir
-        if os.path.isdir(source):
-            for nm in os.listdir(source):
-                if not os.path.exists(os.path.join(target,nm)):
-                    if not nm in moved_sources:
+        if self._tree.isdir(source):
+            for nm in self._tree.listdir(source):
+                if not self._tree.exists(os.path.join(target,nm)):
+                    if os.path.join(source,nm) not in self._gone:
                         self._write_command(JOIN_PATH)
                         self._write_path(nm)
                         self._write_command(REMOVE)
                         self._write_command(POP_PATH)
         #  Adjust mode if necessary
-        t_mod = os.stat(target).st_mode
-        if os.path.isdir(source):
-            s_mod = os.stat(source).st_mode
+        t_mod = self._tree.stat(target).st_mode
+        if self._tree.isdir(source):
+            s_mod = self._tree.stat(source).st_mode
             if s_mod != t_mod:
                 self._write_command(CHMOD)
                 self._write_int(t_mod)
@@ -853,17 +3356,18 @@ class Differ(object):
 
     def _diff_file(self,source,target):
         """Generate patch commands for when the target is a file."""
-        if paths_differ(source,target):
-            if not os.path.isfile(source):
-                self._diff_binary_file(source,target)
-            elif target.endswith(".zip") and source.endswith(".zip"):
-                self._diff_dotzip_file(source,target)
+        if self._tree.paths_differ(source,target):
+            #  Big files are diffed in-process, with their individual windows
+            #  farmed out to the worker pool; see _diff_binary_file().
+            size = self._tree.getsize(target)
+            if self._pool is not None and size <= 2 * self.diff_window_size:
+                self._submit_to_pool(_diff_file_job,source,target)
             else:
-                self._diff_binary_file(source,target)
+                self._diff_file_contents(source,target)
         #  Adjust mode if necessary
-        t_mod = os.stat(target).st_mode
-        if os.path.isfile(source):
-            s_mod = os.stat(source).st_mode
+        t_mod = self._tree.stat(target).st_mode
+        if self._tree.isfile(source):
+            s_mod = self._tree.stat(source).st_mode
             if s_mod != t_mod:
                 self._write_command(CHMOD)
                 self._write_int(t_mod)
@@ -871,6 +3375,148 @@ class Differ(object):
             self._write_command(CHMOD)
             self._write_int(t_mod)
 
+    def _diff_file_contents(self,source,target):
+        """Generate PF_* commands to transform contents of source into target.
+
+        This is the part of _diff_file() that can be farmed out to a worker
+        process; it never leaves a POP_PATH command pending.
+        """
+        if not self._tree.isfile(source):
+            self._diff_binary_file(source,target)
+        elif target.endswith(".zip") and source.endswith(".zip"):
+            self._diff_dotzip_file(source,target)
+        elif target.endswith(_PYC_EXTENSIONS) and \
+             source.endswith(_PYC_EXTENSIONS):
+            self._diff_pyc_file(source,target)
+        else:
+            fmt = self._get_compressed_format(target)
+            if fmt is not None:
+                self._diff_compressed_file(source,target,fmt)
+            elif self.transform_executables:
+                self._diff_executable_file(source,target)
+            else:
+                self._diff_binary_file(source,target)
+
+    def _get_compressed_format(self,path):
+        """Get the _CompressedFormat for the given path, if any.
+
+        The format is chosen by file extension.  Since the Patcher needs
+        lzma to recompress xz files, they're only recognised if lzma is
+        one of the codecs in use.
+        """
+        for fmt in _COMPRESSED_FORMATS:
+            if path.endswith(fmt.extensions):
+                if fmt.name == "xz" and "lzma" not in self.codecs:
+                    return None
+                return fmt
+        return None
+
+    def _diff_executable_file(self,source,target):
+        """Diff a file that may be an x86 executable or shared library.
+
+        If both files are x86 or x86_64 ELF files, the branches in their
+        machine code are transformed to have absolute targets and the
+        results are diffed inside a PF_REC_X86 command.  Branch targets
+        shift all over the place when a binary is rebuilt, and this makes
+        most of those shifts disappear.  If the files aren't ELF, or the
+        transform can't be reversed to give the target exactly, they are
+        diffed as binaries.
+        """
+        s_ranges = _x86_code_ranges(source)
+        t_ranges = s_ranges and _x86_code_ranges(target)
+        if not t_ranges:
+            self._diff_binary_file(source,target)
+            return
+        with _tempdir() as workdir:
+            s_code = os.path.join(workdir,"source")
+            t_code = os.path.join(workdir,"target")
+            for (path,code,ranges) in ((source,s_code,s_ranges),
+                                       (target,t_code,t_ranges)):
+                with open(path,"rb") as fin:
+                    with open(code,"wb") as fout:
+                        _x86_transform_file(fin,fout,ranges,True)
+            try:
+                with open(t_code,"rb") as fin:
+                    with open(target,"rb") as f:
+                        out = _CompareWriter(f)
+                        _x86_transform_file(fin,out,t_ranges,False)
+                        out.finish()
+            except _Mismatch:
+                self._diff_binary_file(source,target)
+                return
+            self._write_command(PF_REC_X86)
+            for ranges in (s_ranges,t_ranges):
+                self._write_int(len(ranges))
+                for (offset,size) in ranges:
+                    self._write_int(offset)
+                    self._write_int(size)
+            self._diff_binary_file(s_code,t_code)
+            self._drain_pool()
+            self._write_command(END)
+
+    def _diff_pyc_file(self,source,target):
+        """Diff a pair of compiled python modules.
+
+        Rebuilding an unchanged module changes the timestamp in its header
+        and, if it was built in a different directory, the source filename
+        stored in each of its code objects.  If both files are modules
+        compiled by this version of python, the target header and filename
+        are written in a PF_REC_PYC command and only the remaining bodies
+        of the modules are diffed.  Otherwise they are diffed as binaries.
+        """
+        with open(source,"rb") as f:
+            s_data = f.read()
+        with open(target,"rb") as f:
+            t_data = f.read()
+        try:
+            s_body = _pyc_split(s_data)[2]
+            (header,filename,t_body) = _pyc_split(t_data)
+            #  Check the target is rebuilt exactly.  This uses a copy of
+            #  the filename, since marshal treats interned strings specially
+            #  and the one read by the Patcher won't be interned.
+            if _pyc_join(header,bytes(bytearray(filename)),t_body) != t_data:
+                raise ValueError("module can't be rebuilt")
+        except ValueError:
+            self._diff_binary_file(source,target)
+            return
+        self._write_command(PF_REC_PYC)
+        self._write_bytes(header)
+        self._write_bytes(filename)
+        if s_body != t_body:
+            with _tempdir() as workdir:
+                s_payload = os.path.join(workdir,"source")
+                t_payload = os.path.join(workdir,"target")
+                for (path,body) in ((s_payload,s_body),(t_payload,t_body)):
+                    with open(path,"wb") as f:
+                        f.write(body)
+                self._diff_binary_file(s_payload,t_payload)
+                self._drain_pool()
+        self._write_command(END)
+
+    def _diff_compressed_file(self,source,target,fmt):
+        """Diff a file in a single-file compression format such as gzip.
+
+        If the target can be recreated exactly by compressing its contents,
+        the decompressed contents of the two files are diffed inside a
+        PF_REC_COMPRESSED command.  Otherwise, the files are diffed as
+        binaries.
+        """
+        with _tempdir() as workdir:
+            s_payload = os.path.join(workdir,"source")
+            t_payload = os.path.join(workdir,"target")
+            found = _find_compression(fmt,source,target,s_payload,t_payload)
+            if found is None:
+                self._diff_binary_file(source,target)
+            else:
+                (level,params) = found
+                self._write_command(PF_REC_COMPRESSED)
+                self._write_int(_COMPRESSED_FORMATS.index(fmt))
+                self._write_int(level)
+                self._write_bytes(params)
+                self._diff_binary_file(s_payload,t_payload)
+                self._drain_pool()
+                self._write_command(END)
+
     def _open_and_check_zipfile(self,path):
         """Open the given path as a zipfile, and check its suitability.
 
@@ -886,16 +3532,40 @@ class Differ(object):
             if not zf.filelist:
                 zf.close()
                 return None
-            # Can't currently handle zipfiles with comments
-            if zf.comment:
-                zf.close()
-                return None
-            # Can't currently handle zipfiles with prepended data
-            if zf.filelist[0].header_offset != 0:
-                zf.close()
-                return None
             # Hooray! Looks like something we can use.
             return zf
+
+    def _check_zipfile_layout(self,path,zf):
+        """Check whether the layout of a target zipfile can be recreated.
+
+        This returns the result of _zipfile_layout(), or None if the Patcher
+        would not recreate the zipfile exactly.  For zipfiles needing the
+        PF_REC_ZIP_EXT command, which are generally not written by esky,
+        this is checked by rebuilding the zipfile from its own members.
+        """
+        layout = _zipfile_layout(path,zf)
+        if layout is None or not layout[0]:
+            return layout
+        with _tempdir() as workdir:
+            meta = BytesIO()
+            _write_zipfile_metadata(meta,zf)
+            zfmeta = _read_zipfile_metadata(BytesIO(meta.getvalue()))
+            contents = _LazyZipContents(path,os.path.join(workdir,"contents"))
+            try:
+                digest = stream = _DigestWriter()
+                preamble = os.path.join(workdir,"preamble")
+                _copy_zipfile_preamble(path,zf,preamble)
+                with open(preamble,"rb") as f:
+                    shutil.copyfileobj(f,stream)
+                if layout[1] & ZIP_RELATIVE_OFFSETS:
+                    stream = _OffsetWriter(stream,stream.tell())
+                contents.write_zipfile(stream,zfmeta.infolist(),zfmeta.comment)
+            finally:
+                contents.close()
+                zfmeta.close()
+        if digest.digest() != self._tree.digest(path):
+            return None
+        return layout
       
     def _diff_dotzip_file(self,source,target):
         s_zf = self._open_and_check_zipfile(source)
@@ -903,13 +3573,32 @@ class Differ(object):
             self._diff_binary_file(source,target)
         else:
             t_zf = self._open_and_check_zipfile(target)
+            if t_zf is not None:
+                layout = self._check_zipfile_layout(target,t_zf)
+                if layout is None:
+                    t_zf.close()
+                    t_zf = None
             if t_zf is None:
                 s_zf.close()
                 self._diff_binary_file(source,target)
             else:
                 try:
-                    self._write_command(PF_REC_ZIP)
+                    (extended,flags) = layout
+                    if extended:
+                        self._write_command(PF_REC_ZIP_EXT)
+                        self._write_int(flags)
+                    else:
+                        self._write_command(PF_REC_ZIP)
                     with _tempdir() as workdir:
+                        #  Write commands to transform any data prepended
+                        #  to the source into that prepended to the target.
+                        if extended:
+                            s_pre = os.path.join(workdir,"s_pre")
+                            _copy_zipfile_preamble(source,s_zf,s_pre)
+                            t_pre = os.path.join(workdir,"t_pre")
+                            _copy_zipfile_preamble(target,t_zf,t_pre)
+                            self._diff_binary_file(s_pre,t_pre)
+                            self._write_command(END)
                         #  Write commands to transform source metadata file
                         #  into target metadata file.
                         s_meta = os.path.join(workdir,"s_meta")
@@ -922,11 +3611,17 @@ class Differ(object):
                         self._write_command(END)
                         #  Write commands to transform source contents
                         #  directory into target contents directory.
+                        #  Only the members that might matter are extracted.
                         s_workdir = os.path.join(workdir,"source")
                         t_workdir = os.path.join(workdir,"target")
-                        extract_zipfile(source,s_workdir)
-                        extract_zipfile(target,t_workdir)
-                        self._diff(s_workdir,t_workdir)
+                        names = _changed_zipfile_members(s_zf,t_zf)
+                        _extract_zipfile_members(source,s_zf,s_workdir,names)
+                        _extract_zipfile_members(target,t_zf,t_workdir,names)
+                        try:
+                            self._diff_tree(s_workdir,t_workdir)
+                            self._drain_pool()
+                        finally:
+                            self._tree.forget(workdir)
                         self._write_command(END)
                 finally:
                     t_zf.close() 
@@ -938,81 +3633,362 @@ class Differ(object):
 
         This is the per-file diffing method used when we don't know enough
         about the file to do anything fancier.  It's basically a windowed
-        bsdiff.
+        bsdiff.  For large files, runs of data that have moved to a different
+        offset are found using a _BlockMatcher and copied directly, so that
+        the bsdiff windows don't get out of alignment.
+
+        If self.adaptive_windows is true, each target window is diffed against
+        the source window indicated by the matcher's anchors rather than the
+        source data at the same offset; see _choose_source_window().
+
+        If there's a pool of worker processes, the windows are planned here
+        but encoded by the workers, and their output written in order.  The
+        position of the source pointer at the start of each window is part
+        of the plan, so the patch is the same as one encoded in-process.
         """
         spos = 0
         tfile = open(target,"rb")
+        tsize = os.path.getsize(target)
         if os.path.isfile(source):
             sfile = open(source,"rb")
+            ssize = os.path.getsize(source)
         else:
             sfile = None
+            ssize = 0
+        matcher = None
         try:
+            if sfile is not None:
+                if os.path.getsize(source) >= BLOCK_MATCH_MIN_SIZE:
+                    matcher = _BlockMatcher(sfile)
+            sread = _file_reader(sfile)
             #  Process the file in diff_window_size blocks.  This
             #  will produce slightly bigger patches but we avoid
             #  running out of memory for large files.
+            toff = 0
             tdata = tfile.read(self.diff_window_size)
             if not tdata:
                 #  The file is empty, do a raw insert of zero bytes.
                 self._write_command(PF_INS_RAW)
                 self._write_bytes("".encode("ascii"))
             else:
+                hint = None
                 while tdata:
-                    sdata = ""
-                    if sfile is not None:
-                        sdata = sfile.read(self.diff_window_size)
-                    #  Look for a shared prefix.
-                    i = 0; maxi = min(len(tdata),len(sdata))
-                    while i < maxi and tdata[i] == sdata[i]:
-                        i += 1
-                    #  Copy it in directly, unless it's tiny.
+                    #  By default, diff against the source data at the
+                    #  same offset, after copying any shared prefix.  The
+                    #  final window takes the rest of the source if it can,
+                    #  so that the files' shared suffix can be copied.
+                    soff = toff
+                    slen = len(tdata)
+                    if toff + len(tdata) >= tsize:
+                        budget = 2 * self.diff_window_size - len(tdata)
+                        slen = max(slen,min(ssize - soff,budget))
+                    sdata = sread(soff,slen)
+                    i = _common_prefix_size(tdata,0,sdata,0,len(sdata))
+                    #  If the matcher found runs of moved data, use them
+                    #  instead unless that gives a bigger patch.
+                    matches = []
+                    rest = None
+                    if matcher is not None and i < len(tdata):
+                        matches = matcher.find_matches(tdata,toff,hint)
+                        if self.adaptive_windows:
+                            (soff,slen,tlen) = self._choose_source_window(
+                                                      matcher,toff,tdata)
+                            #  Don't split a run across two windows.
+                            for (t_idx,_,length) in matches:
+                                if t_idx < tlen < t_idx + length:
+                                    tlen = t_idx + length
+                            if tlen < len(tdata):
+                                rest = tdata[tlen:]
+                                tdata = tdata[:tlen]
+                                matches = [m for m in matches if m[0] < tlen]
+                            slen = min(slen,2*self.diff_window_size - tlen)
+                            sdata = sread(soff,slen)
+                            i = _common_prefix_size(tdata,0,sdata,0,len(sdata))
                     if i > 8:
-                        skipbytes = sfile.tell() - len(sdata) - spos
-                        if skipbytes > 0:
-                            self._write_command(PF_SKIP)
-                            self._write_int(skipbytes)
-                            spos += skipbytes
-                        self._write_command(PF_COPY)
-                        self._write_int(i)
-                        tdata = tdata[i:]; sdata = sdata[i:]
-                        spos += i
-                    #  Write the rest of the block as a diff
-                    if tdata:
-                        spos += self._write_file_patch(sdata,tdata)
-                    tdata = tfile.read(self.diff_window_size)
+                        default = [(0,soff,i)]
+                    else:
+                        default = []
+                    #  Unless this is the last window, it leaves the source
+                    #  pointer at the end of its source data.  So each
+                    #  window's starting position is known when it's planned,
+                    #  and it's encoded the same way in-process or by a worker.
+                    end = None
+                    if toff + len(tdata) < tsize:
+                        end = soff + len(sdata)
+                    #  Windows that are entirely copied from the source are
+                    #  cheap to write, so we don't farm those out.
+                    covered = False
+                    for m in (matches,default):
+                        if sum(length for (_,_,length) in m) == len(tdata):
+                            covered = True
+                    if self._pool is not None and not covered:
+                        window = (toff,len(tdata),soff,len(sdata),
+                                  matches,default,spos,end)
+                        self._submit_to_pool(_diff_window_job,source,target,
+                                             window)
+                    else:
+                        self._write_window(spos,sread,soff,tdata,sdata,
+                                           matches,default,end)
+                    spos = end
+                    #  If the window ended in the middle of a run, try to
+                    #  continue it at the start of the next window.  This
+                    #  uses the planned matches rather than those chosen by
+                    #  the encoding, so that planning doesn't wait for it.
+                    matches = matches or default
+                    hint = None
+                    if matches:
+                        (t_idx,s_off,length) = matches[-1]
+                        if t_idx + length == len(tdata):
+                            hint = s_off + length
+                    toff += len(tdata)
+                    if rest is None:
+                        tdata = tfile.read(self.diff_window_size)
+                    else:
+                        size = self.diff_window_size - len(rest)
+                        tdata = rest + tfile.read(size)
         finally:
+            if matcher is not None:
+                matcher.close()
             tfile.close()
             if sfile:
                 sfile.close()
 
-    def _find_similar_sibling(self,source,target,nm):
+    def _write_window(self,spos,sread,soff,tdata,sdata,matches,default,
+                      end=None):
+        """Write commands for a window of target data.
+
+        The window is encoded using both the runs of moved data found by the
+        block matcher and the default lockstep diff, and the smaller result
+        is written.  If 'end' is not None, the source pointer is then moved
+        to that position.  Returns a tuple giving the new source pointer
+        position and the list of matches that was used.
+        """
+        if not matches:
+            spos = self._write_matched_window(spos,sread,soff,
+                                              tdata,sdata,default)
+            return (self._write_window_end(spos,end),default)
+        candidates = []
+        for m in (matches,default):
+            (new_spos,output) = self._capture(
+                self._write_matched_window,spos,sread,soff,tdata,sdata,m
+            )
+            candidates.append((len(output),new_spos,output,m))
+            if sum(length for (_,_,length) in m) == len(tdata):
+                break
+        candidates.sort(key=lambda c: c[0])
+        (_,spos,output,matches) = candidates[0]
+        self.outfile.write_parts(*output.parts())
+        return (self._write_window_end(spos,end),matches)
+
+    def _write_window_end(self,spos,end):
+        """Move the source pointer to 'end' at the end of a window, if needed."""
+        if end is None or spos == end:
+            return spos
+        if spos is None or end < spos:
+            self._write_command(PF_SEEK)
+            self._write_int(end)
+        else:
+            self._write_command(PF_SKIP)
+            self._write_int(end - spos)
+        return end
+
+    def _choose_source_window(self,matcher,toff,tdata):
+        """Choose the source window against which to diff a target window.
+
+        Each anchor found by the matcher says that some target index lines
+        up with some source offset, i.e. that the window is displaced by
+        a particular amount relative to the source.  The source window is
+        chosen to cover the displacements seen for the target window.
+
+        The source and target windows together may not exceed twice the
+        diff_window_size, which is the most we'd use in lockstep mode.  If
+        the displacements are spread too widely, the target window is shrunk
+        to make room for a bigger source window; failing that, the densest
+        cluster of displacements is used.  Returns a tuple (source offset,
+        source size, target size).
+        """
+        budget = 2 * self.diff_window_size
+        anchors = matcher.find_anchors(tdata)
+        if not anchors:
+            return (toff,len(tdata),len(tdata))
+        tlen = len(tdata)
+        while True:
+            deltas = sorted(s - t for (t,s) in anchors if t < tlen)
+            spread = budget - 2 * tlen
+            if deltas[-1] - deltas[0] <= spread:
+                break
+            if tlen <= self.diff_window_size // 4 or anchors[0][0] >= tlen//2:
+                break
+            tlen //= 2
+        #  Find the densest cluster of displacements that fits the budget.
+        (lo,hi) = (0,0)
+        j = 0
+        for i in xrange(len(deltas)):
+            while j + 1 < len(deltas) and deltas[j+1] - deltas[i] <= spread:
+                j += 1
+            if j - i > hi - lo:
+                (lo,hi) = (i,j)
+        soff = max(0,deltas[lo])
+        return (soff,deltas[hi] + tlen - soff,tlen)
+
+    def _capture(self,func,*args):
+        """Call the given function, capturing the commands it writes.
+
+        Returns a tuple giving the function's return value and a
+        _CommandWriter holding the commands it wrote.
+        """
+        outfile = self.outfile
+        self.outfile = _CommandWriter()
+        try:
+            result = func(*args)
+            return (result,self.outfile)
+        finally:
+            self.outfile = outfile
+
+    def _write_matched_window(self,spos,sread,soff,tdata,sdata,matches):
+        """Write commands for a window of target data, given known matches.
+
+        Each match is a tuple (target index, source offset, length) giving a
+        run of target data to be copied from the source.  The gaps between
+        matches are diffed against the source data between the neighbouring
+        matches, or against the corresponding data in 'sdata' (which is found
+        at offset 'soff' in the source) if there is no such neighbour.
+        Returns the new source pointer position.
+
+        The data is handled via memoryview slices, so the only copies made
+        are of the data that's actually handed to a compressor.
+        """
+        tdata = memoryview(tdata)
+        sdata = memoryview(sdata)
+        tpos = 0
+        prev_s = soff
+        for (t_idx,s_off,length) in matches:
+            if t_idx > tpos:
+                spos = self._write_gap(spos,sread,prev_s,s_off,tdata[tpos:t_idx])
+            spos = self._write_copy(spos,s_off,length)
+            tpos = t_idx + length
+            prev_s = s_off + length
+        if tpos < len(tdata):
+            if soff <= prev_s <= soff + len(sdata):
+                gap_sdata = sdata[prev_s - soff:]
+                spos = self._write_data(spos,prev_s,gap_sdata,tdata[tpos:])
+            else:
+                spos = self._write_gap(spos,sread,prev_s,None,tdata[tpos:])
+        return spos
+
+    def _write_gap(self,spos,sread,s_start,s_end,tdata):
+        """Write commands to generate data from a gap between two matches.
+
+        The gap is diffed against the source data between s_start and s_end
+        if that's a sensibly-sized range, otherwise against the same amount of
+        data as the gap starting at s_start.
+        """
+        size = len(tdata)
+        if s_end is None or s_end < s_start or s_end - s_start > size * 2:
+            s_end = s_start + size
+        return self._write_data(spos,s_start,sread(s_start,s_end-s_start),tdata)
+
+    def _write_copy(self,spos,offset,length):
+        """Write commands to copy data from the given offset in the source.
+
+        Data ahead of the source pointer is copied with PF_SKIP and PF_COPY;
+        anything behind it must use PF_COPY_AT.  If the position of the
+        source pointer is unknown (i.e. spos is None) then it's first moved
+        with PF_SEEK.  Returns the new source pointer position.
+        """
+        if spos is None:
+            self._write_command(PF_SEEK)
+            self._write_int(offset)
+            spos = offset
+        if offset < spos:
+            self._write_command(PF_COPY_AT)
+            self._write_int(offset)
+            self._write_int(length)
+            return spos
+        if offset > spos:
+            self._write_command(PF_SKIP)
+            self._write_int(offset - spos)
+        self._write_command(PF_COPY)
+        self._write_int(length)
+        return offset + length
+
+    def _write_data(self,spos,offset,sdata,tdata):
+        """Write commands to generate tdata, diffed against sdata if possible.
+
+        The argument 'offset' gives the position of sdata in the source file;
+        if the chosen command reads from the source, the source pointer is
+        first moved to that position.  Returns the new source pointer
+        position.
+
+        Any prefix or suffix shared by the two strings is copied directly,
+        so only the differing middle section is passed on for diffing.
+        """
+        tdata = memoryview(tdata)
+        sdata = memoryview(sdata)
+        prefix = _common_prefix_size(tdata,0,sdata,0,len(tdata))
+        if prefix <= 8:
+            prefix = 0
+        maxsize = min(len(tdata),len(sdata)) - prefix
+        suffix = _common_suffix_size(tdata,len(tdata),sdata,len(sdata),maxsize)
+        if suffix <= 8:
+            suffix = 0
+        if prefix:
+            spos = self._write_copy(spos,offset,prefix)
+        if prefix + suffix < len(tdata) or not (prefix or suffix):
+            sdata_mid = sdata[prefix:len(sdata)-suffix].tobytes()
+            tdata_mid = tdata[prefix:len(tdata)-suffix].tobytes()
+            spos = self._write_data_option(spos,offset+prefix,
+                                           sdata_mid,tdata_mid)
+        if suffix:
+            spos = self._write_copy(spos,offset+len(sdata)-suffix,suffix)
+        return spos
+
+    def _write_data_option(self,spos,offset,sdata,tdata):
+        """Write the best command to generate tdata from sdata at 'offset'."""
+        option = self._choose_file_patch(sdata,tdata)
+        if option[0]:
+            if spos is None or offset < spos:
+                self._write_command(PF_SEEK)
+                self._write_int(offset)
+            elif offset > spos:
+                self._write_command(PF_SKIP)
+                self._write_int(offset - spos)
+            spos = offset + option[0]
+        self._write_file_patch_option(option)
+        return spos
+
+    def _find_similar_sibling(self,source,target,nm,exclude=()):
         """Find a sibling of an entry against which we can calculate a diff.
 
         Given two directories 'source' and 'target' and an entry from the target
         directory 'nm', this function finds an entry from the source directory
-        that we can diff against to produce 'nm'.
+        that we can diff against to produce 'nm'.  Names in 'exclude' have
+        already been claimed by another entry and will not be considered.
 
         The idea here is to detect files or directories that have been moved,
         and avoid generating huge patches by diffing against the original.
         We use some pretty simple heuristics but it can make a big difference.
         """
         t_nm = os.path.join(target,nm)
-        if os.path.isfile(t_nm):
+        if self._tree.isfile(t_nm):
              # For files, I haven't decided on a god heuristic yet...
             return None
-        elif os.path.isdir(t_nm):
+        elif self._tree.isdir(t_nm):
             #  For directories, decide similarity based on the number of
             #  entry names they have in common.  This is very simple but should
             #  work well for the use cases we're facing in esky.
-            if not os.path.isdir(source):
+            if not self._tree.isdir(source):
                 return None
-            t_names = set(os.listdir(t_nm))
+            t_names = set(self._tree.listdir(t_nm))
             best = (2,None)
-            for sibnm in os.listdir(source):
-                if not os.path.isdir(os.path.join(source,sibnm)):
+            for sibnm in self._tree.listdir(source):
+                if not self._tree.isdir(os.path.join(source,sibnm)):
+                    continue
+                if self._tree.exists(os.path.join(target,sibnm)):
                     continue
-                if os.path.exists(os.path.join(target,sibnm)):
+                if sibnm in exclude:
                     continue
-                sib_names = set(os.listdir(os.path.join(source,sibnm)))
+                sib_names = set(self._tree.listdir(os.path.join(source,sibnm)))
                 cur = (len(sib_names & t_names),sibnm)
                 if cur > best:
                     best = cur
@@ -1026,27 +4002,624 @@ class Differ(object):
         This function tries the various PF_* commands to find the one which can
         generate tdata from sdata with the smallest command size.  Usually that
         will be BSDIFF4, but you never know :-)
+
+        Returns the number of bytes of sdata consumed by the commands.
+        """
+        option = self._choose_file_patch(sdata,tdata)
+        self._write_file_patch_option(option)
+        return option[0]
+
+    def _choose_file_patch(self,sdata,tdata):
+        """Choose the PF_* command to use for generating tdata from sdata.
+
+        The result is a tuple whose first item is the number of bytes of sdata
+        consumed by the command, followed by the command and its arguments.
+
+        Inserts and bsdiff patches are tried with the codecs chosen by
+        _choose_encoders().  If self.objective is "size" the smallest option
+        is chosen; if it's "speed" the option that's cheapest to decode is
+        chosen from those not much bigger than the smallest.
+
+        If self.solid is true, small inserts are instead made with a
+        PF_INS_SOLID command, whose data goes into the solid block.  It
+        will compress at least as well there as it does on its own, so it's
+        given the size and cost of the best of the other inserts.
         """
+        (ins_codecs,bsdiff_codecs) = self._choose_encoders(sdata,tdata)
         options = []
         #  We could just include the raw data
-        options.append((0,PF_INS_RAW,tdata))
-        #  We could bzip2 the raw data
-        options.append((0,PF_INS_BZ2,bz2.compress(tdata)))
-        #  We could bsdiff4 the data, if we have cx-bsdiff installed
-        if cx_bsdiff is not None:
-            # remove the 8 header bytes, we know it's BSDIFF4 format
-           options.append((len(sdata),PF_BSDIFF4,len(sdata),bsdiff4_diff(sdata,tdata)[8:]))
-        #  Find the option with the smallest data and use that.
-        options = [(len(cmd[-1]),cmd) for cmd in options]
-        options.sort()
-        best_option = options[0][1]
-        self._write_command(best_option[1])
-        for arg in best_option[2:]:
+        options.append((0,(0,PF_INS_RAW,tdata)))
+        #  We could compress the raw data
+        for nm in ins_codecs:
+            codec = _CODECS[nm]
+            cost = codec.decode_cost * len(tdata)
+            data = codec.compress(tdata)
+            options.append((cost,(0,codec.ins_command,data)))
+        #  We could bsdiff4 the data
+        if bsdiff_codecs:
+            blocks = bsdiff4_blocks(sdata,tdata)
+            for nm in bsdiff_codecs:
+                codec = _CODECS[nm]
+                cost = (codec.decode_cost + _BSDIFF_DECODE_COST) * len(tdata)
+                # remove the 8 header bytes, we know it's BSDIFF4 format
+                patch = bsdiff4_encode(blocks,len(tdata),codec.compress)[8:]
+                cmd = (len(sdata),codec.bsdiff_command,len(sdata),patch)
+                options.append((cost,cmd))
+        #  Find the option with the smallest data.  If we're optimising
+        #  for speed, use the cheapest of those that are nearly as small.
+        options = [(len(cmd[-1]),cost,cmd) for (cost,cmd) in options]
+        options.sort(key=lambda o: o[:2])
+        if self.solid and len(tdata) <= SOLID_MAX_INSERT:
+            for (i,(size,cost,cmd)) in enumerate(options):
+                if cmd[0] == 0:
+                    options[i] = (size,cost,(0,PF_INS_SOLID,tdata,size))
+                    break
+        if self.objective == "speed":
+            limit = options[0][0] * DECODE_SPEED_SLACK + 64
+            options = [o for o in options if o[0] <= limit]
+            options.sort(key=lambda o: (o[1],o[0]))
+        return options[0][2]
+
+    def _choose_encoders(self,sdata,tdata):
+        """Choose which encoders are worth trying for the given data.
+
+        Returns a tuple (insert codecs, bsdiff codecs).  There's no point
+        trying bsdiff without any source data, e.g. when data is appended
+        to a file.  Unless self.effort is "best", a few samples of the data
+        are used to skip encoders that are unlikely to win:
+
+            * if the target looks incompressible, don't compress inserts.
+            * if the target has the same length as the source and few
+              changes, bsdiff will win so don't compress inserts.
+            * if the target seems unrelated to the source, don't bsdiff.
+
+        At "fast" effort only the first codec is used, and bsdiff is only
+        tried if the data is clearly related.  Nor is bsdiff tried if it
+        would need the pure-python fallback and BSDIFF_FALLBACK is false.
+        """
+        codecs = self.codecs
+        if not sdata or not tdata:
+            return (codecs,())
+        if cx_bsdiff is None and not BSDIFF_FALLBACK:
+            return (codecs,())
+        if self.effort == "best":
+            return (codecs,codecs)
+        if self.effort == "fast":
+            codecs = codecs[:1]
+        ins_codecs = bsdiff_codecs = codecs
+        (found,same) = _sample_similarity(sdata,tdata)
+        if same >= 0.9 or _looks_incompressible(tdata):
+            ins_codecs = ()
+        if self.effort == "fast":
+            if found < 0.25:
+                bsdiff_codecs = ()
+        elif found == 0:
+            bsdiff_codecs = ()
+        return (ins_codecs,bsdiff_codecs)
+
+    def _write_file_patch_option(self,option):
+        """Write a PF_* command chosen by _choose_file_patch()."""
+        if option[1] == PF_INS_SOLID:
+            #  The data must be added to the solid block before the command,
+            #  and within the frame in which the command is written.
+            (_,cmd,data,size) = option
+            if self._next_frame is not None:
+                self._begin_frame()
+            self.outfile.write_solid(data,size)
+            self._write_command(PF_INS_SOLID)
+            self._write_int(len(data))
+            return
+        self._write_command(option[1])
+        for arg in option[2:]:
             if isinstance(arg,(str,unicode,bytes)):
                 self._write_bytes(arg)
             else:
                 self._write_int(arg)
-        return best_option[0]
+
+
+def _diff_file_job(kwds,source,target):
+    """Diff the contents of a single file, returning the generated commands.
+
+    This is the function executed by worker processes when the Differ is
+    given more than one worker; it must live at module level so that it
+    can be pickled.
+    """
+    differ = Differ(None,**kwds)
+    differ._diff_file_contents(source,target)
+    return differ.outfile.parts()
+
+
+def _diff_window_job(kwds,source,target,window):
+    """Encode a single window of a big file, returning the generated commands.
+
+    This is the function executed by worker processes to diff the windows
+    of a big file in parallel.  The window is a tuple (target offset, target
+    size, source offset, source size, matches, default matches, starting
+    source pointer position, ending source pointer position) as planned
+    by Differ._diff_binary_file().
+    """
+    (toff,tlen,soff,slen,matches,default,spos,end) = window
+    differ = Differ(None,**kwds)
+    with open(target,"rb") as tfile:
+        tfile.seek(toff)
+        tdata = tfile.read(tlen)
+    if os.path.isfile(source):
+        sfile = open(source,"rb")
+    else:
+        sfile = None
+    try:
+        sread = _file_reader(sfile)
+        sdata = sread(soff,slen)
+        differ._write_window(spos,sread,soff,tdata,sdata,matches,default,end)
+    finally:
+        if sfile is not None:
+            sfile.close()
+    return differ.outfile.parts()
+
+
+def _file_reader(f):
+    """Get a function reading a given number of bytes at an offset in f.
+
+    If f is None, it behaves as though f were empty.
+    """
+    def read(offset,size):
+        if f is None or size <= 0:
+            return "".encode("ascii")
+        f.seek(offset)
+        return f.read(size)
+    return read
+
+
+class _ContentIndex(object):
+    """Index of the files in a source tree, by size and content digest.
+
+    The tree is only walked when the index is first queried, and digests
+    are calculated lazily for files whose size matches a query.
+    """
+
+    def __init__(self,root,snapshot=None):
+        self.root = root
+        if snapshot is None:
+            snapshot = TreeSnapshot()
+        self.snapshot = snapshot
+        self._by_size = None
+
+    def _build(self):
+        self._by_size = {}
+        for (dirpath,dirnames,filenames) in self.snapshot.walk(self.root):
+            for nm in filenames:
+                path = os.path.join(dirpath,nm)
+                if not self.snapshot.isfile(path):
+                    continue
+                size = self.snapshot.getsize(path)
+                self._by_size.setdefault(size,[]).append(path)
+
+    def digest(self,path):
+        """Get the (cached) content digest of the given file."""
+        return self.snapshot.digest(path)
+
+    def find_duplicates(self,path):
+        """Find all indexed files with the same contents as the given file."""
+        if self._by_size is None:
+            self._build()
+        size = self.snapshot.getsize(path)
+        if size < REUSE_MIN_SIZE:
+            return []
+        candidates = self._by_size.get(size,())
+        if not candidates:
+            return []
+        digest = self.digest(path)
+        return [c for c in candidates if self.digest(c) == digest]
+
+
+class _SimilarityIndex(object):
+    """Index of the files and directories in a source tree, by similarity.
+
+    Files are indexed by a min-hash signature: the source is split into
+    chunks at newline and NUL bytes, and the signature is the set of the
+    smallest chunk hashes.  The proportion of shared hashes between two
+    signatures estimates how much content the files have in common, even
+    if it has moved around.  Directories are indexed by entry name.
+
+    Like _ContentIndex, the tree is only walked when first queried, using
+    the given TreeSnapshot if any.
+    """
+
+    #  Number of chunk hashes kept in each file's signature.
+    SIGNATURE_SIZE = 64
+    #  Only this much of each file is read when calculating its signature.
+    SAMPLE_SIZE = 1024 * 1024
+    #  Minimum estimated resemblance for a file to be considered similar.
+    MIN_RESEMBLANCE = 0.3
+    #  Minimum overlap in entry names for directories to be considered similar.
+    MIN_DIR_OVERLAP = 0.5
+
+    def __init__(self,root,snapshot=None):
+        self.root = root
+        if snapshot is None:
+            snapshot = TreeSnapshot()
+        self.snapshot = snapshot
+        self._sizes = None
+        self._signatures = None
+        self._by_chunk = None
+        self._entries = None
+        self._by_name = None
+
+    def signature(self,path):
+        """Calculate the min-hash signature of the given file."""
+        with open(path,"rb") as f:
+            data = f.read(self.SAMPLE_SIZE)
+        chunks = data.replace(_NUL,_NL).split(_NL)
+        hashes = set()
+        for chunk in chunks:
+            if len(chunk) >= 4:
+                hashes.add(zlib.crc32(chunk) & 0xffffffff)
+        return frozenset(heapq.nsmallest(self.SIGNATURE_SIZE,hashes))
+
+    def resemblance(self,sig1,sig2):
+        """Estimate the resemblance of two files from their signatures."""
+        union = heapq.nsmallest(self.SIGNATURE_SIZE,sig1 | sig2)
+        if not union:
+            return 0
+        common = [h for h in union if h in sig1 and h in sig2]
+        return len(common) / float(len(union))
+
+    def _build_files(self):
+        self._sizes = {}
+        self._signatures = {}
+        self._by_chunk = {}
+        for (dirpath,dirnames,filenames) in self.snapshot.walk(self.root):
+            for nm in filenames:
+                path = os.path.join(dirpath,nm)
+                if not self.snapshot.isfile(path):
+                    continue
+                try:
+                    size = self.snapshot.getsize(path)
+                    if size < REUSE_MIN_SIZE:
+                        continue
+                    sig = self.signature(path)
+                except EnvironmentError:
+                    continue
+                self._sizes[path] = size
+                self._signatures[path] = sig
+                for h in sig:
+                    self._by_chunk.setdefault(h,[]).append(path)
+
+    def _build_dirs(self):
+        self._entries = {}
+        self._by_name = {}
+        for (dirpath,dirnames,filenames) in self.snapshot.walk(self.root):
+            if dirpath == self.root:
+                continue
+            names = set(dirnames) | set(filenames)
+            self._entries[dirpath] = names
+            for nm in names:
+                self._by_name.setdefault(nm,[]).append(dirpath)
+
+    def find_similar_file(self,path):
+        """Find the indexed file most similar to the given file, if any.
+
+        Only files within a factor of two in size are considered.
+        """
+        if self._signatures is None:
+            self._build_files()
+        size = self.snapshot.getsize(path)
+        if size < REUSE_MIN_SIZE:
+            return None
+        sig = self.signature(path)
+        candidates = set()
+        for h in sig:
+            candidates.update(self._by_chunk.get(h,()))
+        nm = os.path.basename(path)
+        best = None
+        for c in candidates:
+            if not (size / 2 <= self._sizes[c] <= size * 2):
+                continue
+            r = self.resemblance(sig,self._signatures[c])
+            if r < self.MIN_RESEMBLANCE:
+                continue
+            key = (r,os.path.basename(c) == nm,c)
+            if best is None or key > best:
+                best = key
+        if best is None:
+            return None
+        return best[-1]
+
+    def find_similar_dir(self,path):
+        """Find the indexed directory most similar to the given directory.
+
+        Similarity is based on the number of entry names in common; as in
+        Differ._find_similar_sibling() at least three names must match.
+        """
+        if self._entries is None:
+            self._build_dirs()
+        names = set(self.snapshot.listdir(path))
+        counts = {}
+        for nm in names:
+            for d in self._by_name.get(nm,()):
+                counts[d] = counts.get(d,0) + 1
+        best = None
+        for (d,common) in counts.iteritems():
+            if common < 3:
+                continue
+            overlap = common / float(len(names | self._entries[d]))
+            if overlap < self.MIN_DIR_OVERLAP:
+                continue
+            key = (overlap,common,d)
+            if best is None or key > best:
+                best = key
+        if best is None:
+            return None
+        return best[-1]
+
+
+class _BlockMatcher(object):
+    """Find runs of target data that appear anywhere in a source file.
+
+    This works in the style of rsync: the source file is indexed by the
+    KEY_SIZE bytes found at every 'stride' bytes, and each window of target
+    data is probed for those keys.  Any hit is then extended in both
+    directions to find the full extent of the matching run.
+
+    Rather than probing every offset in the target, we probe every
+    PROBE_STRIDE bytes.  Since that is coprime to the (power-of-two) index
+    stride, any common run of at least stride*PROBE_STRIDE+KEY_SIZE bytes is
+    guaranteed to be found, whatever its alignment.
+
+    The index is an open-addressed hash table holding just the source offset
+    of each key, in an array of at most MAX_INDEX_MEMORY bytes.  The stride
+    is increased until the keys fit in half the table.  Keys are found by
+    hashing the target data and comparing it with the source data at each
+    offset in the slot's probe sequence.
+    """
+
+    KEY_SIZE = 32
+    PROBE_STRIDE = 7
+    #  Runs shorter than this are left for bsdiff to deal with.
+    MIN_MATCH_SIZE = 1024
+    #  Keys occurring at more than this many source offsets are ignored.
+    MAX_OFFSETS = 8
+    #  After a run ends, look this far ahead for it to resume.
+    RESYNC_SIZE = 64
+    #  Memory budget for the index table.
+    MAX_INDEX_MEMORY = 1024 * 1024 * 16
+
+    def __init__(self,sfile,stride=1024):
+        self.data = mmap.mmap(sfile.fileno(),0,access=mmap.ACCESS_READ)
+        size = len(self.data)
+        key_size = self.KEY_SIZE
+        #  Each key gets a slot in a table at most half full.
+        itemsize = array.array("l").itemsize
+        max_slots = self.MAX_INDEX_MEMORY // itemsize
+        while 2 * (size // stride + 1) > max_slots:
+            stride *= 2
+        self.stride = stride
+        num_slots = 1024
+        while num_slots < 2 * (size // stride + 1):
+            num_slots *= 2
+        table = self._table = array.array("l",[-1]) * num_slots
+        mask = num_slots - 1
+        data = self.data
+        for offset in xrange(0,size - key_size + 1,stride):
+            key = data[offset:offset+key_size]
+            i = hash(key) & mask
+            count = 0
+            while table[i] != -1:
+                s = table[i]
+                if data[s:s+key_size] == key:
+                    count += 1
+                i = (i + 1) & mask
+            #  Keys this common are just noise; repetitive data is better
+            #  left to the compressor.  Storing one more offset than the
+            #  limit is enough for _lookup() to know to ignore them.
+            if count <= self.MAX_OFFSETS:
+                table[i] = offset
+
+    def _lookup(self,key):
+        """Get the list of source offsets at which the given key is indexed.
+
+        Returns None if the key is too common to be of any use.
+        """
+        table = self._table
+        mask = len(table) - 1
+        data = self.data
+        key_size = self.KEY_SIZE
+        offsets = []
+        i = hash(key) & mask
+        s = table[i]
+        while s != -1:
+            if data[s:s+key_size] == key:
+                offsets.append(s)
+            i = (i + 1) & mask
+            s = table[i]
+        if len(offsets) > self.MAX_OFFSETS:
+            return None
+        return offsets
+
+    def close(self):
+        self.data.close()
+
+    def find_matches(self,tdata,toff=0,hint=None):
+        """Find runs of the given target data that appear in the source.
+
+        Returns a list of non-overlapping tuples (target index, source offset,
+        length) ordered by target index.  If given, 'toff' is the offset of
+        the data in the target file; a run at the same offset in the source
+        is preferred over any other.  If given, 'hint' is a source offset at
+        which a run continuing from the previous window may be found.
+        """
+        matches = []
+        sdata = self.data
+        key_size = self.KEY_SIZE
+        #  Remember the extent of each run we've found, by offset delta, so
+        #  that repeated hits within a run don't extend it all over again.
+        runs = {}
+        tpos = 0
+        t = 0
+        tmax = len(tdata) - key_size
+        if hint is not None:
+            m = self._extend(tdata,0,hint,0)
+            if m[2] >= key_size:
+                matches.append(m)
+                tpos = t = m[2]
+        while t <= tmax:
+            best = None
+            offsets = self._lookup(tdata[t:t+key_size])
+            if offsets:
+                for s in offsets:
+                    delta = s - t
+                    m = runs.get(delta)
+                    if m is None or not (max(m[0],tpos) <= t < m[0] + m[2]):
+                        m = runs[delta] = self._extend(tdata,t,s,tpos)
+                    elif m[0] < tpos:
+                        m = (tpos,tpos + delta,m[0] + m[2] - tpos)
+                    if best is None or m[2] > best[2] or \
+                       (m[2] == best[2] and m[1] - m[0] == toff):
+                        best = m
+                if best[2] < self.MIN_MATCH_SIZE:
+                    best = None
+            if best is None:
+                t += self.PROBE_STRIDE
+                continue
+            matches.append(best)
+            tpos = best[0] + best[2]
+            #  If the run was broken by a small edit, it may resume with
+            #  the same offset just a little bit further on.
+            delta = best[1] - best[0]
+            t = tpos + 1
+            while t <= min(tmax,tpos + self.RESYNC_SIZE):
+                s = t + delta
+                if s < 0:
+                    break
+                if sdata[s:s+key_size] == tdata[t:t+key_size]:
+                    m = self._extend(tdata,t,s,tpos)
+                    if m[2] >= self.MIN_MATCH_SIZE:
+                        matches.append(m)
+                        tpos = m[0] + m[2]
+                    break
+                t += 1
+            t = max(t,tpos)
+        return matches
+
+    def find_anchors(self,tdata):
+        """Find anchor points linking the given target data to the source.
+
+        Returns a list of tuples (target index, source offset) at which the
+        target data matches an unambiguous key from the source index.
+        Unlike find_matches(), these need not be part of a long run.
+        """
+        anchors = []
+        key_size = self.KEY_SIZE
+        for t in xrange(0,len(tdata) - key_size + 1,self.PROBE_STRIDE):
+            offsets = self._lookup(tdata[t:t+key_size])
+            if offsets and len(offsets) == 1:
+                anchors.append((t,offsets[0]))
+        return anchors
+
+    def _extend(self,tdata,t,s,tmin):
+        """Extend a match at target index t and source offset s.
+
+        The match is extended forwards as far as possible, and backwards as
+        far as target index tmin.  Returns the tuple (target index, source
+        offset, length).
+        """
+        back = _common_suffix_size(tdata,t,self.data,s,min(t-tmin,s))
+        fwd = _common_prefix_size(tdata,t,self.data,s,len(self.data)-s)
+        return (t - back,s - back,back + fwd)
+
+
+def _sample_positions(size,count,sample_size):
+    """Get the offsets of evenly-spaced samples from data of the given size."""
+    if size <= sample_size:
+        return [0]
+    step = (size - sample_size) / float(max(count - 1,1))
+    return sorted(set(int(i * step) for i in xrange(count)))
+
+
+def _sample_similarity(sdata,tdata,count=16,sample_size=16):
+    """Estimate how similar two strings are by sampling the target.
+
+    Returns a tuple (found,same) giving the fraction of samples that appear
+    anywhere in the source, and the fraction that appear at the same offset
+    in the source.  The latter is only calculated if the two strings have
+    the same length.
+    """
+    positions = _sample_positions(len(tdata),count,sample_size)
+    found = same = 0
+    for i in positions:
+        sample = tdata[i:i+sample_size]
+        if len(sdata) == len(tdata) and sdata[i:i+sample_size] == sample:
+            found += 1
+            same += 1
+        elif sdata.find(sample) != -1:
+            found += 1
+    return (found / float(len(positions)),same / float(len(positions)))
+
+
+def _looks_incompressible(data,count=4,sample_size=1024*16):
+    """Guess whether the given data is incompressible, by sampling it."""
+    positions = _sample_positions(len(data),count,sample_size)
+    sample = "".encode("ascii").join(data[i:i+sample_size] for i in positions)
+    return len(zlib.compress(sample,1)) >= len(sample) * 0.98
+
+
+def _common_prefix_size(data1,i1,data2,i2,maxsize):
+    """Find the size of the common prefix of data1[i1:] and data2[i2:].
+
+    The result is at most 'maxsize'.  Data is compared in chunks, with a
+    binary search to find the first mismatching byte.
+    """
+    maxsize = min(maxsize,len(data1) - i1,len(data2) - i2)
+    n = 0
+    chunk = 256
+    while n < maxsize:
+        size = min(chunk,maxsize - n)
+        if data1[i1+n:i1+n+size] != data2[i2+n:i2+n+size]:
+            lo = 0; hi = size
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if data1[i1+n+lo:i1+n+mid] == data2[i2+n+lo:i2+n+mid]:
+                    lo = mid
+                else:
+                    hi = mid
+            return n + lo
+        n += size
+        chunk = min(chunk * 2,1024 * 64)
+    return n
+
+
+def _common_suffix_size(data1,i1,data2,i2,maxsize):
+    """Find the size of the common suffix of data1[:i1] and data2[:i2].
+
+    The result is at most 'maxsize'.  Data is compared in chunks, with a
+    binary search to find the last mismatching byte.
+    """
+    maxsize = min(maxsize,i1,i2)
+    n = 0
+    chunk = 256
+    while n < maxsize:
+        size = min(chunk,maxsize - n)
+        if data1[i1-n-size:i1-n] != data2[i2-n-size:i2-n]:
+            lo = 0; hi = size
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if data1[i1-n-mid:i1-n-lo] == data2[i2-n-mid:i2-n-lo]:
+                    lo = mid
+                else:
+                    hi = mid
+            return n + lo
+        n += size
+        chunk = min(chunk * 2,1024 * 64)
+    return n
+
+
+def _relpath(path,root):
+    """Get the relative path from root to path, using "/" as separator.
+
+    Paths written into a patch always use forward slashes, so that patches
+    generated on one platform can be applied on another.
+    """
+    return os.path.relpath(path,root).replace(os.sep,"/")
 
 
 class _tempdir(object):
@@ -1058,87 +4631,691 @@ class _tempdir(object):
         shutil.rmtree(self.path)
 
 
-if cx_bsdiff is not None:
-    def bsdiff4_diff(source,target):
-        """Generate a BSDIFF4-format patch from 'source' to 'target'.
+def bsdiff4_diff(source,target,compress=bz2.compress):
+    """Generate a BSDIFF4-format patch from 'source' to 'target'.
 
-        You must have cx-bsdiff installed for this to work; if I get really
-        bored I might do a pure-python version but it would probably be too
-        slow and ugly to be worthwhile.
-        """
+    If cx-bsdiff is installed it will be used; otherwise a pure-python
+    version of the bsdiff algorithm is used, which is a lot slower but
+    generates equivalent patches.  The data blocks are compressed using
+    'compress', which is bz2 for standard BSDIFF4 patches.
+    """
+    blocks = bsdiff4_blocks(source,target)
+    return bsdiff4_encode(blocks,len(target),compress)
+
+
+def bsdiff4_blocks(source,target):
+    """Calculate the uncompressed data blocks of a BSDIFF4 patch.
+
+    Returns a tuple (control,diff,extra) of bytestrings, which can be
+    compressed and assembled into a patch using bsdiff4_encode().
+    """
+    if cx_bsdiff is not None:
         (tcontrol,bdiff,bextra) = cx_bsdiff.Diff(source,target)
-        #  Write control tuples as series of offts
-        bcontrol = BytesIO()
-        for c in tcontrol:
-            for x in c:
-                bcontrol.write(_encode_offt(x))
-        del tcontrol
-        bcontrol = bcontrol.getvalue()
-        #  Compress each block
-        bcontrol = bz2.compress(bcontrol)
-        bdiff = bz2.compress(bdiff)
-        bextra = bz2.compress(bextra)
-        #  Final structure is:
-        #  (head)(len bcontrol)(len bdiff)(len target)(bcontrol)(bdiff)(bextra)
-        return "".join((
-            "BSDIFF40",
-            _encode_offt(len(bcontrol)),
-            _encode_offt(len(bdiff)),
-            _encode_offt(len(target)),
-            bcontrol,
-            bdiff,
-            bextra,
-        ))
-
-
-def bsdiff4_patch(source,patch):
+    else:
+        (tcontrol,bdiff,bextra) = _bsdiff4_search(source,target)
+    #  Write control tuples as series of offts
+    bcontrol = BytesIO()
+    for c in tcontrol:
+        for x in c:
+            bcontrol.write(_encode_offt(x))
+    del tcontrol
+    bcontrol = bcontrol.getvalue()
+    return (bcontrol,bdiff,bextra)
+
+
+def _bsdiff4_search(old,new):
+    """Pure-python calculation of BSDIFF4 control tuples and data blocks.
+
+    This follows the scan loop of the reference bsdiff implementation,
+    using a suffix array of the source to find the longest match at each
+    target position.  Rather than comparing one byte at a time, runs of
+    data are compared by subtracting whole strings with _sub_bytes() and
+    examining the result.  Returns a tuple (control,diff,extra) where
+    'control' is a list of (x,y,z) tuples.
+    """
+    oldsize = len(old)
+    newsize = len(new)
+    sa = _suffix_sort(old)
+    control = []
+    bdiff = []
+    bextra = []
+    scan = length = pos = 0
+    lastscan = lastpos = lastoffset = 0
+    while scan < newsize:
+        oldscore = 0
+        scan += length
+        scsc = scan
+        while scan < newsize:
+            (length,pos) = _bsdiff_search(sa,old,new,scan)
+            end = min(scan + length,oldsize - lastoffset)
+            if scsc < end:
+                diff = _sub_bytes(new[scsc:end],
+                                  old[scsc+lastoffset:end+lastoffset])
+                oldscore += diff.count(_NUL)
+            scsc = max(scsc,scan + length)
+            if (length == oldscore and length != 0) or length > oldscore + 8:
+                break
+            if scan + lastoffset < oldsize:
+                if old[scan+lastoffset] == new[scan]:
+                    oldscore -= 1
+            scan += 1
+        if length == oldscore and scan != newsize:
+            continue
+        #  Extend the previous match forwards and this one backwards,
+        #  as long as more than half the bytes keep matching.
+        n = min(scan - lastscan,oldsize - lastpos)
+        diff = _sub_bytes(new[lastscan:lastscan+n],old[lastpos:lastpos+n])
+        lenf = _best_extension(diff)
+        lenb = 0
+        if scan < newsize:
+            n = min(scan - lastscan,pos)
+            diff = _sub_bytes(new[scan-n:scan],old[pos-n:pos])
+            lenb = _best_extension(diff[::-1])
+        #  If the extensions overlap, find the best place to split them.
+        if lastscan + lenf > scan - lenb:
+            overlap = (lastscan + lenf) - (scan - lenb)
+            s = best = lens = 0
+            for i in xrange(overlap):
+                if new[lastscan+lenf-overlap+i] == old[lastpos+lenf-overlap+i]:
+                    s += 1
+                if new[scan-lenb+i] == old[pos-lenb+i]:
+                    s -= 1
+                if s > best:
+                    best = s
+                    lens = i + 1
+            lenf += lens - overlap
+            lenb -= lens
+        bdiff.append(_sub_bytes(new[lastscan:lastscan+lenf],
+                                old[lastpos:lastpos+lenf]))
+        bextra.append(new[lastscan+lenf:scan-lenb])
+        control.append((lenf,(scan - lenb) - (lastscan + lenf),
+                        (pos - lenb) - (lastpos + lenf)))
+        lastscan = scan - lenb
+        lastpos = pos - lenb
+        lastoffset = pos - scan
+    empty = "".encode("ascii")
+    return (control,empty.join(bdiff),empty.join(bextra))
+
+
+def _bsdiff_search(sa,old,new,scan):
+    """Find the longest match for new[scan:] among the suffixes of old.
+
+    'sa' is the suffix array of old as produced by _suffix_sort().  Returns
+    a tuple (length,position) giving the length of the match and its offset
+    in old.
+    """
+    st = 0
+    en = len(old)
+    while en - st >= 2:
+        x = st + (en - st) // 2
+        if _suffix_less(old,sa[x],new,scan):
+            st = x
+        else:
+            en = x
+    x = _common_prefix_size(old,sa[st],new,scan,len(new))
+    y = _common_prefix_size(old,sa[en],new,scan,len(new))
+    if x > y:
+        return (x,sa[st])
+    return (y,sa[en])
+
+
+def _suffix_less(old,i,new,j):
+    """Check whether old[i:] sorts before new[j:], up to the shorter length.
+
+    The strings are compared in growing pieces, so the cost is proportional
+    to the length of their common prefix rather than of the strings.
+    """
+    maxsize = min(len(old) - i,len(new) - j)
+    n = 0
+    chunk = 32
+    while n < maxsize:
+        size = min(chunk,maxsize - n)
+        a = old[i+n:i+n+size]
+        b = new[j+n:j+n+size]
+        if a != b:
+            return a < b
+        n += size
+        chunk *= 4
+    return False
+
+
+def _suffix_sort(data):
+    """Calculate the suffix array of the given string.
+
+    The result is an array of the len(data)+1 offsets of the suffixes of
+    data (including the empty suffix) in sorted order.  If numpy can be
+    imported this uses prefix doubling with numpy arrays; otherwise it
+    uses a pure-python version of the Larsson-Sadakane "qsufsort" algorithm,
+    in which only those groups of suffixes not yet told apart are sorted
+    by the rank of the suffix h bytes further on, doubling h each time.
+
+    The pure-python version keeps the suffix array, ranks and groups in
+    compact arrays and sorts with _sort_pairs(), so it needs a few tens of
+    bytes per byte of data rather than a few hundred.  It may stop before
+    the array is fully sorted, in which case the suffixes are at least
+    sorted by their first few bytes.
+    """
+    np = _import_numpy()
+    if np is not None:
+        return _suffix_sort_numpy(np,data)
+    n = len(data)
+    #  Start from the groups of suffixes sharing their first four bytes,
+    #  found by sorting on the big-endian integer formed by those bytes.
+    (keys,order) = _sort_pairs(_prefix_keys(data),xrange(n),n + 1)
+    sa = array.array("i",[n])
+    sa.extend(order)
+    del order
+    #  The rank of each suffix is the index of the last member of its
+    #  group in sa, so that splitting a group never changes its position
+    #  relative to the others.  Groups are kept as flat (start,end) pairs.
+    rank = array.array("i",[0]) * (n + 1)
+    for (j,i) in enumerate(sa):
+        rank[i] = j
+    bounds = _group_bounds(keys,1)
+    del keys
+    groups = array.array("i")
+    start = 1
+    for end in bounds:
+        if end - start > 1:
+            groups.append(start)
+            groups.append(end)
+            for i in sa[start:end]:
+                rank[i] = end - 1
+        start = end
+    del bounds
+    #  Very repetitive data can take many rounds to sort completely, each
+    #  of them over most of the data.  We give up once the rounds add up
+    #  to a couple of passes over the data, leaving any remaining groups
+    #  sorted by their first h bytes only.  That's still fine for bsdiff,
+    #  which just finds shorter matches in such data.
+    budget = 2 * n
+    h = 4
+    while groups:
+        budget -= sum(groups[1::2]) - sum(groups[0::2])
+        if budget < 0:
+            break
+        #  Suffixes shorter than h bytes only share a group if one is a
+        #  prefix of the other (the keys are padded with zero bytes), so
+        #  the shorter one sorts first.  They get the lowest sort keys from
+        #  the extra entries at the end of 'ranks', and all the other keys
+        #  are shifted up to stay above them.
+        ranks = array.array("i",itertools.imap(operator.add,rank,
+                                               itertools.repeat(h + 1)))
+        ranks.extend(xrange(h,0,-1))
+        unsorted = array.array("i")
+        for g in xrange(0,len(groups),2):
+            (start,end) = (groups[g],groups[g+1])
+            members = sa[start:end]
+            keys = itertools.imap(ranks.__getitem__,itertools.imap(
+                                  operator.add,members,itertools.repeat(h)))
+            (keys,members) = _sort_pairs(keys,members,n + 1)
+            sa[start:end] = members
+            del members
+            bounds = _group_bounds(keys,start)
+            del keys
+            run = start
+            for j in bounds:
+                if j - run > 1:
+                    unsorted.append(run)
+                    unsorted.append(j)
+                    for i in sa[run:j]:
+                        rank[i] = j - 1
+                else:
+                    rank[sa[run]] = run
+                run = j
+        groups = unsorted
+        h *= 2
+    return sa
+
+
+#  Inputs to _sort_pairs() are sorted in pieces of this many items.
+_SORT_PIECE_SIZE = 1024 * 64
+
+#  Typecode for arrays of unsigned 64-bit integers, if there is one.
+if array.array("L").itemsize == 8:
+    _UINT64 = "L"
+else:
+    _UINT64 = None
+
+
+def _sort_pairs(keys,values,m):
+    """Sort pairs of non-negative integers, without a tuple for each pair.
+
+    Given an iterable of keys and one of values smaller than m, this returns
+    a sequence of the keys in sorted order and an array of the corresponding
+    values.  Each pair is packed into the single integer key*m + value, and
+    these are sorted in pieces of _SORT_PIECE_SIZE, each kept in a compact
+    array, which are then merged.  So only a piece's worth of python ints
+    are alive at any time.  Without a 64-bit array type, the packed values
+    are just sorted as a list.
+    """
+    packed = itertools.imap(operator.add,values,itertools.imap(
+                            operator.mul,keys,itertools.repeat(m)))
+    if _UINT64 is None:
+        packed = sorted(packed)
+        keys = [k // m for k in packed]
+    else:
+        pieces = []
+        while True:
+            piece = sorted(itertools.islice(packed,_SORT_PIECE_SIZE))
+            if not piece:
+                break
+            pieces.append(array.array(_UINT64,piece))
+        if len(pieces) == 1:
+            packed = pieces[0]
+        else:
+            packed = array.array(_UINT64,heapq.merge(*pieces))
+        del pieces
+        keys = array.array(_UINT64,itertools.imap(operator.floordiv,packed,
+                                                  itertools.repeat(m)))
+    values = array.array("i",itertools.imap(operator.mod,packed,
+                                            itertools.repeat(m)))
+    return (keys,values)
+
+
+def _group_bounds(keys,start):
+    """Find the ends of the runs of equal items in a sorted sequence of keys.
+
+    The returned array gives the index at which each run ends, counting the
+    first key as index 'start'.
+    """
+    bounds = array.array("i",itertools.compress(
+                        xrange(start + 1,start + len(keys)),
+                        itertools.imap(operator.ne,keys,
+                                       itertools.islice(keys,1,None))))
+    bounds.append(start + len(keys))
+    return bounds
+
+
+def _prefix_keys(data):
+    """Get an array of the big-endian integers formed by each four bytes of data.
+
+    The item at index i is formed from data[i:i+4], padded with zero bytes
+    at the end.  The integers at each offset modulo four are decoded in
+    bulk using the array module.
+    """
+    n = len(data)
+    padded = data + _NUL * 4
+    typecode = "I"
+    if array.array(typecode).itemsize != 4:
+        typecode = "L"
+    keys = array.array(typecode,[0]) * n
+    for r in xrange(4):
+        count = (n - r + 3) // 4
+        if count <= 0:
+            continue
+        values = array.array(typecode,padded[r:r+count*4])
+        if sys.byteorder == "little":
+            values.byteswap()
+        keys[r::4] = values
+    return keys
+
+
+def _suffix_sort_numpy(np,data):
+    """Calculate the suffix array of the given string using numpy.
+
+    This works like the pure-python version in _suffix_sort(), but each
+    round of prefix doubling sorts all the suffixes at once, by their
+    current rank combined with the rank of the suffix h bytes further on.
+    """
+    n = len(data)
+    padded = np.zeros(n + 3,dtype=np.int64)
+    padded[:n] = np.frombuffer(data,dtype=np.uint8)
+    keys = np.zeros(n + 1,dtype=np.int64)
+    for k in xrange(4):
+        keys[:n] = keys[:n] * 256 + padded[k:n+k]
+    keys[:n] += 1
+    h = 4
+    while True:
+        sa = np.argsort(keys,kind="mergesort")
+        sorted_keys = keys[sa]
+        boundary = np.zeros(n + 1,dtype=np.int64)
+        boundary[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        rank = np.empty(n + 1,dtype=np.int64)
+        rank[sa] = np.cumsum(boundary)
+        if rank[sa[-1]] == n:
+            break
+        second = np.arange(-1,-n - 2,-1,dtype=np.int64)
+        if h <= n:
+            second[:n+1-h] = rank[h:]
+        keys = rank * (2 * n + 2) + second + (n + 1)
+        h *= 2
+    return array.array("i",sa.tolist())
+
+
+def _import_numpy():
+    """Import numpy if it's available, or return None.
+
+    Only the developer generating patches benefits from numpy, so it's
+    imported by name at runtime; a plain import statement would make the
+    freezers bundle it into every frozen app along with this module.
+    """
+    try:
+        return __import__("numpy")
+    except ImportError:
+        return None
+
+
+def _sub_bytes(new_data,old_data):
+    """Subtract two equal-length strings bytewise, modulo 256.
+
+    This is the inverse of _add_bytes(), and is how the diff block of a
+    bsdiff patch is calculated.
+    """
+    return _add_bytes(new_data,old_data.translate(_NEGATE_BYTES))
+
+
+def _best_extension(diff):
+    """Find how far to extend a match, given the bytewise differences.
+
+    Returns the length i maximising 2*s-i, where s is the number of zero
+    bytes in diff[:i], i.e. the longest extension in which most bytes
+    match.  Only the ends of runs of zero bytes need to be considered.
+    """
+    best = best_score = 0
+    matched = pos = 0
+    for m in _NONZERO_RUN.finditer(diff):
+        if m.start() > pos:
+            matched += m.start() - pos
+            score = 2 * matched - m.start()
+            if score > best_score:
+                (best,best_score) = (m.start(),score)
+        pos = m.end()
+    if len(diff) > pos:
+        matched += len(diff) - pos
+        if 2 * matched - len(diff) > best_score:
+            best = len(diff)
+    return best
+
+
+#  Translation table negating each byte, modulo 256.
+_NEGATE_BYTES = bytes(bytearray((256 - i) % 256 for i in xrange(256)))
+
+#  Matches runs of non-zero bytes.
+_NONZERO_RUN = re.compile("[^\x00]+".encode("ascii"))
+
+
+def bsdiff4_encode(blocks,l_target,compress=bz2.compress):
+    """Assemble a BSDIFF4-format patch from its uncompressed data blocks."""
+    (bcontrol,bdiff,bextra) = blocks
+    #  Compress each block
+    bcontrol = compress(bcontrol)
+    bdiff = compress(bdiff)
+    bextra = compress(bextra)
+    #  Final structure is:
+    #  (head)(len bcontrol)(len bdiff)(len target)(bcontrol)(bdiff)(bextra)
+    return "".encode("ascii").join((
+        "BSDIFF40".encode("ascii"),
+        _encode_offt(len(bcontrol)),
+        _encode_offt(len(bdiff)),
+        _encode_offt(l_target),
+        bcontrol,
+        bdiff,
+        bextra,
+    ))
+
+
+def _add_bytes(diff_data,orig_data):
+    """Add two equal-length strings bytewise, modulo 256.
+
+    This is the core operation of applying a bsdiff patch.  If cx-bsdiff
+    isn't available, the strings are treated as two big integers and added
+    in one go, with the high bit of each byte masked off so that no carry
+    can spill over into the next byte.  It's several times faster than a
+    loop over the individual bytes.
+    """
+    n = len(diff_data)
+    if cx_bsdiff is not None:
+        return cx_bsdiff.Patch(orig_data,n,[(n,0,0)],diff_data,"")
+    #  Diff blocks are often entirely zero, in which case there's no work.
+    if diff_data.count("\x00".encode("ascii")) == n:
+        return orig_data[:n]
+    if sys.version_info[0] < 3:
+        x = int(binascii.hexlify(diff_data),16)
+        y = int(binascii.hexlify(orig_data),16)
+        low = int("7f" * n,16)
+    else:
+        x = int.from_bytes(diff_data,"big")
+        y = int.from_bytes(orig_data,"big")
+        low = int.from_bytes(b"\x7f" * n,"big")
+    high = (low << 1) & ~low
+    #  The low seven bits of each byte are added directly, and the high bit
+    #  is the xor of the two input high bits and the carry from that add.
+    r = ((x & low) + (y & low)) ^ ((x ^ y) & high)
+    if sys.version_info[0] < 3:
+        return binascii.unhexlify("%0*x" % (2 * n,r))
+    else:
+        return r.to_bytes(n,"big")
+
+
+def _decompress_chunks(decompressor,chunks,limit):
+    """Incrementally decompress data from an iterable of chunks.
+
+    This is a generator yielding the decompressed data in pieces of about
+    'limit' bytes.  Decompressors that take a maximum output length are
+    held to the limit; others are fed the input in small pieces so that
+    each piece of output is unlikely to be much bigger than the limit.
+    """
+    d = decompressor
+    if hasattr(d,"unconsumed_tail"):
+        #  zlib-style decompressor, with a max_length argument.
+        for chunk in chunks:
+            data = d.decompress(chunk,limit)
+            while True:
+                if data:
+                    yield data
+                if not d.unconsumed_tail:
+                    break
+                data = d.decompress(d.unconsumed_tail,limit)
+        data = d.flush()
+        if data:
+            yield data
+    elif hasattr(d,"needs_input"):
+        #  python3-style bz2 or lzma decompressor, with a max_length argument.
+        for chunk in chunks:
+            data = d.decompress(chunk,limit)
+            while True:
+                if data:
+                    yield data
+                if d.eof or d.needs_input:
+                    break
+                data = d.decompress("".encode("ascii"),limit)
+    else:
+        step = max(limit // 64,64)
+        for chunk in chunks:
+            for i in xrange(0,len(chunk),step):
+                data = d.decompress(chunk[i:i+step])
+                if data:
+                    yield data
+
+
+def _file_chunks(f,size):
+    """Iterate over the contents of a file, in chunks of the given size."""
+    data = f.read(size)
+    while data:
+        yield data
+        data = f.read(size)
+
+
+class PatchStream(object):
+    """Writable stream that applies a patch as its data arrives.
+
+    Data written to a PatchStream is handed to a Patcher running in a
+    background thread, so that e.g. a patch can be applied while it is still
+    being downloaded.  Once all the data has been written, call close() to
+    wait for the Patcher to finish; it re-raises any error encountered while
+    patching.  If the data can't be completed, call abort() instead.
+
+    At most 'max_pending' written chunks are queued up, after which write()
+    blocks until the Patcher catches up.  Other keyword arguments are passed
+    on to the Patcher.
+    """
+
+    def __init__(self,target,max_pending=16,**kwds):
+        self._queue = Queue.Queue(max_pending)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,args=(target,kwds))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self,target,kwds):
+        chunks = iter(self._queue.get,None)
+        try:
+            Patcher(target,_ChunkReader(chunks),**kwds).patch()
+        except Exception:
+            self._error = sys.exc_info()
+        #  Consume any remaining data, so that writers don't block.
+        for _ in chunks:
+            pass
+
+    @property
+    def failed(self):
+        """Whether the patch has already failed to apply."""
+        return self._error is not None
+
+    def write(self,data):
+        if self._closed:
+            raise ValueError("write to closed PatchStream")
+        if data:
+            self._queue.put(data)
+
+    def close(self):
+        """Finish the patch, raising any error encountered while applying it."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            if self._error is not None:
+                (t,v,tb) = self._error
+                raise t,v,tb
+
+    def abort(self):
+        """Stop applying the patch, leaving the target in an unknown state."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+
+class _ChunkReader(object):
+    """File-like reader over an iterable of chunks of data."""
+
+    def __init__(self,chunks):
+        self._chunks = iter(chunks)
+        self._buffer = "".encode("ascii")
+
+    def read(self,size):
+        """Read up to 'size' bytes; fewer are only returned at the end."""
+        pieces = []
+        while size > 0:
+            if not self._buffer:
+                try:
+                    self._buffer = next(self._chunks)
+                except StopIteration:
+                    break
+            pieces.append(self._buffer[:size])
+            self._buffer = self._buffer[size:]
+            size -= len(pieces[-1])
+        return "".encode("ascii").join(pieces)
+
+    def chunks(self,size=None):
+        """Iterate over the next 'size' bytes (or all remaining) in chunks."""
+        while size is None or size > 0:
+            if not self._buffer:
+                try:
+                    self._buffer = next(self._chunks)
+                except StopIteration:
+                    break
+            if size is None or len(self._buffer) <= size:
+                data = self._buffer
+                self._buffer = "".encode("ascii")
+            else:
+                data = self._buffer[:size]
+                self._buffer = self._buffer[size:]
+            if size is not None:
+                size -= len(data)
+            yield data
+
+    def drain(self):
+        """Discard all remaining data."""
+        for _ in self.chunks():
+            pass
+
+
+def bsdiff4_patch(source,patch,decompress=bz2.decompress):
     """Apply a BSDIFF4-format patch to the given string.
 
     This function returns the result of applying the BSDIFF4-format patch
     'patch' to the input string 'source'.  If cx-bsdiff is installed then
-    it will be used; otherwise a pure-python fallback is used.
+    it will be used; otherwise a pure-python fallback is used.  The data
+    blocks are decompressed using 'decompress', which is bz2 for standard
+    BSDIFF4 patches.
 
     The idea of a pure-python fallback is to avoid making frozen apps depend
-    on cx-bsdiff; only the developer needs to have it installed.
+    on cx-bsdiff; only the developer needs to have it installed, and even
+    then it just makes generating patches faster.
     """
     #  Read the length headers
-    l_bcontrol = _decode_offt(patch[8:16])
-    l_bdiff = _decode_offt(patch[16:24])
-    l_target = _decode_offt(patch[24:32])
+    (l_bcontrol,l_bdiff,l_target) = _decode_offts(patch[8:32])
     #  Read the three data blocks
-    bcontrol = bz2.decompress(patch[32:32+l_bcontrol])
-    bdiff = bz2.decompress(patch[32+l_bcontrol:32+l_bcontrol+l_bdiff])
-    bextra = bz2.decompress(patch[32+l_bcontrol+l_bdiff:])
+    bcontrol = decompress(patch[32:32+l_bcontrol])
+    bdiff = decompress(patch[32+l_bcontrol:32+l_bcontrol+l_bdiff])
+    bextra = decompress(patch[32+l_bcontrol+l_bdiff:])
     #  Decode the control tuples 
-    tcontrol = []
-    for i in xrange(0,len(bcontrol),24):
-        tcontrol.append((
-            _decode_offt(bcontrol[i:i+8]),
-            _decode_offt(bcontrol[i+8:i+16]),
-            _decode_offt(bcontrol[i+16:i+24]),
-        ))
+    values = _decode_offts(bcontrol)
+    tcontrol = zip(values[0::3],values[1::3],values[2::3])
     #  Actually do the patching.
     #  This is simple enough that I can provide a pure-python fallback
     #  when cx_bsdiff is not available.
     if cx_bsdiff is not None:
         return cx_bsdiff.Patch(source,l_target,tcontrol,bdiff,bextra)
     else:
-        source = BytesIO(source)
-        result = BytesIO()
-        bdiff = BytesIO(bdiff)
-        bextra = BytesIO(bextra)
-        for (x,y,z) in tcontrol:
-            diff_data = bdiff.read(x)
-            orig_data = source.read(x)
-            if sys.version_info[0] < 3:
-                for i in xrange(len(diff_data)):
-                    result.write(chr((ord(diff_data[i])+ord(orig_data[i]))%256))
-            else:
-                for i in xrange(len(diff_data)):
-                    result.write(bytes([(diff_data[i]+orig_data[i])%256]))
-            result.write(bextra.read(y))
-            source.seek(z,os.SEEK_CUR)
-        return result.getvalue()
+        return _bsdiff4_apply(source,l_target,tcontrol,bdiff,bextra)
+
+
+def _bsdiff4_apply(source,l_target,tcontrol,bdiff,bextra):
+    """Pure-python application of decoded BSDIFF4 control tuples.
+
+    Rather than adding each diff block to its source data separately, the
+    source data for all the blocks is gathered up and added to the diff
+    data in a single call to _add_bytes.  The output is then assembled by
+    interleaving slices of the result with the extra data.
+    """
+    pieces = []
+    oldpos = 0
+    for (x,y,z) in tcontrol:
+        if x < 0 or y < 0 or oldpos < 0:
+            raise PatchError("corrupted bsdiff patch")
+        pieces.append(source[oldpos:oldpos+x])
+        oldpos += x + z
+    orig_data = "".encode("ascii").join(pieces)
+    if len(bdiff) < len(orig_data):
+        raise PatchError("corrupted bsdiff patch")
+    new_data = _add_bytes(bdiff[:len(orig_data)],orig_data)
+    del pieces[:]
+    dpos = epos = 0
+    for (x,y,z) in tcontrol:
+        pieces.append(new_data[dpos:dpos+x])
+        pieces.append(bextra[epos:epos+y])
+        dpos += x
+        epos += y
+    result = "".encode("ascii").join(pieces)
+    if dpos != len(new_data) or len(result) != l_target:
+        raise PatchError("corrupted bsdiff patch")
+    return result
+
+
+def _decode_offts(data):
+    """Decode a string of consecutive off_t values into a list of ints.
+
+    This is equivalent to calling _decode_offt on each 8-byte slice of the
+    string, but unpacks them all in a single call to struct.unpack.
+    """
+    n = len(data) // 8
+    values = struct.unpack("<%dQ" % (n,),data[:n*8])
+    sign = 1 << 63
+    return [(v if v < sign else sign - v) for v in values]
 
 
 def _decode_offt(bytes):
@@ -1180,6 +5357,21 @@ def _encode_offt(x):
 
 
 
+def _parse_size(size):
+    """Parse a size given on the command-line, e.g. "4M" or "512k"."""
+    scale = 1
+    if size[-1].lower() == "k":
+        scale = 1024
+        size = size[:-1]
+    elif size[-1].lower() == "m":
+        scale = 1024 * 1024
+        size = size[:-1]
+    elif size[-1].lower() == "g":
+        scale = 1024 * 1024 * 1024
+        size = size[:-1]
+    return int(float(size)*scale)
+
+
 def main(args):
     """Command-line diffing and patching for esky."""
     parser = optparse.OptionParser()
@@ -1192,23 +5384,44 @@ def main(args):
                       help="set the window size for diffing files")
     parser.add_option("","--dry-run",dest="dry_run",action="store_true",
                       help="print commands instead of executing them")
+    parser.add_option("","--stats",dest="stats",action="store_true",
+                      help="print the number of bytes used by each command")
+    parser.add_option("","--max-memory",dest="max_memory",metavar="N",
+                      help="stream data when patching, using about N bytes")
+    parser.add_option("-j","--jobs",dest="jobs",type="int",metavar="N",
+                      help="diff files using N worker processes, or apply " \
+                           "a version 2 patch using N threads")
+    parser.add_option("","--patch-version",dest="patch_version",type="int",
+                      default=1,metavar="N",
+                      help="generate a patch in format version N (1 or 2)")
+    parser.add_option("","--adaptive-windows",dest="adaptive_windows",
+                      action="store_true",
+                      help="choose source windows by locating moved data")
+    parser.add_option("","--codecs",dest="codecs",metavar="NAMES",
+                      help="comma-separated list of codecs to try " \
+                           "(bz2, zlib, lzma)")
+    parser.add_option("","--effort",dest="effort",default="default",
+                      metavar="LEVEL",choices=EFFORT_LEVELS,
+                      help="effort spent encoding data: fast, default or best")
+    parser.add_option("","--transform-executables",action="store_true",
+                      dest="transform_executables",
+                      help="diff x86 ELF files with branch targets normalised")
+    parser.add_option("","--solid",action="store_true",dest="solid",
+                      help="compress small inserts together in shared blocks")
+    parser.add_option("","--objective",dest="objective",default="size",
+                      metavar="OBJ",choices=("size","speed"),
+                      help="optimise patches for 'size' or decoding 'speed'")
     (opts,args) = parser.parse_args(args)
+    if opts.codecs:
+        opts.codecs = opts.codecs.split(",")
     if opts.deep_zipped:
         opts.zipped = True
     if opts.zipped:
         workdir = tempfile.mkdtemp()
     if opts.diff_window:
-        scale = 1
-        if opts.diff_window[-1].lower() == "k":
-            scale = 1024
-            opts.diff_window = opts.diff_window[:-1]
-        elif opts.diff_window[-1].lower() == "m":
-            scale = 1024 * 1024
-            opts.diff_window = opts.diff_window[:-1]
-        elif opts.diff_window[-1].lower() == "g":
-            scale = 1024 * 1024 * 1024
-            opts.diff_window = opts.diff_window[:-1]
-        opts.diff_window = int(float(opts.diff_window)*scale)
+        opts.diff_window = _parse_size(opts.diff_window)
+    if opts.max_memory:
+        opts.max_memory = _parse_size(opts.max_memory)
     try:
         cmd = args[0]
         if cmd == "diff":
@@ -1236,7 +5449,19 @@ def main(args):
                         deep_extract_zipfile(target_zip,target)
                     else:
                         extract_zipfile(target_zip,target)
-            write_patch(source,target,stream,diff_window_size=opts.diff_window)
+            differ = Differ(stream,diff_window_size=opts.diff_window,
+                            workers=opts.jobs,
+                            adaptive_windows=opts.adaptive_windows,
+                            codecs=opts.codecs,objective=opts.objective,
+                            effort=opts.effort,
+                            patch_version=opts.patch_version,
+                      transform_executables=opts.transform_executables,
+                            solid=opts.solid)
+            differ.diff(source,target)
+            if opts.stats:
+                stats = sorted(differ.stats.items(),key=lambda i: -i[1])
+                for (nm,n) in stats:
+                    sys.stderr.write("%-16s %10d\n" % (nm,n))
         elif cmd == "patch":
             #  Patch a file or directory.
             #  If --zipped is specified, the target is unzipped to a temporary
@@ -1256,7 +5481,8 @@ def main(args):
                         deep_extract_zipfile(target_zip,target)
                     else:
                         extract_zipfile(target_zip,target)
-            apply_patch(target,stream,dry_run=opts.dry_run)
+            apply_patch(target,stream,dry_run=opts.dry_run,
+                        max_memory=opts.max_memory,workers=opts.jobs)
             if opts.zipped and target_zip is not None:
                 target_dir = os.path.dirname(target_zip)
                 (fd,target_temp) = tempfile.mkstemp(dir=target_dir)
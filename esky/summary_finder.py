@@ -17,7 +17,7 @@ from esky.finder import VersionFinder
 from esky.bootstrap import parse_version, join_app_version
 from esky.errors import *
 from esky.util import deep_extract_zipfile
-from esky.patch import apply_patch, PatchError
+from esky.patch import apply_patch, PatchStream, PatchError
 
 class EskyDownloadError(Exception):
     def __init__(self, file):
@@ -25,6 +25,12 @@ class EskyDownloadError(Exception):
         message = "Unable to download '%s'." % file.url
         super(EskyDownloadError, self).__init__(message)
 
+class EskyPatchError(Exception):
+    def __init__(self, file, error):
+        self.file = file
+        message = "Unable to apply '%s': %s" % (file.url, error)
+        super(EskyPatchError, self).__init__(message)
+
 KNOWN_QUALIFIERS = {
     "pre": 0,
     "alpha": 1,
@@ -526,9 +532,19 @@ class KnownFile(object):
 
             return hash == self.hash
 
-    def fetch(self, app):
+    def fetch(self, app, tee=None):
+        """Download this file, unless it has already been downloaded.
+
+        If 'tee' is given, the downloaded data is also written to it as it
+        arrives.  Returns True if the complete file was written to 'tee',
+        which is only the case if it was downloaded in one go (or resumed
+        from exactly where it left off) and passed its integrity check.
+        """
         full_filename = self.get_full_filename(app)
 
+        # Number of bytes written to the tee.
+        teed = 0
+
         # Attempt to download twice before giving up.
         tries_left = 2
 
@@ -541,14 +557,14 @@ class KnownFile(object):
                 actual_size = os.path.getsize(full_filename)
                 if self.size == 0:
                     if actual_size > 0:
-                        return # Assume it's good, since we can't verify.
+                        break # Assume it's good, since we can't verify.
                     else:
                         seek_to = 0
                 elif actual_size < self.size:
                     seek_to = actual_size
                 else:
                     if self.check_hash(app):
-                        return # It's good (as far as we can tell)!
+                        break # It's good (as far as we can tell)!
                     else:
                         # Count this as a failed download.
                         tries_left -= 1
@@ -564,6 +580,10 @@ class KnownFile(object):
                 os.unlink(full_filename)
                 continue
 
+            if seek_to != teed:
+                # The tee no longer matches what's on disk.
+                tee = None
+
             try:
                 request = urllib2.Request(self.url)
                 if seek_to > 0:
@@ -580,6 +600,9 @@ class KnownFile(object):
                         data = download.read(1 * KB)
                         while data:
                             file.write(data)
+                            if tee is not None:
+                                tee.write(data)
+                                teed += len(data)
                             data = download.read(1 * KB)
                 finally:
                     download.close()
@@ -587,9 +610,11 @@ class KnownFile(object):
                 traceback.print_exc()
                 tries_left -= 1
                 pass
+        else:
+            # Ran out of tries.
+            raise EskyDownloadError(self)
 
-        # Ran out of tries.
-        raise EskyDownloadError(self)
+        return tee is not None and teed == os.path.getsize(full_filename)
 
 class SummaryVersionFinder(VersionFinder):
     """
@@ -625,10 +650,14 @@ files.
 Upgrade files can be produced with esky.patch.  Consult help(esky.patch) for
 more information.  Using a .esky suffix is recommended (though not required),
 as these files cannot be handled by the unix "patch" command.
+
+If stream_patches is true, upgrade files are applied while they are being
+downloaded, rather than once all the files in the upgrade path have arrived.
     """
 
-    def __init__(self, download_url):
+    def __init__(self, download_url, stream_patches=False):
         self.summary_url = download_url
+        self.stream_patches = stream_patches
         super(SummaryVersionFinder,self).__init__()
         self.version_graph = None
 
@@ -748,6 +777,16 @@ as these files cannot be handled by the unix "patch" command.
             # An exception will be raised if no path is available.
             path = self.version_graph.get_best_path(app.version,version)
 
+            if self.stream_patches:
+                try:
+                    self._stream_version(app, version, path)
+                except (EskyDownloadError, EskyPatchError), e:
+                    self.version_graph.remove_file(e.file)
+                    traceback.print_exc()
+                    continue
+
+                return self._get_ready_name(app, version)
+
             try:
                 for known_file in path:
                     known_file.fetch(app)
@@ -758,7 +797,7 @@ as these files cannot be handled by the unix "patch" command.
 
             try:
                 self._prepare_version(app, version, path)
-            except PatchError, e:
+            except EskyPatchError, e:
                 self.version_graph.remove_file(e.file)
                 traceback.print_exc()
                 continue
@@ -777,23 +816,82 @@ as these files cannot be handled by the unix "patch" command.
             # Current version is already prepared, or it wouldn't be running.
             return
 
+        unpack_dir, patches = self._unpack_base_version(app, path)
+        try:
+            # Apply all necessary patches.
+            for patch_file in patches:
+                full_filename = patch_file.get_full_filename(app)
+                with open(full_filename, "rb") as patch:
+                    # If a patch fails, the EskyPatchError will be caught
+                    # outside this method.
+                    try:
+                        apply_patch(unpack_dir, patch)
+                    except PatchError, e:
+                        raise EskyPatchError(patch_file, e)
+
+            self._make_version_ready(app, version, unpack_dir)
+        finally:
+            if os.path.isdir(unpack_dir):
+                shutil.rmtree(unpack_dir)
+
+    def _stream_version(self, app, version, path):
+        """Fetch and prepare the requested version, patching as it downloads.
+
+        This is like fetching each file in the path and then calling
+        _prepare_version(), except that patches are applied while they are
+        being downloaded.  A full-install zipfile has to be downloaded
+        completely before it can be extracted.
+        """
+        if not path:
+            # Current version is already prepared, or it wouldn't be running.
+            return
+
+        if VersionNumber("").in_any(path[0].from_versions):
+            path[0].fetch(app)
+        unpack_dir, patches = self._unpack_base_version(app, path)
+        try:
+            for patch_file in patches:
+                stream = PatchStream(unpack_dir)
+                try:
+                    streamed = patch_file.fetch(app, stream)
+                    if streamed:
+                        stream.close()
+                except PatchError, e:
+                    raise EskyPatchError(patch_file, e)
+                finally:
+                    stream.abort()
+                if not streamed:
+                    # The patch couldn't be applied as it arrived, e.g.
+                    # because it was already downloaded or its download was
+                    # restarted.  Start again from the files on disk.
+                    shutil.rmtree(unpack_dir)
+                    for known_file in path:
+                        known_file.fetch(app)
+                    return self._prepare_version(app, version, path)
+
+            self._make_version_ready(app, version, unpack_dir)
+        finally:
+            if os.path.isdir(unpack_dir):
+                shutil.rmtree(unpack_dir)
+
+    def _unpack_base_version(self, app, path):
+        """Unpack the version at the start of the given path.
+
+        Returns the unpack directory, and the files in the path that remain
+        to be applied to it as patches.
+        """
         unpack_dir = tempfile.mkdtemp(dir=self._workdir(app, "unpack"))
         if not VersionNumber("").in_any(path[0].from_versions):
             # Upgrading from current version.
             self._copy_current_version(app, unpack_dir)
+            return unpack_dir, path
         else:
             # Clean install.
-            base = path.pop(0)
+            base = path[0]
             deep_extract_zipfile(base.get_full_filename(app), unpack_dir)
+            return unpack_dir, path[1:]
 
-        # Apply all necessary patches.
-        for patch_file in path:
-            full_filename = patch_file.get_full_filename(app)
-            with open(full_filename, "rb") as patch:
-                # If a patch fails, it'll raise an exception, which will be
-                # caught outside this method.
-                apply_patch(unpack_dir, patch)
-
+    def _make_version_ready(self, app, version, unpack_dir):
         # Move anything that's not the version dir into esky-bootstrap
         version_dir = "versions"
         bootstrap_dir = os.path.join(unpack_dir, version_dir, join_app_version(app.name, version, app.platform), "esky-bootstrap")
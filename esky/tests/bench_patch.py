@@ -0,0 +1,251 @@
+"""
+
+  esky.tests.bench_patch:  micro-benchmarks for the esky.patch module
+
+Run this module as a script to time some of the hot spots in esky.patch on
+randomly-generated data.  It's not part of the test suite, the numbers are
+just for comparing different implementations on the same machine.
+
+    python -m esky.tests.bench_patch [size-in-MB]
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import bz2
+import time
+import random
+import shutil
+import tempfile
+from io import BytesIO
+
+from esky import patch
+
+
+def timeit(func,*args):
+    """Time a call to func(*args), returning the best of several runs."""
+    best = None
+    for _ in xrange(5):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_window(size,nedits=16):
+    """Make a pair of windows of the given size differing in a few places.
+
+    The edits are kept away from the ends of the window, so that there's
+    a shared prefix and suffix for the differ to trim.
+    """
+    rng = random.Random(size)
+    source = bytearray(os.urandom(size))
+    target = bytearray(source)
+    for _ in xrange(nedits):
+        i = rng.randint(size // 4,(size * 3) // 4)
+        target[i:i+8] = os.urandom(8)
+    return (bytes(source),bytes(target))
+
+
+def bench_windows(size):
+    """Time the per-window prefix/suffix trimming on multi-MB windows."""
+    (sdata,tdata) = make_window(size)
+    def trim_bytes():
+        i = 0
+        maxi = min(len(tdata),len(sdata))
+        while i < maxi and tdata[i] == sdata[i]:
+            i += 1
+        return (tdata[i:],sdata[i:])
+    def trim_views():
+        tview = memoryview(tdata)
+        sview = memoryview(sdata)
+        i = patch._common_prefix_size(tview,0,sview,0,len(tview))
+        j = patch._common_suffix_size(tview,len(tview),sview,len(sview),
+                                      min(len(tview),len(sview)) - i)
+        return (tview[i:len(tview)-j],sview[i:len(sview)-j])
+    def write_data():
+        differ = patch.Differ(BytesIO())
+        differ._write_data(0,0,sdata,tdata)
+    mb = size / float(1024 * 1024)
+    print("window size: %.1fMB" % (mb,))
+    print("  bytewise prefix loop:  %.4fs" % (timeit(trim_bytes),))
+    print("  chunked prefix/suffix: %.4fs" % (timeit(trim_views),))
+    print("  _write_data:           %.4fs" % (timeit(write_data),))
+
+
+def make_command_patch(nentries):
+    """Make a patch with many small commands, for a single-file target.
+
+    Each entry joins and pops a path, then copies and inserts a little data,
+    which is typical of the commands generated for a large tree.
+    """
+    stream = BytesIO()
+    stream.write(patch.PATCH_HEADER)
+    patch._write_vint(stream,1)
+    for i in xrange(nentries):
+        name = ("entry%d" % (i,)).encode("ascii")
+        patch._write_vint(stream,patch.JOIN_PATH)
+        patch._write_vint(stream,len(name))
+        stream.write(name)
+        patch._write_vint(stream,patch.POP_PATH)
+    for i in xrange(nentries):
+        patch._write_vint(stream,patch.PF_COPY)
+        patch._write_vint(stream,1)
+        patch._write_vint(stream,patch.PF_INS_RAW)
+        patch._write_vint(stream,3)
+        stream.write("abc".encode("ascii"))
+    return stream.getvalue()
+
+
+def bench_commands(nentries):
+    """Time applying a patch made of many small commands."""
+    data = make_command_patch(nentries)
+    workdir = tempfile.mkdtemp()
+    try:
+        target = os.path.join(workdir,"target")
+        patchfile = os.path.join(workdir,"patch")
+        with open(patchfile,"wb") as f:
+            f.write(data)
+        def apply(stream):
+            with open(target,"wb") as f:
+                f.write("x".encode("ascii") * nentries)
+            patch.apply_patch(target,stream())
+        print("command patch: %d entries, %d bytes" % (nentries,len(data)))
+        print("  from memory:           %.4fs" % (timeit(apply,
+                                                  lambda: BytesIO(data)),))
+        print("  from file:             %.4fs" % (timeit(apply,
+                                                  lambda: open(patchfile,"rb")),))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def make_bsdiff4_patch(size,blocksize=64*1024):
+    """Make a source string and a BSDIFF4 patch against it.
+
+    The diff data is mostly zeros with a few changed bytes in each block,
+    and each block is followed by a little extra data, which is roughly
+    what bsdiff produces for a binary with small scattered edits.
+    """
+    rng = random.Random(size)
+    source = os.urandom(size)
+    control = []
+    diff = bytearray(size)
+    extra = []
+    for start in xrange(0,size,blocksize):
+        x = min(blocksize,size - start)
+        for _ in xrange(16):
+            diff[start + rng.randrange(x)] = rng.randrange(256)
+        extra.append(os.urandom(64))
+        control.append((x,64,0))
+    bcontrol = "".encode("ascii").join(patch._encode_offt(v)
+                                       for c in control for v in c)
+    extra = "".encode("ascii").join(extra)
+    blocks = (bcontrol,bytes(diff),extra)
+    return (source,patch.bsdiff4_encode(blocks,size + len(extra)))
+
+
+def bench_bsdiff4_patch(size):
+    """Time applying a BSDIFF4 patch with and without cx-bsdiff."""
+    (source,bspatch) = make_bsdiff4_patch(size)
+    def bytewise_loop():
+        #  The per-byte loop that the pure-python fallback used to run.
+        l_bcontrol = patch._decode_offt(bspatch[8:16])
+        l_bdiff = patch._decode_offt(bspatch[16:24])
+        bcontrol = bz2.decompress(bspatch[32:32+l_bcontrol])
+        bdiff = BytesIO(bz2.decompress(bspatch[32+l_bcontrol:
+                                               32+l_bcontrol+l_bdiff]))
+        bextra = BytesIO(bz2.decompress(bspatch[32+l_bcontrol+l_bdiff:]))
+        src = BytesIO(source)
+        result = BytesIO()
+        for i in xrange(0,len(bcontrol),24):
+            x = patch._decode_offt(bcontrol[i:i+8])
+            y = patch._decode_offt(bcontrol[i+8:i+16])
+            z = patch._decode_offt(bcontrol[i+16:i+24])
+            diff_data = bdiff.read(x)
+            orig_data = src.read(x)
+            for j in xrange(len(diff_data)):
+                result.write(chr((ord(diff_data[j])+ord(orig_data[j]))%256))
+            result.write(bextra.read(y))
+            src.seek(z,os.SEEK_CUR)
+        return result.getvalue()
+    def fallback():
+        cx_bsdiff = patch.cx_bsdiff
+        patch.cx_bsdiff = None
+        try:
+            return patch.bsdiff4_patch(source,bspatch)
+        finally:
+            patch.cx_bsdiff = cx_bsdiff
+    def add_bytes():
+        cx_bsdiff = patch.cx_bsdiff
+        patch.cx_bsdiff = None
+        try:
+            return patch._add_bytes(source,source)
+        finally:
+            patch.cx_bsdiff = cx_bsdiff
+    mb = size / float(1024 * 1024)
+    print("bsdiff4 patch: %.1fMB target" % (mb,))
+    if size <= 4 * 1024 * 1024:
+        print("  bytewise loop:         %.4fs" % (timeit(bytewise_loop),))
+    else:
+        print("  bytewise loop:         (skipped, too slow)")
+    print("  pure-python fallback:  %.4fs" % (timeit(fallback),))
+    print("  _add_bytes, random:    %.4fs" % (timeit(add_bytes),))
+    if patch.cx_bsdiff is not None:
+        print("  cx-bsdiff:             %.4fs" % (timeit(patch.bsdiff4_patch,
+                                                         source,bspatch),))
+    else:
+        print("  cx-bsdiff:             (not installed)")
+
+
+def bench_bsdiff4_diff(size):
+    """Time generating a BSDIFF4 patch with and without cx-bsdiff."""
+    (source,target) = make_window(size)
+    def pure_python(import_numpy):
+        cx_bsdiff = patch.cx_bsdiff
+        saved_import_numpy = patch._import_numpy
+        patch.cx_bsdiff = None
+        patch._import_numpy = import_numpy
+        try:
+            return patch.bsdiff4_diff(source,target)
+        finally:
+            patch.cx_bsdiff = cx_bsdiff
+            patch._import_numpy = saved_import_numpy
+    mb = size / float(1024 * 1024)
+    print("bsdiff4 diff: %.1fMB window" % (mb,))
+    print("  pure-python:           %.4fs" % (timeit(pure_python,
+                                                     lambda: None),))
+    if patch._import_numpy() is not None:
+        print("  pure-python, numpy:    %.4fs" % (timeit(pure_python,
+                                                  patch._import_numpy),))
+    else:
+        print("  pure-python, numpy:    (not installed)")
+    if patch.cx_bsdiff is not None:
+        print("  cx-bsdiff:             %.4fs" % (timeit(patch.bsdiff4_diff,
+                                                         source,target),))
+    else:
+        print("  cx-bsdiff:             (not installed)")
+
+
+def main(argv):
+    if len(argv) > 1:
+        sizes = [int(argv[1]) * 1024 * 1024]
+    else:
+        sizes = [1024 * 1024,4 * 1024 * 1024,16 * 1024 * 1024]
+    for size in sizes:
+        bench_windows(size)
+    for size in sizes:
+        bench_bsdiff4_patch(size)
+    for size in sizes:
+        if size <= 4 * 1024 * 1024:
+            bench_bsdiff4_diff(size)
+    bench_commands(100000)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
+
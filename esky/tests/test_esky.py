@@ -15,8 +15,15 @@ import tempfile
 import urllib2
 import hashlib
 import tarfile
+import gzip
+import bz2
+import struct
+import random
 import time
+import imp
+import marshal
 from contextlib import contextmanager
+from StringIO import StringIO
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 from BaseHTTPServer import HTTPServer
 
@@ -29,7 +36,7 @@ import esky.sudo
 from esky import bdist_esky
 from esky.bdist_esky import Executable
 from esky.util import extract_zipfile, deep_extract_zipfile, get_platform, \
-                      ESKY_CONTROL_DIR, files_differ
+                      ESKY_CONTROL_DIR, files_differ, create_zipfile
 from esky.fstransact import FSTransaction
 
 try:
@@ -575,6 +582,10 @@ class TestPatch(unittest.TestCase):
     _TEST_FILES_URL = "http://pypi.python.org/packages/source/p/pyenchant/"
 
     def setUp(self):
+        #  The pure-python bsdiff is far too slow to use for the whole suite;
+        #  test_bsdiff4_diff_fallback checks that it works.
+        self._bsdiff_fallback = esky.patch.BSDIFF_FALLBACK
+        esky.patch.BSDIFF_FALLBACK = False
         self.tests_root = dirname(__file__)
         platform = get_platform()
         self.tfdir = tfdir = os.path.join(self.tests_root,"patch-test-files")
@@ -594,6 +605,7 @@ class TestPatch(unittest.TestCase):
                     f.write(data)
 
     def tearDown(self):
+        esky.patch.BSDIFF_FALLBACK = self._bsdiff_fallback
         shutil.rmtree(self.workdir)
 
     def test_patch_bigfile(self):
@@ -618,6 +630,234 @@ class TestPatch(unittest.TestCase):
         finally:
             shutil.rmtree(tdir)
 
+    def test_patch_bigfile_with_moved_data(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            data = [os.urandom(1024*50) for i in xrange(6)]
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write("".join(data))
+            #  Insert data at the front, and move a chunk from back to front.
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                f.write(os.urandom(1000))
+                f.write("".join([data[5]] + data[:3] + ["XXX"] + data[3:5]))
+            for (window,adaptive) in ((None,False),(1024*64,False),
+                                      (1024*64,True)):
+                patch = StringIO()
+                esky.patch.write_patch(os.path.join(tdir,"source"),
+                                       os.path.join(tdir,"target"),patch,
+                                       diff_window_size=window,
+                                       adaptive_windows=adaptive)
+                self.assertTrue(len(patch.getvalue()) < 1024*4)
+                shutil.copy(os.path.join(tdir,"source"),
+                            os.path.join(tdir,"patched"))
+                esky.patch.apply_patch(os.path.join(tdir,"patched"),
+                                       StringIO(patch.getvalue()))
+                dgst1 = esky.patch.calculate_digest(os.path.join(tdir,"target"))
+                dgst2 = esky.patch.calculate_digest(os.path.join(tdir,"patched"))
+                self.assertEquals(dgst1,dgst2)
+        finally:
+            shutil.rmtree(tdir)
+
+    def test_patch_file_with_shared_prefix_and_suffix(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            head = os.urandom(1024*20)
+            tail = os.urandom(1024*20)
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write(head + os.urandom(1024*10) + tail)
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                f.write(head + "hello world" + tail)
+            patch = StringIO()
+            esky.patch.write_patch(os.path.join(tdir,"source"),
+                                   os.path.join(tdir,"target"),patch)
+            self.assertTrue(len(patch.getvalue()) < 100)
+            esky.patch.apply_patch(os.path.join(tdir,"source"),
+                                   StringIO(patch.getvalue()))
+            dgst1 = esky.patch.calculate_digest(os.path.join(tdir,"target"))
+            dgst2 = esky.patch.calculate_digest(os.path.join(tdir,"source"))
+            self.assertEquals(dgst1,dgst2)
+        finally:
+            shutil.rmtree(tdir)
+
+    def test_patch_with_alternative_codecs(self):
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        codecs = [("zlib",),("bz2","zlib")]
+        if esky.patch.lzma is not None:
+            codecs.append(("lzma",))
+        for c in codecs:
+            for objective in ("size","speed"):
+                patch = StringIO()
+                esky.patch.write_patch(path1,path2,patch,codecs=c,
+                                       objective=objective)
+                path3 = os.path.join(self.workdir,"patched")
+                shutil.copytree(path1,path3)
+                esky.patch.apply_patch(path3,StringIO(patch.getvalue()))
+                self.assertEquals(esky.patch.calculate_digest(path3),
+                                  esky.patch.calculate_digest(path2))
+                shutil.rmtree(path3)
+
+    def test_patch_appended_file_at_each_effort_level(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            data = os.urandom(1024*100)
+            extra = os.urandom(1024*10)
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write(data)
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                f.write(data + extra)
+            differ = esky.patch.Differ(StringIO())
+            self.assertEquals(differ._choose_encoders("",extra)[1],())
+            for effort in esky.patch.EFFORT_LEVELS:
+                patch = StringIO()
+                esky.patch.write_patch(os.path.join(tdir,"source"),
+                                       os.path.join(tdir,"target"),patch,
+                                       effort=effort)
+                self.assertTrue(len(patch.getvalue()) < len(extra) + 100)
+                shutil.copy(os.path.join(tdir,"source"),
+                            os.path.join(tdir,"patched"))
+                esky.patch.apply_patch(os.path.join(tdir,"patched"),
+                                       StringIO(patch.getvalue()))
+                dgst1 = esky.patch.calculate_digest(os.path.join(tdir,"target"))
+                dgst2 = esky.patch.calculate_digest(os.path.join(tdir,"patched"))
+                self.assertEquals(dgst1,dgst2)
+        finally:
+            shutil.rmtree(tdir)
+
+    def test_streaming_patcher(self):
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        for codecs in (("bz2",),("zlib",)):
+            patch = StringIO()
+            esky.patch.write_patch(path1,path2,patch,codecs=codecs)
+            path3 = os.path.join(self.workdir,"patched")
+            shutil.copytree(path1,path3)
+            esky.patch.apply_patch(path3,StringIO(patch.getvalue()),
+                                   max_memory=1024*16)
+            self.assertEquals(esky.patch.calculate_digest(path3),
+                              esky.patch.calculate_digest(path2))
+            shutil.rmtree(path3)
+
+    def test_streaming_bsdiff4_patch(self):
+        source = os.urandom(1024*50)
+        diff = "".join(chr(i % 3) for i in xrange(1024*20))
+        extra = os.urandom(1024*30)
+        control = [(len(diff),len(extra),1024*10),(1024*10,0,0)]
+        blocks = ("".join(esky.patch._encode_offt(x) for c in control
+                          for x in c),
+                  diff + "\x00" * 1024*10,extra)
+        expected = esky.patch.bsdiff4_patch(source,
+                        esky.patch.bsdiff4_encode(blocks,1024*60))
+        for codec in ("bz2","zlib"):
+            codec = esky.patch._CODECS[codec]
+            stream = StringIO()
+            stream.write(esky.patch.PATCH_HEADER)
+            esky.patch._write_vint(stream,1)
+            esky.patch._write_vint(stream,codec.bsdiff_command)
+            esky.patch._write_vint(stream,len(source))
+            bspatch = esky.patch.bsdiff4_encode(blocks,1024*60,
+                                                codec.compress)[8:]
+            esky.patch._write_vint(stream,len(bspatch))
+            stream.write(bspatch)
+            target = os.path.join(self.workdir,"target")
+            with open(target,"wb") as f:
+                f.write(source)
+            esky.patch.apply_patch(target,StringIO(stream.getvalue()),
+                                   max_memory=1024*8)
+            with open(target,"rb") as f:
+                self.assertEquals(f.read(),expected)
+
+    def test_bsdiff4_patch_fallback(self):
+        source = os.urandom(1024*50)
+        diff = os.urandom(1024*20) + "\x00" * 1024*10
+        extra = os.urandom(1024*30)
+        control = [(1024*20,1024*30,-1024*5),(1024*10,0,0)]
+        blocks = ("".join(esky.patch._encode_offt(x) for c in control
+                          for x in c),diff,extra)
+        bspatch = esky.patch.bsdiff4_encode(blocks,1024*60)
+        expected = []
+        oldpos = 0
+        for (x,y,z) in control:
+            for i in xrange(x):
+                expected.append(chr((ord(diff[i])+ord(source[oldpos+i]))%256))
+            diff = diff[x:]
+            expected.append(extra[:y])
+            extra = extra[y:]
+            oldpos += x + z
+        expected = "".join(expected)
+        cx_bsdiff = esky.patch.cx_bsdiff
+        esky.patch.cx_bsdiff = None
+        try:
+            self.assertEquals(esky.patch.bsdiff4_patch(source,bspatch),
+                              expected)
+            self.assertRaises(esky.patch.PatchError,esky.patch.bsdiff4_patch,
+                              source[:1024*20],bspatch)
+        finally:
+            esky.patch.cx_bsdiff = cx_bsdiff
+
+    def test_bsdiff4_diff_fallback(self):
+        source = os.urandom(1024*20) + "abc\n" * 1024 + "\x00" * 1024*4
+        target = list(source)
+        for i in xrange(0,len(target),1024*3):
+            target[i] = "X"
+        target = "".join(target[:1024*6] + ["hello"] + target[1024*9:])
+        cx_bsdiff = esky.patch.cx_bsdiff
+        esky.patch.cx_bsdiff = None
+        try:
+            for data in ("","a","banana",os.urandom(1024*4)):
+                self.assertEquals(list(esky.patch._suffix_sort(data)),
+                                  sorted(xrange(len(data)+1),
+                                         key=lambda i: data[i:]))
+            #  Very repetitive data is only sorted by its first few bytes.
+            sa = esky.patch._suffix_sort(source)
+            self.assertEquals(sorted(sa),range(len(source)+1))
+            prefixes = [source[i:i+4] for i in sa]
+            self.assertEquals(prefixes,sorted(prefixes))
+            for (s,t) in ((source,target),("",target),(source,"")):
+                bspatch = esky.patch.bsdiff4_diff(s,t)
+                self.assertEquals(esky.patch.bsdiff4_patch(s,bspatch),t)
+            bspatch = esky.patch.bsdiff4_diff(source,target)
+            self.assertTrue(len(bspatch) < 1024)
+            #  The Differ only uses the fallback if allowed to.
+            tdir = tempfile.mkdtemp()
+            try:
+                for nm in ("source","target"):
+                    os.mkdir(os.path.join(tdir,nm))
+                with open(os.path.join(tdir,"source","f"),"wb") as f:
+                    f.write(source)
+                with open(os.path.join(tdir,"target","f"),"wb") as f:
+                    f.write(target)
+                sizes = []
+                for fallback in (False,True):
+                    esky.patch.BSDIFF_FALLBACK = fallback
+                    patch = StringIO()
+                    esky.patch.write_patch(os.path.join(tdir,"source"),
+                                           os.path.join(tdir,"target"),patch)
+                    sizes.append(len(patch.getvalue()))
+                self.assertTrue(sizes[1] < sizes[0])
+            finally:
+                shutil.rmtree(tdir)
+        finally:
+            esky.patch.cx_bsdiff = cx_bsdiff
+
+    def test_patch_stream(self):
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        patch = StringIO()
+        esky.patch.write_patch(path1,path2,patch)
+        patch = patch.getvalue()
+        #  A truncated patch fails once the stream is closed.
+        stream = esky.patch.PatchStream(path1)
+        stream.write(patch[:len(patch)//2])
+        self.assertRaises(esky.patch.PatchError,stream.close)
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        stream = esky.patch.PatchStream(path1,max_pending=2)
+        for i in xrange(0,len(patch),1000):
+            stream.write(patch[i:i+1000])
+        stream.close()
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+
     def test_diffing_back_and_forth(self):
         for (tf1,_) in self._TEST_FILES:
             for (tf2,_) in self._TEST_FILES:
@@ -633,6 +873,205 @@ class TestPatch(unittest.TestCase):
                 self.assertEquals(esky.patch.calculate_digest(path1),
                                   esky.patch.calculate_digest(path2))
 
+    def test_parallel_diff_matches_serial(self):
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        serial = StringIO()
+        esky.patch.write_patch(path1,path2,serial)
+        parallel = StringIO()
+        esky.patch.write_patch(path1,path2,parallel,workers=3)
+        self.assertEquals(serial.getvalue(),parallel.getvalue())
+        esky.patch.apply_patch(path1,StringIO(parallel.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+
+    def test_parallel_diff_of_big_file(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            data = [os.urandom(1024*16) for i in xrange(16)]
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write("".join(data))
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                for chunk in data:
+                    f.write(chunk[:100] + "XXX" + chunk[100:])
+            patches = []
+            for workers in (0,2):
+                patch = StringIO()
+                esky.patch.write_patch(os.path.join(tdir,"source"),
+                                       os.path.join(tdir,"target"),patch,
+                                       diff_window_size=1024*32,
+                                       workers=workers)
+                patches.append(patch.getvalue())
+            self.assertEquals(patches[0],patches[1])
+            esky.patch.apply_patch(os.path.join(tdir,"source"),
+                                   StringIO(patch.getvalue()))
+            dgst1 = esky.patch.calculate_digest(os.path.join(tdir,"target"))
+            dgst2 = esky.patch.calculate_digest(os.path.join(tdir,"source"))
+            self.assertEquals(dgst1,dgst2)
+        finally:
+            shutil.rmtree(tdir)
+
+    def test_parallel_diff_of_multi_window_file(self):
+        #  A file spanning several full-sized diff windows, with data
+        #  changed in each, inserted near the start and moved around.
+        tdir = tempfile.mkdtemp()
+        try:
+            size = 2 * esky.patch.DIFF_WINDOW_SIZE + 1024*1024
+            data = os.urandom(size)
+            edited = []
+            for i in xrange(0,size,1024*512):
+                chunk = data[i:i+1024*512]
+                edited.append(chunk[:1000] + "CHANGED" + chunk[1007:])
+            edited.insert(1,os.urandom(5000))
+            edited.append(edited.pop(4))
+            source = os.path.join(tdir,"source")
+            target = os.path.join(tdir,"target")
+            with open(source,"wb") as f:
+                f.write(data)
+            with open(target,"wb") as f:
+                f.write("".join(edited))
+            for kwds in ({},{"adaptive_windows":True}):
+                patches = []
+                for workers in (0,2):
+                    patch = StringIO()
+                    esky.patch.write_patch(source,target,patch,
+                                           workers=workers,**kwds)
+                    patches.append(patch.getvalue())
+                self.assertEquals(patches[0],patches[1])
+            esky.patch.apply_patch(source,StringIO(patches[1]))
+            self.assertEquals(esky.patch.calculate_digest(source),
+                              esky.patch.calculate_digest(target))
+        finally:
+            shutil.rmtree(tdir)
+
+    def test_differ_stats(self):
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        writes = []
+        class Stream(StringIO):
+            def write(self,data):
+                writes.append(len(data))
+                StringIO.write(self,data)
+        for workers in (1,3):
+            del writes[:]
+            patch = Stream()
+            differ = esky.patch.Differ(patch,workers=workers)
+            differ.diff(path1,path2)
+            stats = differ.stats
+            self.assertEquals(sum(stats.values()),len(patch.getvalue()))
+            self.assertEquals(stats["HEADER"],len(esky.patch.PATCH_HEADER)+1)
+            self.assertTrue(stats["VERIFY_MD5"] > 16)
+            #  Output is written in large chunks, not one per command.
+            self.assertTrue(len(writes) <= len(patch.getvalue()) // 1024 + 1)
+        esky.patch.apply_patch(path1,StringIO(patch.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+
+    def test_tree_snapshot(self):
+        path1 = self._extract("pyenchant-1.5.2.tar.gz","source")
+        path2 = self._extract("pyenchant-1.5.2.tar.gz","target")
+        path3 = self._extract("pyenchant-1.6.0.tar.gz","other")
+        snapshot = esky.patch.TreeSnapshot()
+        self.assertFalse(esky.patch.paths_differ(path1,path2,snapshot))
+        self.assertTrue(esky.patch.paths_differ(path1,path3,snapshot))
+        for path in (path1,path2,path3):
+            self.assertEquals(esky.patch.calculate_digest(path,snapshot=snapshot),
+                              esky.patch.calculate_digest(path))
+        #  Results are cached until the snapshot is told to forget them.
+        shutil.rmtree(path3)
+        self.assertTrue(esky.patch.paths_differ(path1,path3,snapshot))
+        snapshot.forget(path3)
+        self.assertFalse(snapshot.exists(path3))
+
+    def test_moved_and_duplicated_files(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            data = [os.urandom(1024*16) for i in xrange(4)]
+            self._write(tdir,"source/a/one.dll",data[0])
+            self._write(tdir,"source/m/two.dll",data[1])
+            self._write(tdir,"source/m/three.dll",data[2])
+            self._write(tdir,"source/z/four.dll",data[3])
+            self._write(tdir,"target/a/two.dll",data[1])
+            self._write(tdir,"target/m/three.dll",data[2])
+            self._write(tdir,"target/m/three-copy.dll",data[2])
+            self._write(tdir,"target/n/libfour.so.2",data[3])
+            self._write(tdir,"target/z/one.dll",data[0])
+            source = os.path.join(tdir,"source")
+            target = os.path.join(tdir,"target")
+            patch = StringIO()
+            esky.patch.write_patch(source,target,patch)
+            self.assertTrue(len(patch.getvalue()) < 1024)
+            esky.patch.apply_patch(source,StringIO(patch.getvalue()))
+            self.assertEquals(esky.patch.calculate_digest(source),
+                              esky.patch.calculate_digest(target))
+        finally:
+            shutil.rmtree(tdir)
+
+    def test_patch_version_2(self):
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        patch = StringIO()
+        esky.patch.write_patch(path1,path2,patch,patch_version=2)
+        data = patch.getvalue()
+        index = esky.patch.read_patch_index(StringIO(data))
+        self.assertEquals(index[0][2],len(esky.patch.PATCH_HEADER) + 1)
+        for (i,(kind,path,offset,size,digest)) in enumerate(index):
+            self.assertEquals(ord(data[offset]),kind)
+            if i + 1 < len(index):
+                self.assertEquals(offset + size,index[i+1][2])
+            if kind == esky.patch.FRAME_PARALLEL:
+                self.assertEquals(digest,esky.patch.calculate_digest(
+                                             os.path.join(path2,path)))
+        esky.patch.apply_patch(path1,StringIO(patch.getvalue()),workers=4)
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+        #  Stashed items used by several top-level items are copied out.
+        tdir = tempfile.mkdtemp()
+        try:
+            data = [os.urandom(1024*16) for i in xrange(3)]
+            self._write(tdir,"source/a/one.dll",data[0])
+            self._write(tdir,"source/m/two.dll",data[1])
+            self._write(tdir,"source/z/three.dll",data[2])
+            self._write(tdir,"target/a/two.dll",data[1])
+            self._write(tdir,"target/m/one.dll",data[0])
+            self._write(tdir,"target/n/one-copy.dll",data[0])
+            self._write(tdir,"target/z/two.dll",data[1])
+            source = os.path.join(tdir,"source")
+            target = os.path.join(tdir,"target")
+            patch = StringIO()
+            esky.patch.write_patch(source,target,patch,patch_version=2)
+            self.assertTrue(len(patch.getvalue()) < 1024)
+            esky.patch.apply_patch(source,StringIO(patch.getvalue()),
+                                   workers=4)
+            self.assertEquals(esky.patch.calculate_digest(source),
+                              esky.patch.calculate_digest(target))
+        finally:
+            shutil.rmtree(tdir)
+
+    def test_moved_and_edited_items(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            def module():
+                return "\n".join(os.urandom(30).encode("hex")
+                                 for i in xrange(500))
+            mod = module()
+            self._write(tdir,"source/pkg/mod.py",mod)
+            self._write(tdir,"target/pkg/sub/mod2.py",mod.replace("a","A",5))
+            mods = [module() for i in xrange(4)]
+            for (i,mod) in enumerate(mods):
+                self._write(tdir,"source/lib/x/m%d.py" % (i,),mod)
+                self._write(tdir,"target/vendor/x/m%d.py" % (i,),
+                            mod + "\n#edited\n")
+            source = os.path.join(tdir,"source")
+            target = os.path.join(tdir,"target")
+            patch = StringIO()
+            esky.patch.write_patch(source,target,patch)
+            esky.patch.apply_patch(source,StringIO(patch.getvalue()))
+            self.assertEquals(esky.patch.calculate_digest(source),
+                              esky.patch.calculate_digest(target))
+        finally:
+            shutil.rmtree(tdir)
+
     def test_apply_patch(self):
         path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
         path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
@@ -647,6 +1086,362 @@ class TestPatch(unittest.TestCase):
                          esky.patch.calculate_digest(path2))
         
 
+    def test_apply_patch_with_workers(self):
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        pf = os.path.join(self.tfdir,"v1.2.0_to_v1.6.0.patch")
+        if not os.path.exists(pf):
+            pf = os.path.join(dirname(esky.__file__),"tests","patch-test-files","v1.2.0_to_v1.6.0.patch")
+        with open(pf,"rb") as f:
+            esky.patch.apply_patch(path1,f,workers=4)
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                         esky.patch.calculate_digest(path2))
+        #  Files inside a zipfile are patched by the workers too.
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        for path in (path1,path2):
+            nm = os.listdir(path)[0]
+            create_zipfile(os.path.join(path,nm),os.path.join(path,"lib.zip"))
+        patch = StringIO()
+        esky.patch.write_patch(path1,path2,patch)
+        esky.patch.apply_patch(path1,StringIO(patch.getvalue()),workers=4)
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+
+    def test_patch_zipfile_in_place(self):
+        path1 = self._extract("pyenchant-1.2.0.tar.gz","source")
+        path2 = self._extract("pyenchant-1.6.0.tar.gz","target")
+        for path in (path1,path2):
+            nm = os.listdir(path)[0]
+            os.rename(os.path.join(path,nm),os.path.join(path,"pyenchant"))
+        #  Give the zipfiles plenty of members that don't change at all.
+        shutil.copytree(os.path.join(path1,"pyenchant","enchant"),
+                        os.path.join(path1,"pyenchant","extra"))
+        shutil.copytree(os.path.join(path1,"pyenchant","enchant"),
+                        os.path.join(path2,"pyenchant","extra"))
+        for path in (path1,path2):
+            create_zipfile(os.path.join(path,"pyenchant"),
+                           os.path.join(path,"lib.zip"),compress=True)
+            shutil.rmtree(os.path.join(path,"pyenchant"))
+        copied = []
+        old_copy_member = esky.patch._LazyZipContents._copy_member
+        def copy_member(self,zf,zinfo,s_zinfo):
+            copied.append(zinfo.filename)
+            return old_copy_member(self,zf,zinfo,s_zinfo)
+        esky.patch._LazyZipContents._copy_member = copy_member
+        try:
+            patch = StringIO()
+            esky.patch.write_patch(path1,path2,patch)
+            esky.patch.apply_patch(path1,StringIO(patch.getvalue()))
+        finally:
+            esky.patch._LazyZipContents._copy_member = old_copy_member
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+        zf = zipfile.ZipFile(os.path.join(path2,"lib.zip"))
+        try:
+            for zinfo in zf.infolist():
+                if zinfo.filename.startswith("extra/"):
+                    assert zinfo.filename in copied
+        finally:
+            zf.close()
+
+    def test_diff_zipfile_members(self):
+        source = os.path.join(self.workdir,"source")
+        target = os.path.join(self.workdir,"target")
+        for path in (source,target):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.makedirs(os.path.join(path,"lib","pkg"))
+            os.makedirs(os.path.join(path,"lib","data"))
+            for i in xrange(20):
+                with open(os.path.join(path,"lib","data","%d.txt"%(i,)),"wb") as f:
+                    f.write(("unchanged data %d\n" % (i,) * 50).encode("ascii"))
+            with open(os.path.join(path,"lib","pkg","mod.pyc"),"wb") as f:
+                f.write("compiled module".encode("ascii"))
+        with open(os.path.join(source,"lib","pkg","mod.py"),"wb") as f:
+            f.write("x = 1\n".encode("ascii"))
+        with open(os.path.join(target,"lib","pkg","mod.py"),"wb") as f:
+            f.write("x = 2\n".encode("ascii"))
+        #  A copy of an unchanged member, and a new directory.
+        shutil.copy(os.path.join(target,"lib","data","7.txt"),
+                    os.path.join(target,"lib","pkg","copy.txt"))
+        os.makedirs(os.path.join(target,"lib","new"))
+        with open(os.path.join(target,"lib","new","file.txt"),"wb") as f:
+            f.write("new file".encode("ascii"))
+        for path in (source,target):
+            create_zipfile(os.path.join(path,"lib"),
+                           os.path.join(path,"lib.zip"),compress=True)
+            shutil.rmtree(os.path.join(path,"lib"))
+        s_zf = zipfile.ZipFile(os.path.join(source,"lib.zip"))
+        t_zf = zipfile.ZipFile(os.path.join(target,"lib.zip"))
+        try:
+            names = esky.patch._changed_zipfile_members(s_zf,t_zf)
+        finally:
+            s_zf.close()
+            t_zf.close()
+        self.assertEquals(names,set(["pkg/mod.py","pkg/mod.pyc","data/7.txt",
+                                     "pkg/copy.txt","new/file.txt"]))
+        found = []
+        old_changed_members = esky.patch._changed_zipfile_members
+        def changed_members(s_zf,t_zf):
+            found.append(old_changed_members(s_zf,t_zf))
+            return found[-1]
+        esky.patch._changed_zipfile_members = changed_members
+        try:
+            patch = StringIO()
+            esky.patch.write_patch(source,target,patch)
+        finally:
+            esky.patch._changed_zipfile_members = old_changed_members
+        self.assertEquals(found,[names])
+        esky.patch.apply_patch(source,StringIO(patch.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(source),
+                          esky.patch.calculate_digest(target))
+
+    def test_patch_zipfile_with_preamble(self):
+        def make_exe(path,stub,version,relative=False,trailer=""):
+            zdata = StringIO()
+            if not relative:
+                zdata.write(stub)
+            zf = zipfile.ZipFile(zdata,"w",compression=zipfile.ZIP_DEFLATED)
+            for i in xrange(10):
+                data = "module %d version %d\n" % (i,version + (i == 3))
+                zf.writestr("lib/mod%d.py" % (i,),data * 100)
+            zf.comment = "built by version %d" % (version,)
+            zf.close()
+            with open(path,"wb") as f:
+                if relative:
+                    f.write(stub)
+                f.write(zdata.getvalue())
+                f.write(trailer)
+        stub1 = "".join(chr(i % 251) for i in xrange(5000))
+        stub2 = stub1[:2000] + "a new stub" + stub1[2000:]
+        extended = []
+        old_recurse_zipfile = esky.patch.Patcher._recurse_zipfile
+        def recurse_zipfile(self,flags):
+            if flags is not None:
+                extended.append(flags)
+            return old_recurse_zipfile(self,flags)
+        esky.patch.Patcher._recurse_zipfile = recurse_zipfile
+        try:
+            for (relative,trailer) in ((False,""),(True,""),(False,"junk")):
+                del extended[:]
+                source = os.path.join(self.workdir,"source.zip")
+                target = os.path.join(self.workdir,"target.zip")
+                make_exe(source,stub1,1,relative)
+                make_exe(target,stub2,2,relative,trailer)
+                patch = StringIO()
+                esky.patch.write_patch(source,target,patch)
+                esky.patch.apply_patch(source,StringIO(patch.getvalue()))
+                self.assertEquals(esky.patch.calculate_digest(source),
+                                  esky.patch.calculate_digest(target))
+                #  Trailing data can't be recreated, so falls back
+                #  to diffing the file as a binary.
+                if trailer:
+                    self.assertEquals(extended,[])
+                else:
+                    flags = relative and esky.patch.ZIP_RELATIVE_OFFSETS or 0
+                    self.assertEquals(extended,[flags])
+                    assert len(patch.getvalue()) < 1000
+        finally:
+            esky.patch.Patcher._recurse_zipfile = old_recurse_zipfile
+
+    def test_patch_compressed_file(self):
+        lines = ["line %d of some data file\n" % (i,) for i in xrange(20000)]
+        data1 = "".join(lines)
+        lines[10] = "a changed line\n"
+        data2 = "".join(lines)
+        def write_gzip(path,data,level=9,trailer=""):
+            with open(path,"wb") as f:
+                gz = gzip.GzipFile("data",mode="wb",compresslevel=level,
+                                   fileobj=f,mtime=1234567890)
+                gz.write(data)
+                gz.close()
+                f.write(trailer)
+        def write_bz2(path,data,level=9):
+            with open(path,"wb") as f:
+                f.write(bz2.compress(data,level))
+        cases = [(".gz",write_gzip,{}),
+                 (".gz",write_gzip,{"level":1}),
+                 (".bz2",write_bz2,{"level":3}),
+                 (".gz",write_gzip,{"trailer":"junk"})]
+        for (ext,write,kwds) in cases:
+            source = os.path.join(self.workdir,"source" + ext)
+            target = os.path.join(self.workdir,"target" + ext)
+            write(source,data1)
+            write(target,data2,**kwds)
+            patch = StringIO()
+            esky.patch.write_patch(source,target,patch)
+            esky.patch.apply_patch(source,StringIO(patch.getvalue()))
+            self.assertEquals(esky.patch.calculate_digest(source),
+                              esky.patch.calculate_digest(target))
+            #  Files that can't be recreated exactly are diffed as
+            #  binaries, giving a patch of most of the compressed data.
+            if "trailer" in kwds:
+                assert len(patch.getvalue()) > 1000
+            else:
+                assert len(patch.getvalue()) < 1000
+
+    def test_patch_compressed_file_fallback(self):
+        #  Recompressing an xz file is slow, so a target that can't be
+        #  recreated is given up on after only a couple of presets.  No
+        #  format tries the same level twice.
+        cases = [("xz","\xFD7zXZ\x00\x00\x04",[6,16]),
+                 ("gzip","\x1F\x8B\x08\x00\x00\x00\x00\x00\x02\xFF",
+                  [9,6,1,2,3,4,5,7,8,0]),
+                 ("gzip","\x1F\x8B\x08\x00\x00\x00\x00\x00\x04\xFF",
+                  [1,6,9,2,3,4,5,7,8,0])]
+        for (name,header,expected) in cases:
+            real = [fmt for fmt in esky.patch._COMPRESSED_FORMATS
+                        if fmt.name == name][0]
+            levels = []
+            def decompress(fin,fout):
+                fout.write(fin.read())
+            def compress(fin,fout,level,params):
+                levels.append(level)
+                fout.write("mismatch")
+            fmt = esky.patch._CompressedFormat(name,real.extensions,
+                                               real.params,decompress,
+                                               compress,())
+            source = os.path.join(self.workdir,"source" + real.extensions[0])
+            target = os.path.join(self.workdir,"target" + real.extensions[0])
+            for path in (source,target):
+                with open(path,"wb") as f:
+                    f.write(header + os.urandom(1024))
+            s_payload = os.path.join(self.workdir,"source")
+            t_payload = os.path.join(self.workdir,"target")
+            found = esky.patch._find_compression(fmt,source,target,
+                                                 s_payload,t_payload)
+            self.assertEquals(found,None)
+            self.assertEquals(levels,expected)
+
+    def test_patch_executable_file(self):
+        #  Build minimal x86_64 ELF files whose code has some functions,
+        #  then lots of calls to them.  The target has extra code inserted
+        #  between the two, changing the relative target of every call.
+        def make_elf(path,padding):
+            funcs = "".join(chr(i % 256) for i in xrange(512))
+            code = funcs + padding
+            for i in xrange(2000):
+                rel = (i * 7919 % 16) * 32 - (len(code) + 5)
+                code += "\xe8" + struct.pack("<i",rel) + "\x90\x90\x90"
+            header = "\x7fELF\x02\x01\x01" + "\x00" * 9
+            header += struct.pack("<HHIQQQIHHHHHH",2,62,1,0,0,64+len(code),
+                                  0,64,56,0,64,1,0)
+            shdr = struct.pack("<IIQQQQIIQQ",0,1,6,0,64,len(code),0,0,16,0)
+            with open(path,"wb") as f:
+                f.write(header + code + shdr)
+        source = os.path.join(self.workdir,"source.so")
+        target = os.path.join(self.workdir,"target.so")
+        make_elf(source,"")
+        make_elf(target,"\x90" * 64)
+        self.assertEquals(esky.patch._x86_code_ranges(target),
+                          [(64,512+64+2000*8)])
+        patches = []
+        for transform in (False,True):
+            patch = StringIO()
+            esky.patch.write_patch(source,target,patch,
+                                   transform_executables=transform)
+            patches.append(patch.getvalue())
+        shutil.copy(source,source + ".orig")
+        for patch in patches:
+            shutil.copy(source + ".orig",source)
+            esky.patch.apply_patch(source,StringIO(patch))
+            self.assertEquals(esky.patch.calculate_digest(source),
+                              esky.patch.calculate_digest(target))
+        assert len(patches[1]) < len(patches[0])
+        #  Files that aren't ELF are diffed as usual.
+        with open(source,"wb") as f:
+            f.write("not an executable" * 100)
+        patch = StringIO()
+        esky.patch.write_patch(source,target,patch,transform_executables=True)
+        esky.patch.apply_patch(source,StringIO(patch.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(source),
+                          esky.patch.calculate_digest(target))
+
+    def test_patch_pyc_file(self):
+        code = "def f(x):\n    return x + %d\n\nclass C:\n    pass\n"
+        def write_pyc(path,filename,mtime,n=1):
+            with open(path,"wb") as f:
+                f.write(imp.get_magic() + struct.pack("<i",mtime))
+                f.write(marshal.dumps(compile(code % (n,),filename,"exec")))
+        source = os.path.join(self.workdir,"source.pyc")
+        target = os.path.join(self.workdir,"target.pyc")
+        write_pyc(source,"/build/one/module.py",1234567890)
+        for (filename,n) in (("/build/two/module.py",1),
+                             ("/build/three/module.py",2)):
+            write_pyc(target,filename,1234567899,n)
+            shutil.copy(source,source + ".orig")
+            patch = StringIO()
+            differ = esky.patch.Differ(patch)
+            differ.diff(source,target)
+            esky.patch.apply_patch(source,StringIO(patch.getvalue()))
+            self.assertEquals(esky.patch.calculate_digest(source),
+                              esky.patch.calculate_digest(target))
+            shutil.copy(source + ".orig",source)
+            #  A module that was just rebuilt costs nothing beyond its
+            #  header and filename.
+            patched = [k for k in differ.stats if k.startswith("PF_")]
+            if n == 1:
+                self.assertEquals(patched,["PF_REC_PYC"])
+            else:
+                self.assertNotEquals(patched,["PF_REC_PYC"])
+        #  Files that aren't compiled modules are diffed as usual.
+        with open(source,"wb") as f:
+            f.write("not a module" * 100)
+        patch = StringIO()
+        esky.patch.write_patch(source,target,patch)
+        esky.patch.apply_patch(source,StringIO(patch.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(source),
+                          esky.patch.calculate_digest(target))
+
+    def test_patch_solid(self):
+        words = ["def","return","self","import","for","in","if","else"]
+        def module(seed):
+            rand = random.Random(seed)
+            lines = []
+            for i in xrange(50):
+                line = " ".join(rand.choice(words) for j in xrange(8))
+                lines.append("%s %d\n" % (line,rand.randrange(1000)))
+            return "".join(lines)
+        for i in xrange(100):
+            self._write(self.workdir,"source/pkg%d/old%d.py" % (i % 10,i),
+                        module(i))
+            self._write(self.workdir,"target/pkg%d/new%d.py" % (i % 10,i),
+                        module(i + 1000))
+        source = os.path.join(self.workdir,"source")
+        target = os.path.join(self.workdir,"target")
+        work = os.path.join(self.workdir,"work")
+        sizes = []
+        for kwds in ({},{"solid":True},{"solid":True,"patch_version":2},
+                     {"solid":True,"workers":3}):
+            patch = StringIO()
+            differ = esky.patch.Differ(patch,**kwds)
+            differ.diff(source,target)
+            sizes.append(len(patch.getvalue()))
+            if kwds:
+                self.assertTrue(differ.stats["SOLID_DATA"] > 0)
+            for max_memory in (None,1024*16):
+                if os.path.exists(work):
+                    shutil.rmtree(work)
+                shutil.copytree(source,work)
+                esky.patch.apply_patch(work,StringIO(patch.getvalue()),
+                                       max_memory=max_memory,workers=3)
+                self.assertEquals(esky.patch.calculate_digest(work),
+                                  esky.patch.calculate_digest(target))
+        #  Compressing the new files together gives a much smaller patch.
+        assert sizes[1] < sizes[0] * 0.8
+        #  Files diffed by workers give the same patch.
+        self.assertEquals(sizes[3],sizes[1])
+
+    def _write(self,tdir,path,data):
+        path = os.path.join(tdir,path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path,"wb") as f:
+            f.write(data)
+
     def _extract(self,filename,dest):
         dest = os.path.join(self.workdir,dest)
         for i in xrange(10):
@@ -691,3 +1486,56 @@ class TestFilesDiffer(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tdir)
 
+
+
+class TestSummaryFinder(unittest.TestCase):
+
+    class _App(object):
+        name = "example"
+        version = "1.0"
+        platform = "testplat"
+        def __init__(self,appdir):
+            self.appdir = appdir
+        def _get_update_dir(self):
+            return os.path.join(self.appdir,"updates")
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_corrupt_streamed_patch(self):
+        app = self._App(os.path.join(self.tdir,"app"))
+        vdir = os.path.join(app.appdir,"versions","example-1.0.testplat")
+        os.makedirs(vdir)
+        open(os.path.join(vdir,"esky-bootstrap.txt"),"w").close()
+        lines = ["line %d of the data\n" % (i,) for i in xrange(1000)]
+        with open(os.path.join(vdir,"data.txt"),"w") as f:
+            f.write("".join(lines))
+        #  A patch that is cut off halfway through fails as it's streamed.
+        source = os.path.join(app.appdir,"versions")
+        target = os.path.join(self.tdir,"target")
+        shutil.copytree(source,target)
+        tfile = os.path.join(target,"example-1.0.testplat","data.txt")
+        with open(tfile,"w") as f:
+            f.write("".join(reversed(lines)))
+        patch = StringIO()
+        esky.patch.write_patch(source,target,patch)
+        patch = patch.getvalue()[:len(patch.getvalue())//2]
+        ppath = os.path.join(self.tdir,"example-1.0-to-2.0.esky")
+        with open(ppath,"wb") as f:
+            f.write(patch)
+        spath = os.path.join(self.tdir,"summary.txt")
+        with open(spath,"w") as f:
+            f.write("example testplat 2.0 1.0 file://%s %d\n"
+                    % (urllib2.quote(ppath),len(patch)))
+        finder = esky.SummaryVersionFinder("file://" + urllib2.quote(spath),
+                                           stream_patches=True)
+        self.assertTrue("2.0" in map(str,finder.find_versions(app)))
+        #  The bad patch is dropped, leaving no way to reach the version,
+        #  and its unpacked files are cleaned up.
+        self.assertRaises(esky.errors.EskyVersionError,
+                          finder.fetch_version,app,"2.0")
+        self.assertEquals(finder.version_graph.files,set())
+        self.assertEquals(os.listdir(finder._workdir(app,"unpack")),[])